@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import struct
+import subprocess
+import threading
+import time
+from functools import lru_cache
+
+from metrics import REGISTRY
+from scheduler import Scheduler
+from score import (ARPEGGIO_INTERVAL, chord_args, diff_tables, index_mapper,
+                   note_args)
+
+
+# linux/input-event-codes.h
+EV_SND = 0x12
+SND_TONE = 0x02
+# pcspkr 的输入设备
+DEFAULT_DEVICE = "/dev/input/by-path/platform-pcspkr-event-spkr"
+
+# struct input_event { struct timeval time; __u16 type; __u16 code; __s32 value; }
+INPUT_EVENT = struct.Struct("llHHi")
+
+
+def tone_event(freq):
+    """打包一个 SND_TONE 事件，频率为 0 时停止发声"""
+    return INPUT_EVENT.pack(0, 0, EV_SND, SND_TONE, round(freq))
+
+
+@lru_cache(maxsize=256)
+def chord_events(freqs):
+    """和弦琶音一个循环的事件，每个音一个打包好的 SND_TONE 事件"""
+    return tuple(tone_event(freq) for freq in freqs)
+
+
+class PlayCursor:
+    """播放位置，可在音符边界换用新的音符表（热替换）
+
+    swap() 可在任意线程调用，会立即和最近的音符表比较并得到下标换算；
+    播放线程在下一次 next() 时换用新表，已播放过的时间线保持不变。
+    """
+
+    def __init__(self, table, start=0, stop=None):
+        self.table = table
+        self.index = start
+        self.to_end = stop is None
+        self.stop = len(table) if stop is None else stop
+        # 上次 next() 是否换用了新表
+        self.swapped = False
+        self._lock = threading.Lock()
+        # 待换用的 (音符表, 下标换算)
+        self._pending = None
+
+    def swap(self, table):
+        """请求在下一个音符边界换用 table"""
+        with self._lock:
+            if self._pending is not None:
+                latest, previous_map = self._pending
+            else:
+                latest, previous_map = self.table, None
+            map_index = index_mapper(len(latest), len(table),
+                                     *diff_tables(latest, table))
+            if previous_map is not None:
+                map_index = _compose(previous_map, map_index)
+            self._pending = (table, map_index)
+
+    def swap_pending(self):
+        """是否有尚未换用的音符表"""
+        return self._pending is not None
+
+    def save(self):
+        """保存当前位置，供 restore() 恢复"""
+        return self.table, self.index, self.stop
+
+    def restore(self, state):
+        """回到 save() 保存的位置，之后换用过的音符表重新作为待换用"""
+        with self._lock:
+            latest = self._pending[0] if self._pending else self.table
+            self._pending = None
+        self.table, self.index, self.stop = state
+        if latest is not self.table:
+            self.swap(latest)
+
+    def next(self):
+        """返回下一个要播放的音符下标，播放完时返回 None"""
+        self.swapped = False
+        if self._pending is not None:
+            with self._lock:
+                table, map_index = self._pending
+                self._pending = None
+            self.index = map_index(self.index)
+            self.stop = len(table) if self.to_end else map_index(self.stop)
+            self.table = table
+            self.swapped = True
+        if self.index >= self.stop:
+            return None
+        self.index += 1
+        return self.index - 1
+
+
+def _compose(first, second):
+    return lambda i: second(first(i))
+
+
+class BeepBackend:
+    """调用 beep 命令播放
+
+    曲谱按 chunk_size 个音符分块，每块由一个 beep 进程播放，避免参数
+    超过 ARG_MAX。播放当前块时下一块的进程已经启动，阻塞在 stdin 上，
+    当前块结束后立即放行，块与块之间没有启动进程的间隙。
+    """
+
+    CHUNK_SIZE = 256
+    # 停止时等待进程退出的时间 (秒)，超时则强制结束
+    KILL_TIMEOUT = 0.05
+    # 离块结束不到这么多毫秒时请求的换表在块边界生效
+    SWAP_MARGIN = 20
+    # 换表时至少提前这么多毫秒启动下一块的进程
+    SPAWN_LEAD = 5
+
+    def __init__(self, device=None, program="beep", chunk_size=CHUNK_SIZE):
+        self.device = device
+        self.program = program
+        self.chunk_size = chunk_size
+        self.process = None
+        self._pending = None
+        self._cursor = None
+        self._stop_event = threading.Event()
+        # 换表或停止时唤醒播放线程
+        self._wake = threading.Event()
+        # 上次播放第一个 beep 进程启动的时间 (time.monotonic_ns())
+        self.first_tone_ns = None
+
+    def play(self, table, start=0, stop=None, on_swap=None):
+        """播放音符表的第 start 到 stop 个音符，播放结束后返回
+
+        播放中可以用 swap() 换用新的音符表，在正在播放的音符结束时生效：
+        按新表从换算后的下标提前启动下一个进程，到时结束当前进程并放行它，
+        生效时以 (音符表, 下标, 结束下标, 距开始的毫秒数) 调用 on_swap。
+        """
+        cursor = self._cursor = PlayCursor(table, start, stop)
+
+        def next_chunk():
+            with REGISTRY.span("argv"):
+                return self._next_chunk(cursor)
+
+        try:
+            self._play_chunks(next_chunk, cursor, on_swap)
+        finally:
+            self._cursor = None
+
+    def swap(self, table):
+        """播放中换用新的音符表"""
+        cursor = self._cursor
+        if cursor is not None:
+            cursor.swap(table)
+            self._wake.set()
+
+    def _play_chunks(self, next_chunk, cursor, on_swap=None):
+        """逐块播放，next_chunk() 返回 _next_chunk() 生成的块或 None"""
+        stop_event = self._stop_event
+        self._wake.clear()
+        self.first_tone_ns = None
+        chunk = next_chunk()
+        if chunk is None or stop_event.is_set():
+            return
+        at = 0.0
+        with REGISTRY.span("spawn"):
+            process = self.process = subprocess.Popen(chunk[0])
+        # beep 进程启动后立即发声，以此近似第一个音的时间
+        self.first_tone_ns = chunk_ns = time.monotonic_ns()
+        try:
+            while True:
+                if on_swap and chunk[2]:
+                    table, index, stop, offset = chunk[2]
+                    on_swap(table, index, stop, at + offset)
+                following = next_chunk()
+                pending = self._pending = (
+                    self._spawn_gated(following[0]) if following else None)
+                played = chunk[1]
+                cut = self._wait_for_swap(
+                    chunk, chunk_ns, cursor,
+                    following is not None and following[2] is not None)
+                if cut is not None:
+                    # 换表：下一块从截断处按新表重新生成并提前启动，
+                    # 到当前音符结束时结束当前进程、放行下一块
+                    state, played, deadline_ns = cut
+                    if pending is not None:
+                        self._discard(pending)
+                    cursor.restore(state)
+                    following = next_chunk()
+                    pending = self._pending = (
+                        self._spawn_gated(following[0]) if following else None)
+                    timeout = (deadline_ns - time.monotonic_ns()) / 1e9
+                    if timeout <= 0 or not stop_event.wait(timeout):
+                        process.terminate()
+                if stop_event.is_set():
+                    process.terminate()
+                process.wait()
+                at += played
+                if stop_event.is_set():
+                    break
+                if cursor.swap_pending():
+                    # 块快结束时才请求的换表：下一块是按旧音符表生成的，
+                    # 回到它的开头按新表重新生成
+                    if pending is not None:
+                        self._discard(pending)
+                        pending = self._pending = None
+                        cursor.restore(following[3])
+                    following = next_chunk()
+                    if following is None:
+                        break
+                    with REGISTRY.span("spawn"):
+                        process = self.process = subprocess.Popen(following[0])
+                elif pending is None:
+                    break
+                else:
+                    # 放行已就绪的下一块
+                    pending.stdin.write(b"\n")
+                    pending.stdin.close()
+                    process = self.process = pending
+                    self._pending = None
+                chunk_ns = time.monotonic_ns()
+                chunk = following
+        finally:
+            if self._pending is not None:
+                self._discard(self._pending)
+                self._pending = None
+
+    def _wait_for_swap(self, chunk, chunk_ns, cursor, requested=False):
+        """在当前块播放期间等待换表请求，找出截断的位置
+
+        没有请求、被停止或离块结束不到 SWAP_MARGIN 毫秒时返回 None（换表在
+        块边界生效），否则返回 (截断后的播放位置, 当前块已播放的毫秒数,
+        截断的时刻)。截断在当前音符结束处；离现在不到 SPAWN_LEAD 毫秒时顺延
+        到下一个音符，留出启动下一块进程的时间。
+        """
+        span = chunk[4]
+        if span is None:
+            return None
+        self._wake.clear()
+        end_ns = chunk_ns + round(chunk[1] * 1e6)
+        if not requested and not cursor.swap_pending():
+            timeout = (end_ns - time.monotonic_ns()) / 1e9 - self.SWAP_MARGIN / 1000
+            if timeout <= 0 or not self._wake.wait(timeout):
+                return None
+            if not cursor.swap_pending():
+                return None
+        if self._stop_event.is_set():
+            return None
+        table, first, last, stop = span
+        onsets = table.onsets()
+        begin = onsets[first]
+        now_ms = (time.monotonic_ns() - chunk_ns) / 1e6
+        i = table.index_at_time(begin + now_ms)
+        while True:
+            following = i + max(1, table.voices[i])
+            if following >= last:
+                return None
+            played = table.end_ms(i) - begin
+            if played - now_ms >= self.SPAWN_LEAD:
+                break
+            i = following
+        return ((table, following, stop), played,
+                chunk_ns + round(played * 1e6))
+
+    def _next_chunk(self, cursor):
+        """从 cursor 取出下一块音符，生成 (参数, 时长, 换表信息, 块开始位置, 范围)
+
+        范围为 (音符表, 第一个下标, 结束下标, 播放结束下标)，块内换过表时为 None。
+        """
+        begin = cursor.save()
+        args = None
+        total = 0.0
+        swap = None
+        first = None
+        for _ in range(self.chunk_size):
+            i = cursor.next()
+            if cursor.swapped and swap is None:
+                swap = (cursor.table, cursor.index - (i is not None),
+                        cursor.stop, total)
+            if i is None:
+                break
+            table = cursor.table
+            if first is None:
+                first = (table, i)
+            if not table.voices[i]:
+                # 和弦的其余音已随首音加入
+                continue
+            if args is None:
+                args = [self.program]
+            else:
+                args.append("-n")
+            chord = table.chord(i)
+            if chord and table.degree[i] != -1:
+                args.extend(chord_args(chord, table.delay[i],
+                                       table.duration[i]))
+            else:
+                args.extend(note_args(table.degree[i], table.freq[i],
+                                      table.delay[i], table.duration[i]))
+            total += table.delay[i] + table.duration[i]
+        if args is None:
+            return None
+        table, index, stop = cursor.save()
+        span = (table, first[1], index, stop) if table is first[0] else None
+        return args, total, swap, begin, span
+
+    def _spawn_gated(self, args):
+        """启动一个等待 stdin 放行后才 exec beep 的进程"""
+        with REGISTRY.span("spawn"):
+            return subprocess.Popen(
+                ["sh", "-c", 'read _ && exec "$@"', "sh"] + args,
+                stdin=subprocess.PIPE
+            )
+
+    @staticmethod
+    def _discard(process):
+        """丢弃尚未放行的进程"""
+        process.stdin.close()
+        process.wait()
+
+    def reset(self):
+        """清除停止标志，准备下一次播放
+
+        停止标志在播放开始前就可以设置，play() 会立即返回，不会漏掉停止请求。
+        """
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        """停止播放，进程在 KILL_TIMEOUT 内没有退出时强制结束"""
+        self._stop_event.set()
+        self._wake.set()
+        process = self.process
+        if process and process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(self.KILL_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    def live_processes(self):
+        """仍在运行的 beep 进程"""
+        return [process for process in (self.process, self._pending)
+                if process is not None and process.poll() is None]
+
+    def timing_stats(self):
+        """beep 自行计时，没有定时统计"""
+        return None
+
+
+class EvdevBackend:
+    """直接向 pcspkr 输入设备写入 EV_SND 事件
+
+    设备可以是任何可写的文件或 FIFO，便于在没有扬声器的机器上检查事件流。
+    """
+
+    def __init__(self, device=DEFAULT_DEVICE):
+        self.device = device
+        self.scheduler = Scheduler()
+        self._cursor = None
+        self._stop_event = threading.Event()
+        # 上次播放写入第一个音的时间 (time.monotonic_ns())
+        self.first_tone_ns = None
+
+    def play(self, table, start=0, stop=None, on_swap=None):
+        """播放音符表的第 start 到 stop 个音符，播放结束或被停止后返回
+
+        播放中可以用 swap() 换用新的音符表，在下一个音符边界生效，
+        生效时以 (音符表, 下标, 结束下标, 距开始的毫秒数) 调用 on_swap。
+        """
+        stop_event = self._stop_event
+        scheduler = self.scheduler
+        cursor = self._cursor = PlayCursor(table, start, stop)
+        self.first_tone_ns = None
+        with REGISTRY.span("open_device"):
+            fd = os.open(self.device, os.O_WRONLY)
+        try:
+            silence = tone_event(0)
+            # 按累计时间计算每个事件的绝对时刻，避免误差累积
+            at = 0.0
+            scheduler.start()
+            while not scheduler.wait_until(round(at * 1e6), stop_event):
+                i = cursor.next()
+                if i is None:
+                    break
+                table = cursor.table
+                if cursor.swapped and on_swap:
+                    on_swap(table, i, cursor.stop, at)
+                voices = table.voices[i]
+                if not voices:
+                    # 和弦的其余音已随首音播放
+                    continue
+                if table.degree[i] != -1:
+                    begin = at
+                    at += table.duration[i]
+                    if voices > 1:
+                        stopped = self._play_chord(
+                            fd, chord_events(table.chord(i)), begin, at,
+                            stop_event)
+                    else:
+                        os.write(fd, tone_event(table.freq[i]))
+                        if self.first_tone_ns is None:
+                            self.first_tone_ns = time.monotonic_ns()
+                        stopped = scheduler.wait_until(
+                            round(at * 1e6), stop_event)
+                    os.write(fd, silence)
+                    if stopped:
+                        break
+                    at += table.delay[i]
+                else:
+                    # 休止符
+                    at += table.duration[i] + table.delay[i]
+        finally:
+            self._cursor = None
+            os.close(fd)
+
+    def _play_chord(self, fd, events, begin, end, stop_event):
+        """在 begin 到 end (ms) 之间循环写入和弦各音的事件，被停止时返回 True
+
+        切换间隔只有几毫秒，睡眠的唤醒误差与之相当，因此和弦期间全程忙等；
+        每次切换都按绝对时刻等待，切换时刻的偏差计入定时统计。
+        """
+        spin_until = self.scheduler.spin_until
+        count = len(events)
+        step = ARPEGGIO_INTERVAL
+        k = 0
+        at = begin
+        while at < end:
+            os.write(fd, events[k])
+            if self.first_tone_ns is None:
+                self.first_tone_ns = time.monotonic_ns()
+            k = k + 1 if k + 1 < count else 0
+            at = min(at + step, end)
+            if spin_until(round(at * 1e6), stop_event):
+                return True
+        return False
+
+    def swap(self, table):
+        """播放中换用新的音符表"""
+        cursor = self._cursor
+        if cursor is not None:
+            cursor.swap(table)
+
+    def timing_stats(self):
+        """上次播放的定时统计"""
+        return self.scheduler.stats()
+
+    def reset(self):
+        """清除停止标志，准备下一次播放"""
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        """停止播放"""
+        self._stop_event.set()
+
+    def live_processes(self):
+        """不启动子进程"""
+        return []
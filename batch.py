@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from score import (KEY_OFFSETS, Arrangement, NoteTable, compile_tokens,
+                   iter_line_tokens, iter_notes)
+
+
+# 每个文件最多列出的错误数
+MAX_ERRORS = 20
+
+
+def expand_paths(patterns):
+    """展开文件名、通配符和目录（目录取其中所有 .txt）"""
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "**", "*.txt")
+        matches = sorted(glob.glob(pattern, recursive=True))
+        paths.extend(matches if matches else [pattern])
+    return paths
+
+
+def process_file(path, key_offset, bpm, render_dir=None, raw=False):
+    """检查单个曲谱文件，可选渲染为音频，返回结果字典"""
+    start = time.perf_counter()
+    result = {"file": path}
+    try:
+        errors = []
+        default_duration = 60000 / bpm
+        line_key, line_bpm = key_offset, bpm
+        table = NoteTable()
+        with open(path, encoding="utf-8") as file:
+            for line_num, line in enumerate(file, 1):
+                checked = len(table.invalid)
+                table, line_key, line_bpm = compile_tokens(
+                    iter_line_tokens(line, line_num), line_key, line_bpm,
+                    default_duration, table
+                )
+                for _, col_start, col_end, reason in table.invalid[checked:]:
+                    if len(errors) < MAX_ERRORS:
+                        errors.append({
+                            "line": line_num,
+                            "column": col_start + 1,
+                            "token": line[col_start:col_end],
+                            "reason": reason,
+                        })
+
+        # 按演奏顺序统计，重复和宏逐个展开计数，不整体展开
+        arrangement = Arrangement(table)
+        notes = 0
+        total_ms = 0.0
+        delay, duration = table.delay, table.duration
+        for i in arrangement:
+            notes += 1
+            total_ms += delay[i] + duration[i]
+        for line_num, col_start, _, token, reason in arrangement.errors:
+            if len(errors) < MAX_ERRORS:
+                errors.append({"line": line_num, "column": col_start + 1,
+                               "token": token, "reason": reason})
+        invalid = len(table.invalid) + len(arrangement.errors)
+        result.update({
+            "valid": invalid == 0,
+            "source_notes": len(table),
+            "notes": notes,
+            "invalid": invalid,
+            "duration_s": round(total_ms / 1000, 3),
+            "errors": errors,
+        })
+
+        if render_dir is not None:
+            # 延迟导入，只检查时不需要
+            from render import render
+
+            name = os.path.splitext(os.path.basename(path))[0]
+            output = os.path.join(render_dir, name + (".pcm" if raw else ".wav"))
+            with open(path, encoding="utf-8") as file:
+                render(iter_notes(file, key_offset, bpm), output, raw=raw)
+            result["output"] = output
+    except (OSError, UnicodeDecodeError) as e:
+        result.update({"valid": False, "error": str(e)})
+    result["elapsed_s"] = round(time.perf_counter() - start, 4)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="批量检查曲谱文件，可选渲染为音频，结果按行输出 JSON")
+    parser.add_argument("paths", nargs="+", help="曲谱文件、通配符或目录")
+    parser.add_argument("--bpm", type=int, default=200)
+    parser.add_argument("--key", default="C", choices=list(KEY_OFFSETS))
+    parser.add_argument("--render", metavar="DIR",
+                        help="同时渲染到该目录下的 WAV 文件")
+    parser.add_argument("--raw", action="store_true", help="渲染为裸 PCM")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="进程数，默认为 CPU 数")
+    args = parser.parse_args()
+
+    paths = expand_paths(args.paths)
+    if args.render:
+        os.makedirs(args.render, exist_ok=True)
+
+    start = time.perf_counter()
+    files = notes = failed = 0
+    with ProcessPoolExecutor(args.jobs) as pool:
+        futures = [
+            pool.submit(process_file, path, KEY_OFFSETS[args.key], args.bpm,
+                        args.render, args.raw)
+            for path in paths
+        ]
+        for future in futures:
+            result = future.result()
+            print(json.dumps(result, ensure_ascii=False), flush=True)
+            files += 1
+            notes += result.get("notes", 0)
+            failed += not result["valid"]
+    elapsed = time.perf_counter() - start
+
+    print(f"共 {files} 个文件，{notes} 个音符，{failed} 个有错误，"
+          f"用时 {elapsed:.2f} 秒（{files / elapsed if elapsed else 0:.1f} 文件/秒，"
+          f"{notes / elapsed if elapsed else 0:.0f} 音符/秒）", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
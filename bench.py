@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""解析器、调度器和播放后端的基准测试
+
+不需要扬声器：beep 后端调用临时生成的假 beep（只按需睡眠的 shell 脚本），
+evdev 后端写入临时文件。曲谱由固定种子随机生成，覆盖 parse_note 接受的
+所有参数形式以及和弦、结构记号和注释，结果可以复现。
+
+测量的指标（名称以 _per_s 结尾的越大越好，其余越小越好）：
+    parse.<音符数>.tokens_per_s       编译整个曲谱（解析缓存清空后）
+    parse_note.tokens_per_s           不经缓存直接调用 parse_note
+    argv.<音符数>.us_per_note         生成 beep 命令行参数
+    events.<音符数>.us_per_note       EvdevBackend 生成并写出事件（不等待）
+    <后端>.time_to_first_tone_ms      从调用 play() 到第一个音
+    <后端>.stop_latency_ms            从调用 stop() 到 play() 返回
+    evdev.jitter_p50_ms / p99_ms      evdev 播放的定时迟到
+    evdev.drift_ms                    evdev 播放结束时的累计漂移
+
+结果以 JSON 输出；给出 --baseline 时与之比较，超过阈值的退步会列出，
+退出码为 1。用 --save-baseline 保存本次结果作为以后比较的基准。
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from fnmatch import fnmatch
+
+from backends import BeepBackend, EvdevBackend, PlayCursor, chord_events
+from scheduler import Scheduler
+from score import (KEY_OFFSETS, compile_score, iter_tokens, parse_note,
+                   resolve_note)
+
+
+SIZES = (1000, 10000, 100000, 1000000)
+SEED = 20240601
+NOTES_PER_LINE = 8
+# 默认的退步阈值（相对变化）
+THRESHOLD = 0.25
+# 以毫秒计的指标变化不超过此值时不算退步，避免亚毫秒级的噪声误报
+MIN_DELTA_MS = 1.0
+# 曲谱很大时减少重复次数：重复次数不超过 REPEAT_BUDGET / 音符数
+REPEAT_BUDGET = 1000000
+
+# parse_note 接受的参数形式：延时,持续时间,调性,bpm 的各种组合，
+# 每项可以是毫秒或倍数
+FORMS = (
+    "{p}",
+    "{p}({d},{l},{k},{b})",
+    "{p}({d},{l},{k})",
+    "{p}({d},{l})",
+    "{p}({l},{k},{b})",
+    "{p}({l},{k})",
+    "{p}({l})",
+    "{p}(,{l})",
+    "[{p} {q} {r}]({l})",
+)
+PITCHES = ("1", "2", "3", "4", "5", "6", "7", "+1", "+3", "+5", "-5", "-6",
+           "-7", "0")
+KEYS = ("C", "D", "Eb", "F", "G", "A", "Bb")
+BPMS = ("120", "160", "200", "240")
+
+# 假 beep：按环境变量 BENCH_BEEP_SLEEP 睡眠若干秒后退出
+FAKE_BEEP = '#!/bin/sh\nexec sleep "${BENCH_BEEP_SLEEP:-0}"\n'
+
+
+def _length(rng, factor_max):
+    """毫秒或倍数表示的时值"""
+    if rng.random() < 0.5:
+        return str(rng.choice((50, 100, 150, 200, 300)))
+    return "*" + str(rng.choice((0.25, 0.5, 1, 1.5, 2)[:factor_max]))
+
+
+def synthetic_score(notes, seed=SEED):
+    """生成约 notes 个音符的曲谱文本，每 NOTES_PER_LINE 个音符一行"""
+    rng = random.Random(seed)
+    lines = []
+    line = []
+    for n in range(notes):
+        form = rng.choice(FORMS)
+        line.append(form.format(
+            p=rng.choice(PITCHES), q=rng.choice(PITCHES[:7]),
+            r=rng.choice(PITCHES[:7]),
+            d=rng.choice(("0", "*0", "50", "*0.5")), l=_length(rng, 5),
+            k=rng.choice(KEYS), b=rng.choice(BPMS)))
+        if len(line) == NOTES_PER_LINE:
+            if rng.random() < 0.1:
+                line.append("#注释")
+            lines.append(" ".join(line))
+            line = []
+            if len(lines) % 64 == 0:
+                # 偶尔出现的反复和注释行
+                lines.append("# 段落")
+                lines.append("|: 1 2 3 :|")
+    if line:
+        lines.append(" ".join(line))
+    return "\n".join(lines)
+
+
+def _median(func, repeat):
+    """重复调用 func() 返回的测量值取中位数"""
+    return statistics.median(func() for _ in range(repeat))
+
+
+def bench_parse(text, repeat):
+    """编译整个曲谱的速度（音符/秒），每次都先清空解析缓存
+
+    返回 (速度, 编译出的音符表)。
+    """
+    tokens = sum(1 for _ in iter_tokens(text))
+    tables = []
+
+    def once():
+        resolve_note.cache_clear()
+        begin = time.perf_counter()
+        tables[:] = [compile_score(text, KEY_OFFSETS["C"], 200)]
+        return tokens / (time.perf_counter() - begin)
+    return _median(once, repeat), tables[0]
+
+
+def bench_parse_note(text, repeat, count=100000):
+    """不经缓存直接调用 parse_note 的速度（音符/秒）"""
+    tokens = [token for *_, token in iter_tokens(text)
+              if not token.startswith(("[", "|", ":"))][:count]
+
+    def once():
+        begin = time.perf_counter()
+        for token in tokens:
+            parse_note(token, 300.0, 300.0, 0, 200)
+        return len(tokens) / (time.perf_counter() - begin)
+    return _median(once, repeat)
+
+
+def bench_argv(table, repeat):
+    """生成 beep 命令行参数的耗时（微秒/音符）"""
+    backend = BeepBackend(program="beep")
+
+    def once():
+        cursor = PlayCursor(table)
+        begin = time.perf_counter()
+        while backend._next_chunk(cursor) is not None:
+            pass
+        return (time.perf_counter() - begin) * 1e6 / len(table)
+    return _median(once, repeat)
+
+
+class CatchUpScheduler(Scheduler):
+    """零点设在足够久之前的调度器：所有截止时间都已到达，等待立即返回
+
+    等待和统计的代码照常执行，只是不睡眠，用于测量播放后端本身的开销。
+    """
+
+    def __init__(self, behind_ms):
+        super().__init__()
+        self.behind_ns = round(behind_ms * 1e6) + 1_000_000_000
+
+    def start(self, start_ns=None):
+        super().start(time.monotonic_ns() - self.behind_ns)
+
+
+def bench_events(table, repeat, device=os.devnull):
+    """EvdevBackend 播放整个曲谱、生成并写出事件的耗时（微秒/音符）
+
+    写入 device（默认 /dev/null），调度器不等待，因此与曲谱时长无关。
+    """
+    backend = EvdevBackend(device)
+    backend.scheduler = CatchUpScheduler(table.total_ms())
+
+    def once():
+        chord_events.cache_clear()
+        backend.reset()
+        begin = time.perf_counter()
+        backend.play(table)
+        return (time.perf_counter() - begin) * 1e6 / len(table)
+    return _median(once, repeat)
+
+
+def _time_to_first_tone(backend, table):
+    backend.reset()
+    requested = time.monotonic_ns()
+    backend.play(table)
+    return (backend.first_tone_ns - requested) / 1e6
+
+
+def _stop_latency(backend, table, after=0.1):
+    """播放 after 秒后停止，返回从 stop() 到 play() 返回的毫秒数"""
+    backend.reset()
+    thread = threading.Thread(target=backend.play, args=(table,))
+    thread.start()
+    time.sleep(after)
+    begin = time.monotonic_ns()
+    backend.stop()
+    thread.join()
+    return (time.monotonic_ns() - begin) / 1e6
+
+
+def bench_beep(workdir, repeat):
+    """用假 beep 测量 beep 后端的首音时间和停止延迟"""
+    program = os.path.join(workdir, "beep")
+    with open(program, "w") as file:
+        file.write(FAKE_BEEP)
+    os.chmod(program, 0o755)
+    backend = BeepBackend(program=program)
+    short = compile_score("1", 0, 200)
+    long = compile_score(" ".join(["1(*0,*4)"] * 600), 0, 200)
+    results = {
+        "beep.time_to_first_tone_ms": _median(
+            lambda: _time_to_first_tone(backend, short), repeat),
+    }
+    os.environ["BENCH_BEEP_SLEEP"] = "10"
+    try:
+        results["beep.stop_latency_ms"] = _median(
+            lambda: _stop_latency(backend, long), repeat)
+    finally:
+        del os.environ["BENCH_BEEP_SLEEP"]
+    leaked = backend.live_processes()
+    for process in leaked:
+        process.kill()
+        process.wait()
+    results["beep.leaked_processes"] = len(leaked)
+    return results
+
+
+def bench_evdev(workdir, repeat, notes=200, bpm=4000):
+    """向临时文件写事件，测量 evdev 后端的首音时间、停止延迟和定时抖动"""
+    device = os.path.join(workdir, "pcspkr")
+    open(device, "wb").close()
+    backend = EvdevBackend(device)
+    short = compile_score("1", 0, 200)
+    long = compile_score(" ".join(["1(*0,*4)"] * 600), 0, 200)
+    results = {
+        "evdev.time_to_first_tone_ms": _median(
+            lambda: _time_to_first_tone(backend, short), repeat),
+        "evdev.stop_latency_ms": _median(
+            lambda: _stop_latency(backend, long), repeat),
+    }
+    # 短音符和和弦交替，共约 notes * 60000 / bpm 毫秒
+    table = compile_score(" ".join(["1 3 [1 3 5] 0"] * (notes // 4)), 0, bpm)
+    backend.reset()
+    backend.play(table)
+    stats = backend.timing_stats()
+    results["evdev.jitter_p50_ms"] = stats["p50_ms"]
+    results["evdev.jitter_p99_ms"] = stats["p99_ms"]
+    results["evdev.drift_ms"] = abs(stats["drift_ms"])
+    return results
+
+
+def run(sizes, repeat, playback=True):
+    """运行全部基准，返回 {指标: 数值}"""
+    results = {}
+    for size in sizes:
+        text = synthetic_score(size)
+        times = max(1, min(repeat, REPEAT_BUDGET // size))
+        results[f"parse.{size}.tokens_per_s"], table = bench_parse(text, times)
+        results[f"argv.{size}.us_per_note"] = bench_argv(table, times)
+        results[f"events.{size}.us_per_note"] = bench_events(table, times)
+        print(f"{size} 个音符完成", file=sys.stderr)
+    results["parse_note.tokens_per_s"] = bench_parse_note(
+        synthetic_score(min(max(sizes), 100000)), repeat)
+    if playback:
+        workdir = tempfile.mkdtemp(prefix="pcspkr-bench-")
+        try:
+            results.update(bench_beep(workdir, repeat))
+            results.update(bench_evdev(workdir, repeat))
+        finally:
+            shutil.rmtree(workdir)
+    return results
+
+
+def compare(results, baseline, threshold, overrides=(),
+            min_delta_ms=MIN_DELTA_MS):
+    """与基准比较，返回退步列表 [(指标, 基准值, 本次值, 变化, 阈值)]
+
+    overrides 为 [(通配符, 阈值)]，后给出的优先；以毫秒计的指标
+    变化不超过 min_delta_ms 时不算退步。
+    """
+    regressions = []
+    for name, value in results.items():
+        base = baseline.get(name)
+        if base is None or not isinstance(value, (int, float)):
+            continue
+        limit = threshold
+        for pattern, pattern_limit in overrides:
+            if fnmatch(name, pattern):
+                limit = pattern_limit
+        if base == 0:
+            # 基准为 0 的计数（如遗留进程）：出现即为退步
+            if value > 0 and not name.endswith("_per_s"):
+                regressions.append((name, base, value, float("inf"), limit))
+            continue
+        change = (value - base) / base
+        worse = -change if name.endswith("_per_s") else change
+        if name.endswith("_ms") and value - base <= min_delta_ms:
+            continue
+        if worse > limit:
+            regressions.append((name, base, value, change, limit))
+    return regressions
+
+
+def _override(text):
+    pattern, sep, value = text.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"应写成 通配符=阈值: {text}")
+    return pattern, float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="解析器、调度器和播放后端的基准测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES),
+                        help="合成曲谱的音符数")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="每项重复次数，取中位数（曲谱很大时自动减少）")
+    parser.add_argument("--no-playback", action="store_true",
+                        help="不测量需要实时播放的指标")
+    parser.add_argument("-o", "--output", help="结果 JSON 文件，默认输出到标准输出")
+    parser.add_argument("--baseline", help="与此基准 JSON 比较")
+    parser.add_argument("--save-baseline", metavar="PATH",
+                        help="把本次结果保存为基准")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="退步阈值（相对变化，默认 0.25）")
+    parser.add_argument("--threshold-for", type=_override, action="append",
+                        default=[], metavar="通配符=阈值",
+                        help="单独指定某些指标的阈值，可重复")
+    parser.add_argument("--min-delta-ms", type=float, default=MIN_DELTA_MS,
+                        help="以毫秒计的指标变化不超过此值时不算退步（默认 1）")
+    args = parser.parse_args()
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed": SEED,
+            "sizes": args.sizes,
+            "repeat": args.repeat,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": run(args.sizes, args.repeat, not args.no_playback),
+    }
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(report["results"], baseline, args.threshold,
+                              args.threshold_for, args.min_delta_ms)
+        report["regressions"] = [
+            {"metric": name, "baseline": base, "value": value,
+             "change": change, "threshold": limit}
+            for name, base, value, change, limit in regressions]
+        for name, base, value, change, limit in regressions:
+            print(f"退步 {name}: {base:.4g} -> {value:.4g} "
+                  f"({change:+.1%}，阈值 {limit:.0%})", file=sys.stderr)
+        if regressions:
+            status = 1
+        else:
+            print("没有超过阈值的退步", file=sys.stderr)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text)
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as file:
+            file.write(text)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
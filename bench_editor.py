@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""编辑器操作的延迟基准
+
+文档从 10 行增长到 10 万行，测量快速插入音符 (insert_note) 和按行范围
+取出音符的耗时，二者都应与文档长度无关。作为对照，同时测量取出整个
+文本的耗时（插入前旧的判空方式）。每个长度输出一行 JSON，时间单位为微秒。
+
+需要图形显示，没有显示时可以用 xvfb-run python3 bench_editor.py。
+"""
+
+import argparse
+import json
+import sys
+import time
+import tkinter as tk
+
+from main import MusicEditor
+from scheduler import percentile
+from score import iter_range_tokens
+
+
+SIZES = (10, 100, 1000, 10000, 100000)
+LINE = "1 2 3(*0,*1) +5(*0,*2) -6 [1 3 5](*2) #注释"
+# 按行范围取音符时每次取的行数
+RANGE_LINES = 50
+
+
+def summary(samples):
+    samples = sorted(samples)
+    return {
+        "p50_us": percentile(samples, 50) / 1000,
+        "p99_us": percentile(samples, 99) / 1000,
+        "max_us": samples[-1] / 1000,
+    }
+
+
+def bench(root, app, lines, repeat):
+    """在 lines 行的文档中间测量各操作 repeat 次"""
+    text = app.score_text
+    text.delete("1.0", tk.END)
+    text.insert("1.0", "\n".join([LINE] * lines))
+    root.update()
+    middle = max(1, lines // 2)
+    clock = time.perf_counter_ns
+
+    inserts = []
+    for _ in range(repeat):
+        text.mark_set(tk.INSERT, f"{middle}.end")
+        begin = clock()
+        app.insert_note("5", True)
+        inserts.append(clock() - begin)
+        root.update_idletasks()
+
+    tokens = []
+    first = max(1, middle - RANGE_LINES // 2)
+    last = min(lines, first + RANGE_LINES - 1)
+    for _ in range(repeat):
+        begin = clock()
+        for _ in iter_range_tokens(app.get_lines, first, last):
+            pass
+        tokens.append(clock() - begin)
+
+    full_text = []
+    for _ in range(min(repeat, 20)):
+        begin = clock()
+        text.get("1.0", tk.END).strip()
+        full_text.append(clock() - begin)
+
+    return {
+        "lines": lines,
+        "insert_note": summary(inserts),
+        "range_tokens": summary(tokens),
+        "full_text_get": summary(full_text),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="编辑器操作的延迟基准")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES),
+                        help="文档行数")
+    parser.add_argument("--repeat", type=int, default=200,
+                        help="每个长度重复的次数")
+    args = parser.parse_args()
+
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        print(f"无法创建窗口: {e}", file=sys.stderr)
+        return 1
+    app = MusicEditor(root)
+    try:
+        for lines in args.sizes:
+            print(json.dumps(bench(root, app, lines, args.repeat)), flush=True)
+    finally:
+        app.worker.close()
+        root.destroy()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,62 +1,101 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import re
+import argparse
 import sys
 
-def validate_line(line, line_num):
-    """验证单行格式并计算总和"""
-    # 正则表达式匹配 x(*y,*z) 格式
-    pattern = r'([+-]?\d+(?:\.\d+)?)\(\*([+-]?\d+(?:\.\d+)?),\*([+-]?\d+(?:\.\d+)?)\)'
-    matches = re.findall(pattern, line)
-    
-    # 检查格式错误
-    if "(*" in line and not matches:
-        return f"Line {line_num}: Format error - '{line.strip()}' contains parentheses but invalid syntax"
-    
-    # 计算总和
-    total_y = 0.0
-    total_z = 0.0
-    for x, y, z in matches:
-        try:
-            total_y += float(y)
-            total_z += float(z)
-        except ValueError:
-            return f"Line {line_num}: Format error - '{line.strip()}' contains non-numeric values"
-    
-    # 检查总和是否为4（考虑浮点精度）
-    total = total_y + total_z
-    if not (3.999 < total < 4.001):  # 允许0.001的误差
-        return f"Line {line_num}: Sum error - {total:.3f} ≠ 4 in '{line.strip()}'"
-    
-    return None
-
-def main(filename):
-    """主函数：处理文件并验证每行"""
-    results = []
+from score import (KEY_OFFSETS, Arrangement, check_note, compile_tokens,
+                   iter_line_tokens)
+
+
+def validate_line(line, line_num, key_offset, bpm, default_duration,
+                  beats_per_bar):
+    """验证单行格式并计算拍数，返回 (错误列表, 本行的音符表, 调性偏移, bpm)
+
+    每行为一小节。拍数按每个音符生效时的 bpm 换算，行内改变 bpm 也能正确计算；
+    beats_per_bar 为 None 时不检查拍数，只有结构记号（反复、宏）的行也不检查。
+    """
+    tokens = list(iter_line_tokens(line, line_num))
+    table, key_offset, bpm = compile_tokens(
+        tokens, key_offset, bpm, default_duration)
+
+    # 无法解析的音符和和弦，以及其余音符中会被静默忽略的问题，按列排序
+    problems = [(start, line[start:end], reason)
+                for _, start, end, reason in table.invalid]
+    for _, start, _, note in tokens:
+        if any(first <= start < last for _, first, last, _ in table.invalid):
+            continue
+        error = check_note(note)
+        if error:
+            problems.append((start, note, error))
+    errors = [f"Line {line_num}, column {start + 1}: Format error - '{note}': {error}"
+              for start, note, error in sorted(problems)]
+
+    if beats_per_bar is not None and (len(table) or not table.marks):
+        # 计算总拍数
+        total = 0.0
+        for i in range(len(table)):
+            total += (table.delay[i] + table.duration[i]) * table.bpm[i] / 60000
+        # 允许0.001的误差
+        if abs(total - beats_per_bar) >= 0.001:
+            errors.append(
+                f"Line {line_num}: Sum error - {total:.3f} ≠ {beats_per_bar:g} in '{line.strip()}'")
+
+    return errors, table, key_offset, bpm
+
+
+def main(filename, beats_per_bar=4, bpm=200, key="C"):
+    """主函数：逐行处理文件并验证每行"""
+    key_offset = KEY_OFFSETS[key]
+    default_duration = 60000 / bpm
+    error_count = 0
+
+    def report(error):
+        nonlocal error_count
+        if not error_count:
+            print("Validation errors found:")
+        print(error)
+        error_count += 1
+
+    # 反复和宏跨行：逐行收集结构记号（不保留音符），读完后检查一次
+    marks = []
+    count = 0
     with open(filename, 'r', encoding='utf-8') as file:
         for line_num, line in enumerate(file, 1):
-            line = line.strip()
+            stripped = line.strip()
             # 跳过空行和注释行
-            if not line or line.startswith('#') or line.startswith('//'):
+            if not stripped or stripped.startswith('#') or stripped.startswith('//'):
                 continue
             # 验证行格式
-            error = validate_line(line, line_num)
-            if error:
-                results.append(error)
-    
-    # 输出结果
-    if results:
-        print("Validation errors found:")
-        for error in results:
-            print(error)
+            errors, table, key_offset, bpm = validate_line(
+                line, line_num, key_offset, bpm, default_duration, beats_per_bar)
+            marks.extend((count + index, *rest) for index, *rest in table.marks)
+            count += len(table)
+            # 输出结果
+            for error in errors:
+                report(error)
+
+    arrangement = Arrangement.from_marks(marks, count)
+    for line_num, start, _, token, reason in arrangement.errors:
+        report(f"Line {line_num}, column {start + 1}: Structure error - '{token}': {reason}")
+
+    if error_count:
         sys.exit(1)
+    elif beats_per_bar is None:
+        print("All lines are valid")
     else:
-        print("All lines are valid and sum to 4")
-        sys.exit(0)
+        print(f"All lines are valid and sum to {beats_per_bar:g}")
+    sys.exit(0)
+
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print(f"Usage: {sys.argv[0]} <filename.txt>")
-        sys.exit(1)
-    main(sys.argv[1])
+    parser = argparse.ArgumentParser(description="检查曲谱格式和每小节拍数")
+    parser.add_argument("filename")
+    parser.add_argument("-b", "--beats", type=float, default=4,
+                        help="每小节（每行）拍数，默认 4")
+    parser.add_argument("--no-beats", action="store_true", help="不检查拍数")
+    parser.add_argument("--bpm", type=int, default=200, help="初始 bpm")
+    parser.add_argument("--key", default="C", choices=list(KEY_OFFSETS),
+                        help="初始调性")
+    args = parser.parse_args()
+    main(args.filename, None if args.no_beats else args.beats, args.bpm, args.key)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""不依赖图形界面的核心：解析、频率计算和播放
+
+导入时不加载 tkinter，也没有任何副作用（不检查平台、不调整优先级），
+可以在工作进程和命令行工具中直接使用。播放后端在第一次创建时才导入。
+"""
+
+import importlib
+import sys
+import time
+
+from metrics import REGISTRY
+from score import (KEY_OFFSETS, NOTE_FREQUENCIES, LineCache, NoteTable,
+                   cache_stats, calculate_frequency, compile_score,
+                   expand_table, parse_note)
+from worker import PlaybackWorker
+
+__all__ = [
+    "KEY_OFFSETS", "NOTE_FREQUENCIES", "LineCache", "NoteTable",
+    "cache_stats", "calculate_frequency", "compile_score", "expand_table",
+    "parse_note", "PlaybackWorker", "BACKEND_NAMES", "backend_class",
+    "create_backend", "BeepPlayer", "REGISTRY",
+]
+
+# 播放后端名称 -> (模块, 类名)
+BACKEND_MODULES = {
+    "beep": ("backends", "BeepBackend"),
+    "evdev": ("backends", "EvdevBackend"),
+}
+BACKEND_NAMES = tuple(BACKEND_MODULES)
+
+
+def backend_class(name):
+    """按名称取得播放后端类，第一次使用时才导入所在模块"""
+    try:
+        module, attr = BACKEND_MODULES[name]
+    except KeyError:
+        raise ValueError(f"未知的播放后端: {name}") from None
+    return getattr(importlib.import_module(module), attr)
+
+
+def create_backend(name, device=None):
+    """按名称创建播放后端，device 为 None 时使用后端的默认设备"""
+    cls = backend_class(name)
+    return cls() if device is None else cls(device)
+
+
+class BeepPlayer:
+    def __init__(self, device=None, backend="beep"):
+        self.device = device
+        self.backend_name = backend
+        self.backend = create_backend(backend, device)
+        # self.playing = False
+
+    def set_backend(self, name):
+        """切换播放后端"""
+        if name not in BACKEND_MODULES:
+            raise ValueError(f"未知的播放后端: {name}")
+        if name != self.backend_name:
+            self.stop()
+            self.backend = create_backend(name, self.device)
+            self.backend_name = name
+
+    def play_table(self, table, on_start=None, start=0, stop=None,
+                   on_error=None, on_swap=None):
+        """播放音符表的第 start 到 stop 个音符
+
+        开始时以 time.monotonic_ns() 调用 on_start，出错时以异常调用 on_error，
+        换用新音符表时调用 on_swap。回调都在播放线程中执行。
+        """
+        if not len(table):
+            return
+
+        try:
+            # self.playing = True
+            if on_start:
+                on_start(time.monotonic_ns())
+            with REGISTRY.span("playback"):
+                self.backend.play(table, start, stop, on_swap)
+            stats = self.backend.timing_stats()
+            if stats:
+                REGISTRY.set("timing", stats)
+
+        except Exception as e:
+            if on_error:
+                on_error(e)
+            else:
+                print('播放失败:', e, file=sys.stderr)
+
+    def stop(self):
+        """停止播放"""
+        self.backend.stop()
+        # self.playing = False
+
+    parse_note = staticmethod(parse_note)
+    calculate_frequency = staticmethod(calculate_frequency)
@@ -1,46 +1,24 @@
 #!/usr/bin/env python3
 
+"""曲谱编辑器的图形界面，解析和播放都在 core 中"""
+
 import tkinter as tk
-from tkinter import ttk, messagebox, scrolledtext
-import subprocess
-import threading
-import re
+from tkinter import ttk, messagebox, scrolledtext, filedialog, simpledialog
 import time
 import os
+import json
 import platform
 import sys
-from threading import Timer
-
-
-def debounce(wait_time):
-    """防抖装饰器"""
-    def decorator(func):
-        def debounced(*args, **kwargs):
-            # 如果已有定时器，则取消
-            if hasattr(debounced, "_timer"):
-                debounced._timer.cancel()
-
-            # 设置新的定时器
-            debounced._timer = Timer(wait_time, func, args=args, kwargs=kwargs)
-            debounced._timer.start()
-
-        return debounced
-    return decorator
-
+import queue
+import threading
+from bisect import bisect_right
 
-# 音符频率映射表 (C调基准)
-NOTE_FREQUENCIES = {
-    -1: [130.81, 146.83, 164.81, 174.61, 196.00, 220.00, 246.94],  # 低音
-    0: [261.63, 293.66, 329.63, 349.23, 392.00, 440.00, 493.88],   # 中音
-    1: [523.25, 587.33, 659.25, 698.46, 783.99, 880.00, 987.77]    # 高音
-}
+from core import (BACKEND_NAMES, KEY_OFFSETS, REGISTRY, BeepPlayer,
+                  LineCache, PlaybackWorker, cache_stats, expand_table)
+from score import HIGHLIGHT_TAGS, highlight_spans
+from scorefile import cache_path, load_score, text_digest, write_table
+from transform import scale_tempo, to_factors, to_milliseconds, transpose
 
-# 调性偏移映射 (半音数)
-KEY_OFFSETS = {
-    "C": 0, "C♯": 1, "Db": 1, "D": 2, "D♯": 3, "Eb": 3,
-    "E": 4, "F": 5, "F♯": 6, "Gb": 6, "G": 7, "G♯": 8,
-    "Ab": 8, "A": 9, "A♯": 10, "Bb": 10, "B": 11
-}
 
 MULTIPLE = {
     "0.125": 0.125,
@@ -65,197 +43,413 @@ MULTIPLE = {
 }
 
 
-class BeepPlayer:
-    def __init__(self, device):
-        self.device = device
-        self.process = None
-        # self.playing = False
-
-    def play_notes(self, notes, default_duration, default_delay, key_offset, bpm):
-        """播放音符序列"""
+class TimerService:
+    """基于 root.after 的定时服务
+
+    每个键同时只有一个待执行的回调，重复安排会合并；所有回调都在 Tk 主线程执行。
+    其他线程通过 post() 投递回调，由主线程定期取出执行。
+    """
+
+    POLL_INTERVAL = 30  # 毫秒
+
+    def __init__(self, widget):
+        self.widget = widget
+        # 键 -> [after id, 回调, 参数]
+        self._pending = {}
+        self._posted = queue.SimpleQueue()
+        self.widget.after(self.POLL_INTERVAL, self._poll)
+
+    def schedule(self, key, delay, func, *args, restart=True):
+        """delay 毫秒后执行 func(*args)
+
+        同一个键已有待执行的回调时：restart 为 True 则重新计时（防抖），
+        否则保留原来的时间，只替换回调和参数（节流）。
+        """
+        entry = self._pending.get(key)
+        if entry is not None:
+            if not restart:
+                entry[1:] = [func, args]
+                return
+            self.widget.after_cancel(entry[0])
+        entry = [None, func, args]
+        entry[0] = self.widget.after(delay, self._run, key, entry)
+        self._pending[key] = entry
+
+    def cancel(self, key):
+        """取消键对应的回调"""
+        entry = self._pending.pop(key, None)
+        if entry is not None:
+            self.widget.after_cancel(entry[0])
+
+    def pending(self, key):
+        """键是否有待执行的回调"""
+        return key in self._pending
+
+    def post(self, func, *args):
+        """从任意线程投递一个回调，在主线程中尽快执行"""
+        self._posted.put((func, args))
+
+    def _run(self, key, entry):
+        if self._pending.get(key) is entry:
+            del self._pending[key]
+        entry[1](*entry[2])
+
+    def _poll(self):
+        while True:
+            try:
+                func, args = self._posted.get_nowait()
+            except queue.Empty:
+                break
+            func(*args)
+        self.widget.after(self.POLL_INTERVAL, self._poll)
+
+
+class Playhead:
+    """播放时高亮当前音符
+
+    音符的开始时间和位置都在编译时算好，定时回调只需二分查找当前音符并移动标签。
+    """
+
+    INTERVAL = 15  # 毫秒
+
+    def __init__(self, text, tag, timers):
+        self.text = text
+        self.tag = tag
+        self.timers = timers
+        self.table = None
+        self.onsets = None
+        self.offset_ms = 0
+        self.end_ms = 0
+        self.start_ns = None
+        self.index = -1
+        self._span = None
+
+    def start(self, table, start=0, stop=None):
+        """准备跟随 table 第 start 到 stop 个音符的播放，真正的开始时间由 started() 给出"""
         self.stop()
-        if not notes:
+        self.table = table
+        self.onsets = table.onsets()
+        self.offset_ms = self.onsets[start]
+        self.end_ms = table.end_ms((len(table) if stop is None else stop) - 1)
+        self.start_ns = None
+        self.timers.schedule("playhead", self.INTERVAL, self.tick)
+
+    def started(self, start_ns):
+        """播放线程开始发声时调用"""
+        self.start_ns = start_ns
+
+    def rebase(self, table, index, stop, at_ms):
+        """播放在开始后 at_ms 毫秒处换用了 table，从第 index 个音符继续"""
+        if self.table is None:
             return
-
-        try:
-            # args = ["beep", "--device", self.device]
-            args = ["beep"]
-
-            for i, note in enumerate(notes):
-                # 解析音符参数
-                pitch, delay, duration, key_offset, bpm = self.parse_note(
-                    note, default_duration, default_delay, key_offset, bpm
-                )
-
-                # 计算频率（考虑调性偏移）
-                freq = self.calculate_frequency(pitch, key_offset)
-                if freq is None:
-                    continue
-
-                # 添加音符参数
-                    # 添加新音符标记
-                if i > 0:
-                    args.append("-n")
-                if pitch[1] != -1:
-                    args.extend(["-f", str(freq), "-l", str(duration)])
-                    if delay > 0:
-                        args.extend(["-D", str(delay)])
-                else:
-                    args.extend(["-f", "1", "-l", str(duration + delay)])
-
-            # self.playing = True
-            self.process = subprocess.Popen(args)
-            start = time.time()
-            self.process.wait()
-            print('已结束，用时', time.time() - start)
-
-        except Exception as e:
-            messagebox.showerror("播放错误", f"播放失败: {str(e)}")
+        self.table = table
+        self.onsets = table.onsets()
+        self.offset_ms = self.onsets[index] - at_ms
+        self.end_ms = table.end_ms(stop - 1) if stop else 0
+        if self._span:
+            self.text.tag_remove(self.tag, *self._span)
+            self._span = None
+        self.index = -1
+
+    def tick(self):
+        """定时移动高亮"""
+        start_ns = self.start_ns
+        if start_ns is not None:
+            elapsed = (time.monotonic_ns() - start_ns) / 1e6 + self.offset_ms
+            if elapsed >= self.end_ms:
+                self.stop()
+                return
+            index = bisect_right(self.onsets, elapsed) - 1
+            if index != self.index:
+                self.index = index
+                table = self.table
+                line = table.line[index]
+                if self._span:
+                    self.text.tag_remove(self.tag, *self._span)
+                self._span = (f"{line}.{table.start[index]}",
+                              f"{line}.{table.end[index]}")
+                self.text.tag_add(self.tag, *self._span)
+        self.timers.schedule("playhead", self.INTERVAL, self.tick)
 
     def stop(self):
-        """停止播放"""
-        if self.process:
-            self.process.terminate()
-            # self.playing = False
-
-    def parse_note(self, note_str, default_duration, default_delay, key_offset, bpm):
-        """解析音符字符串"""
-        # 默认值
-        pitch = 0
-        duration = default_duration
-        delay = default_delay
-        offset = key_offset
-
-        # 解析音高部分
-        pitch_match = re.match(r"([+-]?)(\d+)", note_str)
-        if pitch_match:
-            sign = pitch_match.group(1)
-            note_num = int(pitch_match.group(2))
-
-            # 确定八度
-            if sign == "-":
-                pitch = (-1, note_num - 1)
-            elif sign == "+":
-                pitch = (1, note_num - 1)
-            else:
-                pitch = (0, note_num - 1)
-
-        # 解析参数部分
-        params_match = re.search(r"\(([^)]*)\)", note_str)
-        if params_match:
-            params = params_match.group(1).split(",")
-
-            # 1 s/n   s/n      str    num
-            # 1 delay duration offset bpm
-            # 2 delay duration offset
-            # 3 delay duration
-            # 4 duration offset bpm
-            # 5 duration offset
-            # 6 duration
-            # 7
-
-            # 解析第四/三个参数（bpm），对后面 note 均生效 #1,2,4
-            if len(params) > 2 and params[-1].strip():
-                try:
-                    # 1,4
-                    bpm = int(params[-1])
-                except ValueError:
-                    pass
-            default_delay = default_duration = 60000 / bpm
-
-            # 解析第一个参数（假定为延时，可能为持续时间） #1,2,3
-            if params[0].strip():
-                try:
-                    # 支持倍数表示法 (如 *1.5)
-                    if params[0].strip().startswith("*"):
-                        factor = float(params[0].strip()[1:])
-                        delay = float(default_delay * factor)
-                    else:
-                        delay = float(params[0].strip())
-                except ValueError:
-                    pass
-            else:
-                delay = 0
-
-            # 解析第二/一个参数（持续时间）
-            i = 1
-            #  1,2,3,4,5
-            if len(params) > 1:
-                if params[1].strip().startswith("*"):  # 123
-                    i = 1
-                else:
-                    try:
-                        # 123
-                        float(params[1].strip())
-                        i = 1
-                    except ValueError:
-                        i = 0
-                        pass
-            else:
-                # 4,5,6
-                i = 0
-            if params[i].strip():
-                try:
-                    # 支持倍数表示法 (如 *1.5)
-                    if params[i].strip().startswith("*"):
-                        factor = float(params[i].strip()[1:])
-                        duration = float(default_duration * factor)
-                    else:
-                        duration = float(params[i].strip())
-                except ValueError:
-                    pass
-            if i == 0:
-                delay = 0
-
-            # 解析第三/二个参数（调），对后面 note 均生效
-            if (len(params) > i + 1) and params[i + 1].strip():
-                try:
-                    offset = KEY_OFFSETS[params[i + 1]]
-                except KeyError:
-                    pass
+        """停止跟随并清除高亮"""
+        self.timers.cancel("playhead")
+        if self._span:
+            self.text.tag_remove(self.tag, *self._span)
+            self._span = None
+        self.index = -1
+        self.table = None
+
+
+class Highlighter:
+    """后台语法高亮
+
+    编辑时只把受影响的行标记为脏；主线程取出可见范围内脏行的文本交给
+    后台线程分析，结果回到主线程后按批打上标签。分析期间又有编辑时
+    丢弃结果重新来过，因此标签总是对应当前文本。
+    """
+
+    DELAY = 50         # 编辑或滚动后多久开始高亮（毫秒）
+    MARGIN = 50        # 可见范围前后额外高亮的行数
+    BATCH_LINES = 200  # 每次回调最多打标签的行数
+
+    TAG_OPTIONS = {
+        "comment": {"foreground": "gray50"},
+        "structure": {"foreground": "purple"},
+        "octave": {"foreground": "blue"},
+        "params": {"foreground": "dark green"},
+        "change": {"foreground": "dark orange"},
+        "invalid": {"underline": True, "foreground": "red"},
+    }
+
+    def __init__(self, text, timers):
+        self.text = text
+        self.timers = timers
+        for tag in HIGHLIGHT_TAGS:
+            text.tag_config(tag, **self.TAG_OPTIONS[tag])
+        text.tag_raise("invalid")
+        # 每行是否已按当前文本高亮
+        self.clean = [False]
+        # 每次编辑加一，分析结果的编号不同时作废
+        self.generation = 0
+        self._busy = False
+        self._requests = queue.SimpleQueue()
+        threading.Thread(
+            target=self._run, name="highlight", daemon=True).start()
+
+    def reset(self, line_count):
+        """把所有行标记为脏"""
+        self.clean = [False] * line_count
+        self.generation += 1
+        self.schedule()
+
+    def splice(self, first, removed, added):
+        """把从 first 行 (从 0 开始) 起的 removed 行替换为 added 个脏行"""
+        self.clean[first:first + removed] = [False] * added
+        self.generation += 1
+        self.schedule()
+
+    def schedule(self):
+        """稍后高亮可见范围内的脏行"""
+        self.timers.schedule("highlight", self.DELAY, self.update)
+
+    def update(self):
+        """取出可见范围内脏行的文本，交给后台线程分析"""
+        if self._busy:
+            # 结果回来后会再次调用
+            return
+        text = self.text
+        count = len(self.clean)
+        top = int(text.index("@0,0").split(".")[0])
+        bottom = int(text.index(f"@0,{text.winfo_height()}").split(".")[0])
+        first = max(1, top - self.MARGIN)
+        last = min(count, bottom + self.MARGIN)
+        # 连续的脏行一次取出
+        runs = []
+        line = first
+        while line <= last:
+            if self.clean[line - 1]:
+                line += 1
+                continue
+            end = line
+            while end < last and not self.clean[end]:
+                end += 1
+            runs.append((line, text.get(f"{line}.0", f"{end}.end").split("\n")))
+            line = end + 1
+        if runs:
+            self._busy = True
+            self._requests.put((self.generation, runs))
+
+    def _run(self):
+        """后台线程：分析各行，结果投递回主线程"""
+        while True:
+            generation, runs = self._requests.get()
+            with REGISTRY.span("highlight"):
+                results = [(first, [highlight_spans(line) for line in lines])
+                           for first, lines in runs]
+            self.timers.post(self._deliver, generation, results)
+
+    def _deliver(self, generation, results):
+        """主线程：按批打上标签"""
+        batches = []
+        for first, spans in results:
+            for k in range(0, len(spans), self.BATCH_LINES):
+                batches.append((first + k, spans[k:k + self.BATCH_LINES]))
+        self._apply(generation, batches, 0)
+
+    def _apply(self, generation, batches, index):
+        if generation != self.generation:
+            # 分析期间文本又改了
+            self._busy = False
+            self.schedule()
+            return
+        first, spans = batches[index]
+        last = first + len(spans) - 1
+        text = self.text
+        ranges = {tag: [] for tag in HIGHLIGHT_TAGS}
+        for line, line_spans in enumerate(spans, first):
+            for tag, start, end in line_spans:
+                ranges[tag].extend((f"{line}.{start}", f"{line}.{end}"))
+        for tag, indices in ranges.items():
+            text.tag_remove(tag, f"{first}.0", f"{last}.end")
+            if indices:
+                text.tag_add(tag, *indices)
+        self.clean[first - 1:last] = [True] * len(spans)
+        if index + 1 < len(batches):
+            self.timers.schedule("highlight_apply", 0, self._apply,
+                                 generation, batches, index + 1)
         else:
-            delay = 0
-            duration = 60000 / bpm
-
-        return pitch, delay, duration, offset, bpm
-
-    def calculate_frequency(self, pitch, key_offset):
-        """计算音符频率（考虑调性偏移）"""
-        if not pitch:
-            return None
-
-        octave, note_index = pitch
-
-        # 检查音符是否有效
-        if octave not in NOTE_FREQUENCIES or note_index < -1 or note_index > 6:
-            return None
+            self._busy = False
+            # 期间可能滚动到了别处
+            self.update()
+
+
+class MetricsPanel:
+    """显示各阶段耗时的小窗口，定时刷新，可导出 JSON、跟踪文件和 cProfile 结果"""
+
+    INTERVAL = 1000  # 毫秒
+
+    def __init__(self, root, timers, worker):
+        self.timers = timers
+        self.worker = worker
+        self.window = tk.Toplevel(root)
+        self.window.title("性能指标")
+        self.window.geometry("480x560")
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+
+        btn_frame = ttk.Frame(self.window, padding=5)
+        btn_frame.pack(fill=tk.X)
+        ttk.Button(btn_frame, text="导出 JSON", command=self.export).pack(
+            side=tk.LEFT)
+        self.trace_button = ttk.Button(
+            btn_frame, text="开始跟踪", command=self.toggle_trace)
+        self.trace_button.pack(side=tk.LEFT, padx=(2, 0))
+        self.profile_button = ttk.Button(
+            btn_frame, text="开始分析", command=self.toggle_profile)
+        self.profile_button.pack(side=tk.LEFT, padx=(2, 0))
+        ttk.Button(btn_frame, text="清零", command=self.reset).pack(
+            side=tk.LEFT, padx=(2, 0))
+
+        self.text = scrolledtext.ScrolledText(
+            self.window, font=("Courier", 10), wrap=tk.NONE)
+        self.text.pack(fill=tk.BOTH, expand=True)
+        self.refresh()
+
+    def snapshot(self):
+        """各阶段耗时、播放线程指标和解析缓存统计"""
+        snapshot = REGISTRY.snapshot()
+        snapshot["worker"] = self.worker.metrics()
+        snapshot["cache"] = cache_stats()
+        return snapshot
+
+    def refresh(self):
+        """定时刷新显示内容，保持滚动位置"""
+        position = self.text.yview()[0]
+        self.text.delete("1.0", tk.END)
+        self.text.insert(
+            "1.0", json.dumps(self.snapshot(), ensure_ascii=False, indent=2))
+        self.text.yview_moveto(position)
+        self.timers.schedule("metrics_panel", self.INTERVAL, self.refresh)
+
+    def export(self):
+        """把当前指标导出为 JSON 文件"""
+        path = filedialog.asksaveasfilename(
+            parent=self.window, defaultextension=".json",
+            filetypes=[("JSON", "*.json")])
+        if not path:
+            return
+        try:
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(self.snapshot(), file, ensure_ascii=False, indent=2)
+        except OSError as e:
+            messagebox.showerror("导出失败", str(e), parent=self.window)
+
+    def toggle_trace(self):
+        """开始跟踪，或停止并写出 Chrome 跟踪格式的文件"""
+        if not REGISTRY.tracing:
+            REGISTRY.start_trace()
+            self.trace_button.config(text="停止跟踪")
+            return
+        self.trace_button.config(text="开始跟踪")
+        path = filedialog.asksaveasfilename(
+            parent=self.window, defaultextension=".json",
+            filetypes=[("跟踪文件", "*.json")])
+        try:
+            if path:
+                REGISTRY.stop_trace(path)
+            else:
+                REGISTRY.stop_trace(os.devnull)
+        except OSError as e:
+            messagebox.showerror("导出失败", str(e), parent=self.window)
+
+    def toggle_profile(self):
+        """开始 cProfile 分析（编译和播放），或停止并写出 .prof 文件"""
+        if not REGISTRY.profiling:
+            REGISTRY.start_profile()
+            self.profile_button.config(text="停止分析")
+            return
+        self.profile_button.config(text="开始分析")
+        path = filedialog.asksaveasfilename(
+            parent=self.window, defaultextension=".prof",
+            filetypes=[("cProfile", "*.prof")])
+        try:
+            if not REGISTRY.stop_profile(path or os.devnull) and path:
+                messagebox.showinfo(
+                    "提示", "分析期间没有编译或播放", parent=self.window)
+        except OSError as e:
+            messagebox.showerror("导出失败", str(e), parent=self.window)
 
-        base_freq = NOTE_FREQUENCIES[octave][note_index]
+    def reset(self):
+        """清空各阶段耗时"""
+        REGISTRY.reset()
+        self.refresh()
 
-        # 应用调性偏移（十二平均律）
-        return base_freq * (2 ** (key_offset / 12))
+    def close(self):
+        self.timers.cancel("metrics_panel")
+        self.window.destroy()
 
 
 class MusicEditor:
+    # 播放中编辑后，停止输入多久（毫秒）再把改动换入
+    HOT_SWAP_DELAY = 300
+
     def __init__(self, root: tk.Tk):
         self.autoPlayVar = tk.BooleanVar(value=False)
         self.root = root
         self.root.title("曲谱编辑器")
         self.root.geometry("1024x768")
 
-        # 创建播放器
-        self.player = BeepPlayer(
-            "/dev/input/by-path/platform-pcspkr-event-spkr")
+        # 所有定时回调都经由主循环执行
+        self.timers = TimerService(self.root)
+
+        # 创建播放器，所有播放都在同一个常驻线程中进行
+        self.player = BeepPlayer()
+        self.worker = PlaybackWorker(self.player, self.on_player_event)
 
         # 默认参数
         self.default_bpm = round(60 * 1000 / 300)
         self.default_duration = 300  # 毫秒
         self.default_delay = 300     # 毫秒
         self.key = "C"               # 调性
+        self.file_path = None        # 当前曲谱文件
 
         # 创建界面
         self.create_widgets()
 
+        # 按行缓存的编译结果，编辑时只重新解析受影响的行
+        self.line_cache = LineCache()
+        self._source_table = self._played_table = None
+        self.highlighter = Highlighter(self.score_text, self.timers)
+        self.hook_text_edits()
+        # 滚动时高亮新露出的行
+        vbar_set = self.score_text.vbar.set
+
+        def on_scroll(*args):
+            vbar_set(*args)
+            self.highlighter.schedule()
+
+        self.score_text.configure(yscrollcommand=on_scroll)
+
         self.root.bind("<FocusOut>", self.on_focus_out)
 
         # # 加载示例曲谱
@@ -264,13 +458,31 @@ class MusicEditor:
         # 高亮标签
         self.highlight_tag = "highlight"
         self.score_text.tag_config(self.highlight_tag, background="yellow")
+        self.playhead = Playhead(
+            self.score_text, self.highlight_tag, self.timers)
 
-    @debounce(0.05)
     def on_focus_out(self, arg):
-        if self.autoPlayVar and self.autoPlayVar.get() and not root.focus_displayof():
-            self.play()
+        # 焦点在窗口内部控件间切换时也会触发，稍后再判断窗口是否真的失焦
+        self.timers.schedule("focus_out", 50, self.auto_play)
+
+    def auto_play(self):
+        """窗口失焦时自动播放，正在播放时只换入改动"""
+        if self.autoPlayVar and self.autoPlayVar.get() and not self.root.focus_displayof():
+            if self.worker.state == "playing":
+                self.hot_swap()
+            else:
+                self.play()
             self.autoPlayVar.set(False)
 
+    def hot_swap(self):
+        """播放中把改动后的曲谱换入，从下一个音符起生效，不中断播放"""
+        self.timers.cancel("hot_swap")
+        if self.worker.state != "playing":
+            return
+        table = self.compile()
+        if table is not None:
+            self.worker.update(table)
+
     def create_widgets(self):
         # 主框架
         main_frame = ttk.Frame(self.root, padding=10)
@@ -283,7 +495,8 @@ class MusicEditor:
         # 曲谱编辑框
         ttk.Label(left_frame, text="曲谱编辑:").pack(anchor=tk.W)
         self.score_text = scrolledtext.ScrolledText(
-            left_frame, width=50, height=25, font=("Courier", 12), wrap=tk.WORD, spacing1=4, spacing2=4, spacing3=4
+            left_frame, width=50, height=25, font=("Courier", 12), wrap=tk.WORD, spacing1=4, spacing2=4, spacing3=4,
+            undo=True
         )
         self.score_text.pack(fill=tk.BOTH, expand=True, pady=5)
 
@@ -325,6 +538,15 @@ class MusicEditor:
         )
         key_combo.grid(row=2, column=1)
 
+        # 播放后端
+        ttk.Label(param_frame, text="输出方式:").grid(
+            row=3, column=0, sticky=tk.W)
+        self.backend_var = tk.StringVar(value="beep")
+        ttk.Combobox(
+            param_frame, textvariable=self.backend_var,
+            values=list(BACKEND_NAMES), width=8, state="readonly"
+        ).grid(row=3, column=1)
+
         # 控制按钮
         btn_frame = ttk.Frame(right_frame)
         btn_frame.pack(fill=tk.X, pady=10)
@@ -333,12 +555,32 @@ class MusicEditor:
             fill=tk.X, pady=2)
         ttk.Button(btn_frame, text="播放选中", command=self.play_selected).pack(
             fill=tk.X, pady=2)
+        ttk.Button(btn_frame, text="从光标播放", command=self.play_from_cursor).pack(
+            fill=tk.X, pady=2)
+        seek_frame = ttk.Frame(btn_frame)
+        seek_frame.pack(fill=tk.X, pady=2)
+        self.seek_var = tk.StringVar(value="0")
+        ttk.Entry(seek_frame, textvariable=self.seek_var, width=6).pack(
+            side=tk.LEFT)
+        ttk.Button(seek_frame, text="从此秒数播放", command=self.play_from_time).pack(
+            side=tk.LEFT, fill=tk.X, expand=True, padx=(2, 0))
+        self.pause_button = ttk.Button(
+            btn_frame, text="暂停", command=self.toggle_pause)
+        self.pause_button.pack(fill=tk.X, pady=2)
         ttk.Button(btn_frame, text="停止", command=self.stop).pack(
             fill=tk.X, pady=2)
+        file_frame = ttk.Frame(btn_frame)
+        file_frame.pack(fill=tk.X, pady=2)
+        ttk.Button(file_frame, text="打开", command=self.open_file).pack(
+            side=tk.LEFT, fill=tk.X, expand=True)
+        ttk.Button(file_frame, text="保存", command=self.save_file).pack(
+            side=tk.LEFT, fill=tk.X, expand=True, padx=(2, 0))
         ttk.Button(btn_frame, text="加载示例", command=self.load_example).pack(
             fill=tk.X, pady=2)
         ttk.Button(btn_frame, text="清除", command=self.clear).pack(
             fill=tk.X, pady=2)
+        ttk.Button(btn_frame, text="性能指标", command=self.show_metrics).pack(
+            fill=tk.X, pady=2)
         checkbutton = ttk.Checkbutton(
             btn_frame,
             text="窗口失焦自动播放",
@@ -437,15 +679,25 @@ class MusicEditor:
         )
         key_combo.grid(row=0, column=1)
 
+        # 整曲变换
+        transform_frame = ttk.LabelFrame(right_frame, text="整曲变换", padding=10)
+        transform_frame.pack(fill=tk.X, pady=5)
+        for k, (label, command) in enumerate((
+                ("移调…", self.transpose_score),
+                ("改变速度…", self.scale_score_tempo),
+                ("时值转为倍数", lambda: self.transform_score(
+                    "时值转为倍数", to_factors)),
+                ("时值转为毫秒", lambda: self.transform_score(
+                    "时值转为毫秒", to_milliseconds)))):
+            ttk.Button(transform_frame, text=label, command=command).grid(
+                row=k // 2, column=k % 2, sticky=tk.EW, padx=1, pady=1)
+
     def insert_note(self, text, add_space=True):
         """插入音符到编辑框"""
-        # 获取当前光标位置
-        cursor_pos = self.score_text.index(tk.INSERT)
-
-        # 如果文本不为空且不是开头，添加空格
-        if add_space and self.score_text.get("1.0", tk.END).strip():
-            # 检查光标前是否有空格
-            prev_char = self.score_text.get(f"{cursor_pos}-1c", cursor_pos)
+        # 光标前是非空白字符时添加空格；此时文本必然不为空，
+        # 因此只需取光标前一个字符，不必取出整个文本
+        if add_space:
+            prev_char = self.score_text.get(f"{tk.INSERT}-1c", tk.INSERT)
             if prev_char and not prev_char.isspace():
                 text = " " + text
 
@@ -476,38 +728,123 @@ class MusicEditor:
         if response:
             self.score_text.delete(1.0, tk.END)
 
-    def get_notes(self, selected_only=False):
-        """从编辑框获取音符列表"""
-        if selected_only:
-            try:
-                # 获取选中文本
-                text = self.score_text.get(tk.SEL_FIRST, tk.SEL_LAST).strip()
-                if not text:
-                    return []
-            except tk.TclError:
-                return []
+    def open_file(self):
+        """打开曲谱文件，二进制缓存有效时不再重新解析"""
+        params = self.read_params()
+        if params is None:
+            return
+        path = filedialog.askopenfilename(
+            filetypes=[("曲谱", "*.txt"), ("所有文件", "*")])
+        if not path:
+            return
+        try:
+            text, table, _ = load_score(path, *params)
+        except (OSError, UnicodeDecodeError) as e:
+            messagebox.showerror("打开失败", str(e))
+            return
+        self.score_text.delete("1.0", tk.END)
+        self.score_text.insert("1.0", text)
+        self.score_text.edit_reset()
+        # 编辑框内容与缓存一致，直接使用缓存的音符表
+        self.line_cache.adopt(table, *params)
+        self.file_path = path
+
+    def save_file(self):
+        """保存曲谱文件，同时更新二进制缓存"""
+        path = self.file_path or filedialog.asksaveasfilename(
+            defaultextension=".txt",
+            filetypes=[("曲谱", "*.txt"), ("所有文件", "*")])
+        if not path:
+            return
+        text = self.score_text.get("1.0", "end-1c")
+        try:
+            with open(path, "w", encoding="utf-8") as file:
+                file.write(text)
+        except OSError as e:
+            messagebox.showerror("保存失败", str(e))
+            return
+        self.file_path = path
+        params = self.read_params()
+        if params is None:
+            return
+        try:
+            self.get_table(*params)
+            write_table(cache_path(path), self._source_table,
+                        text_digest(text), *params)
+        except OSError as e:
+            print(f"无法写入缓存: {e}", file=sys.stderr)
+
+    def get_table(self, key_offset, bpm):
+        """从编辑框获取编译好的整个曲谱的音符表，只重新解析改动过的行
+
+        返回按演奏顺序展开重复和宏的音符表，曲谱没有改动时复用上次的展开结果。
+        """
+        with REGISTRY.span("compile"):
+            source = self.line_cache.compile(self.get_lines, key_offset, bpm)
+            if source is not self._source_table:
+                self._source_table = source
+                with REGISTRY.span("expand"):
+                    self._played_table = expand_table(source)
+                if self._played_table.truncated:
+                    messagebox.showwarning(
+                        "曲谱过长", "展开重复和宏后超过 "
+                        f"{len(self._played_table)} 个音符，之后的部分不演奏")
+        return self._played_table
+
+    def get_lines(self, first, last):
+        """获取第 first 到 last 行的文本列表"""
+        return self.score_text.get(f"{first}.0", f"{last}.end").split("\n")
+
+    def hook_text_edits(self):
+        """拦截编辑框的修改命令，把受影响的行标记为脏"""
+        widget = self.score_text
+        self._text_command = widget._w + "_orig"
+        widget.tk.call("rename", widget._w, self._text_command)
+        widget.tk.createcommand(widget._w, self.on_text_command)
+
+    def on_text_command(self, *args):
+        """编辑框命令代理"""
+        call = self.score_text.tk.call
+        command = self._text_command
+        op = args[0] if args else ""
+
+        def line_of(index):
+            return int(call(command, "index", index).split(".")[0])
+
+        def line_count():
+            return line_of("end-1c")
+
+        if op == "insert":
+            first = last = line_of(args[1])
+        elif op in ("delete", "replace") and len(args) <= 4:
+            first = line_of(args[1])
+            if op == "delete" and len(args) == 2:
+                last = line_of(f"{args[1]}+1c")
+            else:
+                last = line_of(args[2])
+        elif op == "delete" or (op == "edit" and args[1:2] in (("undo",), ("redo",))):
+            # 多段删除、撤销和重做：整体失效
+            result = call((command,) + args)
+            self.line_cache.reset(line_count())
+            self.highlighter.reset(line_count())
+            if self.worker.state == "playing":
+                self.timers.schedule("hot_swap", self.HOT_SWAP_DELAY, self.hot_swap)
+            return result
         else:
-            # 获取全部文本
-            text = self.score_text.get(1.0, tk.END).strip()
-            if not text:
-                return []
-
-        # === 添加的注释处理代码开始 ===
-        # 处理注释：移除所有注释行（以 # 开头的行）
-        lines = text.splitlines()
-        cleaned_lines = []
-        for line in lines:
-            stripped_line = line.strip()
-            # 保留非注释行
-            if stripped_line and not stripped_line.startswith('#'):
-                cleaned_lines.append(stripped_line)
-
-        # 重新组合文本
-        cleaned_text = ' '.join(cleaned_lines)
-        # === 添加的注释处理代码结束 ===
-
-        # 分割音符（支持空格和换行分隔）
-        return re.split(r"\s+", cleaned_text) if cleaned_text else []
+            return call((command,) + args)
+
+        # "end" 位于最后一行之后
+        before = line_count()
+        first, last = min(first, before), min(last, before)
+        result = call((command,) + args)
+        removed = last - first + 1
+        added = max(1, removed + line_count() - before)
+        self.line_cache.splice(first - 1, removed, added)
+        self.highlighter.splice(first - 1, removed, added)
+        if self.worker.state == "playing":
+            # 播放中编辑：停顿片刻后把改动换入
+            self.timers.schedule("hot_swap", self.HOT_SWAP_DELAY, self.hot_swap)
+        return result
 
     def play(self):
         """播放整个曲谱"""
@@ -519,6 +856,127 @@ class MusicEditor:
 
     def play_with_selection(self, selected_only):
         """播放曲谱（可选择仅播放选中部分）"""
+        table = self.compile()
+        if table is None:
+            return
+
+        start, stop = 0, len(table)
+        if selected_only:
+            # 在整个曲谱的音符表中定位选区，前面改变的 bpm 和调性依然生效
+            try:
+                first = self.score_text.index(tk.SEL_FIRST)
+                last = self.score_text.index(tk.SEL_LAST)
+            except tk.TclError:
+                start = stop
+            else:
+                start = table.index_at_position(*map(int, first.split(".")))
+                stop = table.index_at_position(*map(int, last.split(".")))
+            if start >= stop:
+                messagebox.showinfo("提示", "未选中任何内容")
+                return
+        elif not table:
+            messagebox.showinfo("提示", "曲谱为空")
+            return
+
+        self.start_playback(table, start, stop)
+
+    def play_from_cursor(self):
+        """从光标处播放"""
+        table = self.compile()
+        if table is None:
+            return
+        cursor = self.score_text.index(tk.INSERT)
+        start = table.index_at_position(*map(int, cursor.split(".")))
+        if start >= len(table):
+            messagebox.showinfo("提示", "光标后没有音符")
+            return
+        self.start_playback(table, start)
+
+    def play_from_time(self):
+        """从指定时间（秒）处播放"""
+        try:
+            seconds = float(self.seek_var.get())
+        except ValueError:
+            messagebox.showerror("参数错误", "时间必须是数字（秒）")
+            return
+        table = self.compile()
+        if table is None:
+            return
+        if not table or seconds * 1000 >= table.end_ms(len(table) - 1):
+            messagebox.showinfo("提示", "超出曲谱长度")
+            return
+        self.start_playback(table, table.index_at_time(seconds * 1000))
+
+    def compile(self):
+        """读取参数并编译整个曲谱，参数错误时返回 None"""
+        params = self.read_params()
+        if params is None:
+            return None
+        with REGISTRY.profiled():
+            return self.get_table(*params)
+
+    def transpose_score(self):
+        """整曲移调若干半音"""
+        params = self.read_params()
+        if params is None:
+            return
+        semitones = simpledialog.askinteger(
+            "移调", "移调的半音数（可为负）:", parent=self.root)
+        if semitones:
+            self.transform_score("移调", transpose, semitones, params[0])
+
+    def scale_score_tempo(self):
+        """整曲速度乘以一个倍数"""
+        params = self.read_params()
+        if params is None:
+            return
+        factor = simpledialog.askfloat(
+            "改变速度", "速度倍数（如 1.5 为加快一半）:", parent=self.root,
+            minvalue=0.01)
+        if factor and factor != 1:
+            self.transform_score("改变速度", scale_tempo, factor, params[1])
+
+    def transform_score(self, title, transform, *args):
+        """对整个曲谱做一次变换，改动作为一次编辑写回，可以一次撤销"""
+        params = self.read_params()
+        if params is None:
+            return
+        with REGISTRY.span("transform"):
+            self.get_table(*params)
+            try:
+                changes = transform(self._source_table, self.get_lines, *args)
+            except ValueError as e:
+                messagebox.showerror(title, str(e))
+                return
+            self.replace_lines(changes)
+
+    def replace_lines(self, changes):
+        """把 [(行号, 新的行文本)] 写回编辑框，作为一次可撤销的编辑
+
+        连续的行合并为一次替换，从后往前替换，前面的行号不受影响。
+        """
+        if not changes:
+            return
+        runs = []
+        for line_num, text in changes:
+            if runs and runs[-1][1] == line_num - 1:
+                runs[-1][1] = line_num
+                runs[-1][2].append(text)
+            else:
+                runs.append([line_num, line_num, [text]])
+        widget = self.score_text
+        autoseparators = widget.cget("autoseparators")
+        widget.edit_separator()
+        widget.configure(autoseparators=False)
+        try:
+            for first, last, texts in reversed(runs):
+                widget.replace(f"{first}.0", f"{last}.end", "\n".join(texts))
+        finally:
+            widget.edit_separator()
+            widget.configure(autoseparators=autoseparators)
+
+    def read_params(self):
+        """读取参数，返回 (调性偏移, bpm)，参数错误时返回 None"""
         # 获取参数
         try:
             bpm = self.default_bpm = int(self.bpm_var.get())
@@ -526,43 +984,61 @@ class MusicEditor:
             self.key = self.key_var.get()
         except ValueError:
             messagebox.showerror("参数错误", "bpm 必须是整数")
-            return
+            return None
 
         if self.key not in KEY_OFFSETS:
             messagebox.showerror("参数错误", "无效的调性")
-            return
+            return None
 
-        # 获取音符
-        notes = self.get_notes(selected_only)
-        if not notes:
-            if selected_only:
-                messagebox.showinfo("提示", "未选中任何内容")
-            else:
-                messagebox.showinfo("提示", "曲谱为空")
-            return
+        return KEY_OFFSETS[self.key], self.default_bpm
 
-        # 停止当前播放
-        self.stop()
+    def start_playback(self, table, start=0, stop=None):
+        """交给播放线程播放音符表的第 start 到 stop 个音符"""
+        self.worker.play(table, start, stop, self.backend_var.get())
 
-        # 在新线程中播放
-        key_offset = KEY_OFFSETS[self.key]
-        threading.Thread(
-            target=self.player.play_notes,
-            args=(notes, self.default_duration,
-                  self.default_delay, key_offset, self.default_bpm),
-            daemon=True
-        ).start()
+    def toggle_pause(self):
+        """暂停或继续播放"""
+        if self.worker.state == "paused":
+            self.worker.resume()
+        else:
+            self.worker.pause()
+
+    def on_player_event(self, event, info):
+        """播放线程的状态通知，转到主线程处理"""
+        self.timers.post(self.handle_player_event, event, info)
+
+    def handle_player_event(self, event, info):
+        """处理播放状态变化"""
+        if event == "playing":
+            self.playhead.start(info["table"], info["start"], info["stop"])
+            self.playhead.started(info["start_ns"])
+        elif event == "swapped":
+            self.playhead.rebase(
+                info["table"], info["index"], info["stop"], info["at_ms"])
+        else:
+            self.playhead.stop()
+        self.pause_button.config(text="继续" if event == "paused" else "暂停")
+        if event == "error":
+            messagebox.showerror("播放错误", f"播放失败: {str(info['error'])}")
 
     def stop(self):
         """停止播放"""
-        self.player.stop()
-
+        self.worker.stop()
+        self.playhead.stop()
+
+    def show_metrics(self):
+        """打开性能指标面板，已打开时提到前面"""
+        panel = getattr(self, "metrics_panel", None)
+        if panel is not None and panel.window.winfo_exists():
+            panel.window.lift()
+            return
+        self.metrics_panel = MetricsPanel(self.root, self.timers, self.worker)
 
-if platform.system() != 'Linux':
-    print("错误：此脚本仅支持 Linux 系统", file=sys.stderr)
-    sys.exit(1)
 
-if __name__ == "__main__":
+def main():
+    if platform.system() != 'Linux':
+        print("错误：此脚本仅支持 Linux 系统", file=sys.stderr)
+        sys.exit(1)
     try:
         os.system('sudo -n renice -10 ' + str(os.getpid()))
     except:
@@ -570,3 +1046,7 @@ if __name__ == "__main__":
     root = tk.Tk()
     app = MusicEditor(root)
     root.mainloop()
+
+
+if __name__ == "__main__":
+    main()
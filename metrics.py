@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""各阶段耗时的指标登记表
+
+用 span(名称) 包住一段代码即可记录一次耗时；已经测好的耗时用 add() 记录。
+快照可以导出为 JSON；开启跟踪后各次耗时还会按 Chrome 跟踪格式
+(chrome://tracing、Perfetto) 写出；开启分析后在 profiled() 包住的
+代码中运行 cProfile，结果合并写入一个 .prof 文件。
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# json、cProfile、pstats 只在导出或分析时才导入，保持导入本模块的开销很小
+
+from scheduler import percentile
+
+
+class Metrics:
+    """线程安全的指标登记表"""
+
+    # 每项保留最近多少次耗时用于计算百分位数
+    SAMPLES = 1024
+    # 跟踪最多记录的事件数
+    MAX_TRACE_EVENTS = 100000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 名称 -> [次数, 总耗时, 最大耗时, 最近的耗时] (ns)
+        self._spans = {}
+        self._counters = {}
+        # 名称 -> 最近一次记下的值（如后端的定时统计）
+        self._values = {}
+        # 跟踪事件 (名称, 开始 ns, 耗时 ns, 线程)，未开启时为 None
+        self._trace = None
+        # 线程 -> cProfile.Profile，未开启时为 None
+        self._profiles = None
+
+    @contextmanager
+    def span(self, name):
+        """记录 with 块的耗时"""
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter_ns() - start, start)
+
+    def add(self, name, ns, start_ns=None):
+        """记录一次耗时 (ns)"""
+        with self._lock:
+            entry = self._spans.get(name)
+            if entry is None:
+                entry = self._spans[name] = [0, 0, 0, deque(maxlen=self.SAMPLES)]
+            entry[0] += 1
+            entry[1] += ns
+            entry[2] = max(entry[2], ns)
+            entry[3].append(ns)
+            trace = self._trace
+            if (trace is not None and start_ns is not None
+                    and len(trace) < self.MAX_TRACE_EVENTS):
+                trace.append((name, start_ns, ns, threading.get_ident()))
+
+    def count(self, name, n=1):
+        """计数器加 n"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def set(self, name, value):
+        """记下一个可转为 JSON 的值，覆盖之前的值"""
+        with self._lock:
+            self._values[name] = value
+
+    def reset(self):
+        """清空所有指标"""
+        with self._lock:
+            self._spans.clear()
+            self._counters.clear()
+            self._values.clear()
+            if self._trace is not None:
+                self._trace = []
+
+    def snapshot(self):
+        """指标快照，时间单位为毫秒"""
+        with self._lock:
+            spans = {name: (entry[0], entry[1], entry[2], sorted(entry[3]),
+                            entry[3][-1])
+                     for name, entry in self._spans.items()}
+            counters = dict(self._counters)
+            values = dict(self._values)
+        return {
+            "spans": {
+                name: {
+                    "count": count,
+                    "total_ms": total / 1e6,
+                    "mean_ms": total / count / 1e6,
+                    "p50_ms": percentile(samples, 50) / 1e6,
+                    "p99_ms": percentile(samples, 99) / 1e6,
+                    "max_ms": longest / 1e6,
+                    "last_ms": last / 1e6,
+                }
+                for name, (count, total, longest, samples, last)
+                in sorted(spans.items())
+            },
+            "counters": counters,
+            "values": values,
+        }
+
+    def to_json(self):
+        """快照的 JSON 文本"""
+        import json
+        return json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+
+    def dump(self, path):
+        """把快照写入 JSON 文件"""
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(self.to_json())
+
+    # 跟踪
+
+    def start_trace(self):
+        """开始记录跟踪事件"""
+        with self._lock:
+            self._trace = []
+
+    def stop_trace(self, path):
+        """停止跟踪并写出 Chrome 跟踪格式的 JSON 文件，返回事件数"""
+        with self._lock:
+            trace, self._trace = self._trace or [], None
+        events = [
+            {"name": name, "ph": "X", "ts": start / 1000, "dur": ns / 1000,
+             "pid": os.getpid(), "tid": thread}
+            for name, start, ns, thread in trace
+        ]
+        import json
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump({"traceEvents": events}, file, ensure_ascii=False)
+        return len(events)
+
+    @property
+    def tracing(self):
+        return self._trace is not None
+
+    # cProfile
+
+    def start_profile(self):
+        """开始分析，之后 profiled() 包住的代码都会被 cProfile 记录"""
+        with self._lock:
+            self._profiles = {}
+
+    def stop_profile(self, path):
+        """停止分析并把各线程的结果合并写入 path，没有数据时返回 False"""
+        with self._lock:
+            profiles, self._profiles = self._profiles or {}, None
+        profiles = [profile for profile in profiles.values()
+                    if profile.getstats()]
+        if not profiles:
+            return False
+        import pstats
+        pstats.Stats(*profiles).dump_stats(path)
+        return True
+
+    @property
+    def profiling(self):
+        return self._profiles is not None
+
+    @contextmanager
+    def profiled(self):
+        """分析开启时用 cProfile 记录 with 块（cProfile 只作用于当前线程）"""
+        profiles = self._profiles
+        if profiles is None:
+            yield
+            return
+        import cProfile
+        thread = threading.get_ident()
+        profile = profiles.get(thread)
+        if profile is None:
+            profile = profiles[thread] = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # 同一线程中嵌套：外层已在记录
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+
+
+# 全局登记表
+REGISTRY = Metrics()
+span = REGISTRY.span
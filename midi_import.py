@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""把标准 MIDI 文件 (SMF) 导入为曲谱
+
+文件用 mmap 映射，每个音轨由一个生成器逐个解码事件，再按时间归并，
+整个转换只读一遍文件，内存占用与文件大小无关。从所有音符中取最高音
+（或只取指定通道）得到单声部旋律，按调号或前若干个音符推断调性，
+写成 `+n`/`n`/`-n(延时,持续时间,调性,bpm)` 记法，每小节一行。
+"""
+
+import argparse
+import heapq
+import mmap
+import struct
+import sys
+import time
+from functools import lru_cache
+
+from score import KEY_NAMES, KEY_OFFSETS
+
+
+# 大调音阶中各音级相对主音的半音数
+MAJOR_STEPS = (0, 2, 4, 5, 7, 9, 11)
+STEP_DEGREES = {step: degree for degree, step in enumerate(MAJOR_STEPS)}
+# 中音 1 (C 调) 对应的 MIDI 音高
+MIDDLE_C = 60
+
+# 没有调号时，按前多少个音符推断调性
+KEY_WINDOW = 64
+# 打击乐通道 (10 号通道)，取最高音时跳过
+DRUM_CHANNEL = 9
+DEFAULT_TEMPO = 500000  # 微秒/四分音符
+
+
+class MidiError(Exception):
+    """MIDI 文件格式错误"""
+
+
+def _read_varlen(data, pos):
+    """读取可变长度数值，返回 (数值, 新位置)"""
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, pos
+
+
+def iter_track(data, start, end, track):
+    """逐个产出音轨中的事件 (tick, 音轨, 序号, 类型, 通道, 参数1, 参数2)
+
+    类型为 "on"/"off"/"tempo"/"time"/"key"，其余事件跳过。
+    """
+    pos = start
+    tick = 0
+    status = None
+    seq = 0
+    while pos < end:
+        # 大多数时间差只有一个字节
+        delta = data[pos]
+        if delta & 0x80:
+            delta, pos = _read_varlen(data, pos)
+        else:
+            pos += 1
+        tick += delta
+        byte = data[pos]
+        if byte & 0x80:
+            pos += 1
+            if byte < 0xF0:
+                status = byte
+        elif status is None:
+            raise MidiError(f"音轨 {track} 缺少状态字节")
+        else:
+            byte = status
+
+        if byte == 0xFF:
+            meta = data[pos]
+            length, pos = _read_varlen(data, pos + 1)
+            if meta == 0x51 and length == 3:
+                yield (tick, track, seq, "tempo", 0,
+                       int.from_bytes(data[pos:pos + 3], "big"), 0)
+            elif meta == 0x58 and length >= 2:
+                yield tick, track, seq, "time", 0, data[pos], data[pos + 1]
+            elif meta == 0x59 and length == 2:
+                sharps = struct.unpack("b", data[pos:pos + 1])[0]
+                yield tick, track, seq, "key", 0, sharps, data[pos + 1]
+            elif meta == 0x2F:
+                return
+            pos += length
+        elif byte in (0xF0, 0xF7):
+            length, pos = _read_varlen(data, pos)
+            pos += length
+        else:
+            kind = byte & 0xF0
+            channel = byte & 0x0F
+            if kind in (0xC0, 0xD0):
+                pos += 1
+                continue
+            note, velocity = data[pos], data[pos + 1]
+            pos += 2
+            if kind == 0x90 and velocity:
+                yield tick, track, seq, "on", channel, note, velocity
+            elif kind in (0x80, 0x90):
+                yield tick, track, seq, "off", channel, note, 0
+            else:
+                continue
+        seq += 1
+
+
+def iter_events(data):
+    """解析文件头，按时间归并所有音轨，返回 (每四分音符 tick 数, 事件迭代器)
+
+    division 为负（SMPTE 时间）时返回 (每秒 tick 数的相反数, 事件迭代器)。
+    """
+    if data[:4] != b"MThd":
+        raise MidiError("不是标准 MIDI 文件")
+    length, _, count, division = struct.unpack(">IHHh", data[4:14])
+    if division < 0:
+        division = -(-(division >> 8) * (division & 0xFF))
+    pos = 8 + length
+    tracks = []
+    while pos + 8 <= len(data) and len(tracks) < count:
+        kind, length = struct.unpack(">4sI", data[pos:pos + 8])
+        start = pos + 8
+        pos = start + length
+        if kind == b"MTrk":
+            tracks.append(iter_track(data, start, min(pos, len(data)),
+                                     len(tracks)))
+    return division, heapq.merge(*tracks)
+
+
+def key_from_signature(sharps):
+    """调号（升降号数）对应的调性偏移，小调与关系大调相同"""
+    return sharps * 7 % 12
+
+
+def guess_key(histogram):
+    """按音级出现次数选出包含最多音符的大调"""
+    return max(range(12), key=lambda key: (
+        sum(histogram[(key + step) % 12] for step in MAJOR_STEPS), -key))
+
+
+def spell(pitch, key):
+    """MIDI 音高在 key 调中的 (八度, 音级)，超出音域的按八度折回，不在音阶中时返回 None"""
+    relative = pitch - MIDDLE_C - key
+    while relative < -12:
+        relative += 12
+    while relative >= 24:
+        relative -= 12
+    octave, step = divmod(relative, 12)
+    degree = STEP_DEGREES.get(step)
+    return None if degree is None else (octave, degree)
+
+
+@lru_cache(maxsize=None)
+def spell_chromatic(pitch, key):
+    """返回 (八度, 音级, 调性偏移)，音阶外的音改用最近的能表示它的调"""
+    for distance in range(12):
+        for candidate in (key - distance, key + distance):
+            if 0 <= candidate < 12:
+                spelled = spell(pitch, candidate)
+                if spelled is not None:
+                    return spelled + (candidate,)
+    raise ValueError(pitch)
+
+
+class ScoreWriter:
+    """把旋律音符写成曲谱文本
+
+    音符通过 note() 依次给出 (音高, 开始毫秒, 结束毫秒, 小节号)，延时
+    （音符后的静音）要等到下一个音符开始才知道，因此总是晚写一个音符。
+    毫秒按累计时间取整，长曲子不会累积误差。
+    """
+
+    def __init__(self, out, bpm=None, key=None):
+        self.out = out
+        self.bpm = bpm
+        self.key = key
+        # 调性由调用方指定时，忽略文件中的调号（同 bpm）
+        self.fixed_key = key is not None
+        # 实际写出的调性（为表示音阶外的音可能临时改变）
+        self.written_key = None
+        self.notes = 0
+        self._pending = None
+        self._buffer = []
+        self._histogram = [0] * 12
+        self._line = []
+        self._bar = None
+        self._position = 0  # 已写出的时间 (ms，取整后)
+
+    def set_bpm(self, bpm):
+        if self.bpm is None:
+            self.bpm = bpm
+
+    def set_key(self, key):
+        """调号改变，之后的音符按新调书写；调性已指定时忽略"""
+        if self.fixed_key:
+            return
+        if self.key is None:
+            self.key = key
+            self._drain()
+        else:
+            self.key = key
+
+    def note(self, pitch, start, end, bar):
+        if self.key is None:
+            # 调性未定：先缓冲，数量有上限
+            self._buffer.append((pitch, start, end, bar))
+            self._histogram[pitch % 12] += 1
+            if len(self._buffer) >= KEY_WINDOW:
+                self.key = guess_key(self._histogram)
+                self._drain()
+            return
+        self._feed(pitch, start, end, bar)
+
+    def close(self):
+        """写出剩余的音符"""
+        if self.key is None:
+            self.key = guess_key(self._histogram)
+            self._drain()
+        if self._pending is not None:
+            pitch, start, end, bar = self._pending
+            self._write(pitch, start, end, end, bar)
+            self._pending = None
+        self._flush_line()
+
+    def _drain(self):
+        buffered, self._buffer = self._buffer, []
+        for entry in buffered:
+            self._feed(*entry)
+
+    def _feed(self, pitch, start, end, bar):
+        if self._pending is not None:
+            previous = self._pending
+            self._write(previous[0], previous[1], previous[2], start,
+                        previous[3])
+        self._pending = (pitch, start, end, bar)
+
+    def _write(self, pitch, start, end, following, bar):
+        start, end, following = round(start), round(end), round(following)
+        if end <= start:
+            # 太短的音并入静音
+            return
+        if start > self._position:
+            # 第一个音符之前的静音写成休止符
+            self._token(bar, "0", [str(start - self._position)])
+        octave, degree, key = spell_chromatic(pitch, self.key)
+        params = [str(following - end), str(end - start)]
+        if key != self.written_key or not self.notes:
+            params.append(KEY_NAMES[key])
+            if not self.notes and self.bpm:
+                params.append(str(self.bpm))
+            self.written_key = key
+        elif params[0] == "0":
+            params = params[1:]
+        prefix = "-" if octave < 0 else "+" if octave > 0 else ""
+        self._token(bar, f"{prefix}{degree + 1}", params)
+        self._position = following
+        self.notes += 1
+
+    def _token(self, bar, name, params):
+        if bar != self._bar:
+            self._flush_line()
+            self._bar = bar
+        self._line.append(f"{name}({','.join(params)})")
+
+    def _flush_line(self):
+        if self._line:
+            self.out.write(" ".join(self._line) + "\n")
+            self._line = []
+
+
+def convert(data, out, channel=None, key=None, bpm=None):
+    """把映射的 MIDI 数据转换为曲谱写入 out，返回 (事件数, 音符数)
+
+    channel 为 None 时取所有通道（打击乐通道除外）中的最高音。
+    """
+    division, events = iter_events(data)
+    writer = ScoreWriter(out, bpm, key)
+    # 速度换算：上次速度变化处的 tick 和毫秒
+    tempo = DEFAULT_TEMPO
+    base_tick = 0
+    base_ms = 0.0
+    # 小节：上次拍号变化处的 tick、小节号和每小节 tick 数
+    bar_tick = 0
+    bar_base = 0
+    bar_length = 4 * abs(division) if division > 0 else None
+
+    # 每个音高正在发声的音符数
+    sounding = [0] * 128
+    top = -1
+    melody = None  # 当前旋律音 (音高, 开始毫秒, 小节号)
+    tick = 0
+    count = 0
+
+    def ms_at(at):
+        if division < 0:
+            return at * 1000 / -division
+        return base_ms + (at - base_tick) * tempo / 1000 / division
+
+    def bar_at(at):
+        if bar_length is None:
+            return 0
+        return bar_base + (at - bar_tick) // bar_length
+
+    def settle(at):
+        # 一个 tick 的事件处理完后，旋律音可能改变
+        nonlocal melody
+        current = melody[0] if melody else -1
+        if top == current:
+            return
+        now = ms_at(at)
+        if melody is not None:
+            writer.note(melody[0], melody[1], now, melody[2])
+        melody = (top, now, bar_at(at)) if top >= 0 else None
+
+    for event in events:
+        count += 1
+        at, _, _, kind, event_channel, a, b = event
+        if at != tick:
+            settle(tick)
+            tick = at
+        if kind == "on" or kind == "off":
+            if channel is None:
+                if event_channel == DRUM_CHANNEL:
+                    continue
+            elif event_channel != channel:
+                continue
+            if kind == "on":
+                sounding[a] += 1
+                top = max(top, a)
+            elif sounding[a]:
+                sounding[a] -= 1
+                while top >= 0 and not sounding[top]:
+                    top -= 1
+        elif kind == "tempo":
+            if division > 0:
+                base_ms = ms_at(at)
+                base_tick = at
+            tempo = a
+            writer.set_bpm(round(60000000 / tempo))
+        elif kind == "time":
+            if division > 0:
+                # 拍号在小节中间改变时从下一小节算起
+                bars, remainder = divmod(at - bar_tick, bar_length)
+                bar_base += bars + (remainder > 0)
+                bar_tick = at
+                bar_length = max(1, a * 4 * division // (2 ** b))
+        elif kind == "key":
+            writer.set_key(key_from_signature(a))
+    settle(tick)
+    if melody is not None:
+        writer.note(melody[0], melody[1], ms_at(tick), melody[2])
+    writer.close()
+    return count, writer.notes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="把标准 MIDI 文件导入为曲谱（单声部）")
+    parser.add_argument("midi", help="MIDI 文件")
+    parser.add_argument("-o", "--output", help="输出曲谱文件，默认输出到标准输出")
+    parser.add_argument("--channel", type=int, choices=range(1, 17),
+                        metavar="1-16", help="只取该通道，默认取所有通道中的最高音")
+    parser.add_argument("--key", choices=list(KEY_OFFSETS),
+                        help="指定调性，默认按调号或音符推断")
+    parser.add_argument("--bpm", type=int, help="写入曲谱的 bpm，默认按 MIDI 速度")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    out = (open(args.output, "w", encoding="utf-8") if args.output
+           else sys.stdout)
+    try:
+        with open(args.midi, "rb") as file, \
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            out.write(f"# 由 {args.midi} 导入\n")
+            events, notes = convert(
+                data, out,
+                None if args.channel is None else args.channel - 1,
+                None if args.key is None else KEY_OFFSETS[args.key],
+                args.bpm)
+    except (OSError, ValueError, IndexError, MidiError) as e:
+        print(f"导入失败: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.perf_counter() - start
+    print(f"共 {events} 个事件，写出 {notes} 个音符，用时 {elapsed:.2f} 秒"
+          f"（{events / elapsed if elapsed else 0:.0f} 事件/秒）", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""多声部曲谱：每个声部输出到各自的设备，在同一条时间线上同步播放
+
+声部以单独一行的 `>> 名称 设备路径` 开始，到下一个声部开始为止；
+第一个声部之前的内容属于名为 main 的声部。设备可以是 pcspkr 输入设备
+或 FIFO，只打开已存在的路径；写成 `file:路径` 时输出到普通文件（创建或
+清空，写入同样的 input_event 事件流），便于测试。
+
+所有声部的事件按时间归并后在一个线程中依次写出，截止时间都从同一个
+起点算出，声部之间不会随曲子变长而错开。同一时刻的事件实际写出时间的
+差即为声部间的偏差 (skew)。
+"""
+
+import argparse
+import heapq
+import json
+import os
+import re
+import sys
+import threading
+import time
+from array import array
+
+from backends import DEFAULT_DEVICE, chord_events, tone_event
+from scheduler import Scheduler, percentile
+from score import (ARPEGGIO_INTERVAL, KEY_OFFSETS, NoteTable, compile_tokens,
+                   expand_table, iter_line_tokens)
+
+
+PART_HEADER = re.compile(r"^\s*>>\s*(\S+)(?:\s+(\S+))?\s*$")
+DEFAULT_PART = "main"
+# 时间线零点设在打开设备之后多久 (ms)，让第一批事件也能准时写出
+START_DELAY = 50
+# 设备写成 file:路径 时输出到普通文件
+FILE_PREFIX = "file:"
+
+
+class Part:
+    """一个声部"""
+
+    def __init__(self, name, device=None):
+        self.name = name
+        self.device = device
+        # (行号, 文本)，行号为在整个文件中的行号
+        self.lines = []
+        self.table = None
+
+    def compile(self, key_offset, bpm):
+        """编译本声部，行号保持为整个文件中的行号"""
+        default_duration = 60000 / bpm
+        table = NoteTable()
+        for line_num, line in self.lines:
+            table, key_offset, bpm = compile_tokens(
+                iter_line_tokens(line, line_num), key_offset, bpm,
+                default_duration, table)
+        self.table = expand_table(table)
+        return self.table
+
+
+def split_parts(lines):
+    """按声部标题行把行的可迭代对象分成声部列表"""
+    parts = [Part(DEFAULT_PART)]
+    for line_num, line in enumerate(lines, 1):
+        match = PART_HEADER.match(line)
+        if match:
+            parts.append(Part(match.group(1), match.group(2)))
+        else:
+            parts[-1].lines.append((line_num, line))
+    # 没有内容的默认声部不播放
+    if len(parts) > 1 and not any(line.strip() for _, line in parts[0].lines):
+        parts.pop(0)
+    return parts
+
+
+def open_output(path):
+    """打开声部的输出，返回文件描述符
+
+    设备路径只以 O_WRONLY 打开，不存在时报错，不会误建普通文件；
+    只有 file: 前缀的文件输出才创建或清空。
+    """
+    if path.startswith(FILE_PREFIX):
+        return os.open(path[len(FILE_PREFIX):],
+                       os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    return os.open(path, os.O_WRONLY)
+
+
+def iter_events(table, part):
+    """按时间产出一个声部的事件 (时刻 ns, 声部下标, 序号, 事件)"""
+    silence = tone_event(0)
+    at = 0.0
+    seq = 0
+    for i in range(len(table)):
+        voices = table.voices[i]
+        if not voices:
+            continue
+        duration = table.duration[i]
+        if table.degree[i] != -1 and duration > 0:
+            end = at + duration
+            if voices > 1:
+                events = chord_events(table.chord(i))
+                step = at
+                k = 0
+                while step < end:
+                    yield round(step * 1e6), part, seq, events[k % len(events)]
+                    seq += 1
+                    k += 1
+                    step += ARPEGGIO_INTERVAL
+            else:
+                yield round(at * 1e6), part, seq, tone_event(table.freq[i])
+                seq += 1
+            yield round(end * 1e6), part, seq, silence
+            seq += 1
+        at += duration + table.delay[i]
+
+
+class PartPlayer:
+    """在一个线程、一条时间线上播放多个声部"""
+
+    def __init__(self):
+        self.scheduler = Scheduler()
+        self._stop_event = threading.Event()
+        self._stats = None
+
+    def play(self, parts, devices=None):
+        """播放各声部，播放结束或被停止后返回
+
+        devices 为 {声部名称: 设备路径}，覆盖曲谱中写的设备。
+        """
+        devices = devices or {}
+        paths = [devices.get(part.name) or part.device or DEFAULT_DEVICE
+                 for part in parts]
+        stop_event = self._stop_event
+        stop_event.clear()
+        scheduler = self.scheduler
+        fds = []
+        # 每个声部事件的迟到时间 (ns)
+        lateness = [array("q") for _ in parts]
+        # 同一时刻各声部第一个事件实际写出时间的最大差 (ns)，只有一个声部时不计
+        skews = array("q")
+        try:
+            for path in paths:
+                fds.append(open_output(path))
+            events = heapq.merge(*(iter_events(part.table, k)
+                                   for k, part in enumerate(parts)))
+            group_at = None
+            # 当前时刻各声部第一个事件的写出时间 {声部下标: ns}
+            group = {}
+            previous = 0
+            scheduler.start(time.monotonic_ns() + START_DELAY * 1_000_000)
+            for at, part, _, event in events:
+                # 间隔很短（和弦切换）时全程忙等
+                if at - previous <= ARPEGGIO_INTERVAL * 1_000_000:
+                    stopped = scheduler.spin_until(at, stop_event)
+                else:
+                    stopped = scheduler.wait_until(at, stop_event)
+                if stopped:
+                    break
+                previous = at
+                os.write(fds[part], event)
+                written = time.monotonic_ns()
+                lateness[part].append(written - scheduler.start_ns - at)
+                if at != group_at:
+                    if len(group) > 1:
+                        skews.append(max(group.values()) - min(group.values()))
+                    group_at = at
+                    group = {}
+                group.setdefault(part, written)
+            if len(group) > 1:
+                skews.append(max(group.values()) - min(group.values()))
+        finally:
+            silence = tone_event(0)
+            for fd in fds:
+                os.write(fd, silence)
+                os.close(fd)
+        self._stats = self._summarize(parts, paths, lateness, skews)
+        return self._stats
+
+    def stop(self):
+        """停止播放"""
+        self._stop_event.set()
+
+    def stats(self):
+        """上次播放的统计"""
+        return self._stats
+
+    @staticmethod
+    def _summarize(parts, paths, lateness, skews):
+        def summary(values):
+            values = sorted(values)
+            return {
+                "count": len(values),
+                "p50_ms": percentile(values, 50) / 1e6,
+                "p99_ms": percentile(values, 99) / 1e6,
+                "max_ms": (values[-1] if values else 0) / 1e6,
+            }
+
+        result = {"parts": {}}
+        drifts = []
+        for part, path, values in zip(parts, paths, lateness):
+            entry = summary(values)
+            entry["device"] = path
+            entry["drift_ms"] = (values[-1] if values else 0) / 1e6
+            drifts.append(entry["drift_ms"])
+            result["parts"][part.name] = entry
+        # skew：同一时刻的事件在各声部实际写出的时间差
+        result["skew"] = summary(skews)
+        result["drift_spread_ms"] = (max(drifts) - min(drifts)) if drifts else 0
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="同步播放多声部曲谱，每个声部输出到各自的设备")
+    parser.add_argument("score", help="多声部曲谱文件")
+    parser.add_argument("--bpm", type=int, default=200)
+    parser.add_argument("--key", default="C", choices=list(KEY_OFFSETS))
+    parser.add_argument("-d", "--device", action="append", default=[],
+                        metavar="声部=路径",
+                        help="指定声部的输出设备，可重复；file:路径 表示输出到文件")
+    args = parser.parse_args()
+
+    devices = {}
+    for item in args.device:
+        name, sep, path = item.partition("=")
+        if not sep:
+            parser.error(f"设备应写成 声部=路径: {item}")
+        devices[name] = path
+
+    with open(args.score, encoding="utf-8") as file:
+        parts = split_parts(file)
+    for part in parts:
+        part.compile(KEY_OFFSETS[args.key], args.bpm)
+        print(f"声部 {part.name}: {len(part.table)} 个音符，"
+              f"{part.table.total_ms() / 1000:.1f} 秒", file=sys.stderr)
+
+    player = PartPlayer()
+    try:
+        stats = player.play(parts, devices)
+    except KeyboardInterrupt:
+        # 各设备已在 play() 中静音
+        return 1
+    except OSError as e:
+        print(f"播放失败: {e}", file=sys.stderr)
+        return 1
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
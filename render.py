@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import struct
+import sys
+import time
+import wave
+from functools import lru_cache
+
+from score import ARPEGGIO_INTERVAL, KEY_OFFSETS, group_chords, iter_notes
+
+
+SAMPLE_RATE = 44100
+AMPLITUDE = 8000
+# 每次写入文件的最大帧数
+BLOCK_FRAMES = 65536
+# 8253/8254 PIT 时钟频率，pcspkr 按它的整数分频发声
+PIT_TICK_RATE = 1193182
+
+
+def speaker_frequency(freq):
+    """扬声器实际发出的频率（PIT 分频取整后）"""
+    return PIT_TICK_RATE / (PIT_TICK_RATE // round(freq))
+
+
+@lru_cache(maxsize=256)
+def square_pattern(freq, rate=SAMPLE_RATE, amplitude=AMPLITUDE):
+    """约一秒长、首尾相接的方波 PCM 片段 (16 位单声道)
+
+    片段包含整数个周期，重复拼接时相位连续。
+    """
+    periods = max(1, round(freq))
+    length = max(2, round(periods * rate / freq))
+    half = length / (2 * periods)
+    high = struct.pack("<h", amplitude)
+    low = struct.pack("<h", -amplitude)
+    runs = []
+    position = 0
+    for edge_index in range(1, 2 * periods + 1):
+        edge = round(edge_index * half)
+        runs.append((high if edge_index % 2 else low) * (edge - position))
+        position = edge
+    return b"".join(runs)
+
+
+@lru_cache(maxsize=256)
+def chord_pattern(freqs, rate=SAMPLE_RATE, interval=ARPEGGIO_INTERVAL):
+    """和弦琶音一个循环的 PCM 片段：各音依次持续 interval 毫秒"""
+    frames = round(interval * rate / 1000)
+    parts = []
+    for freq in freqs:
+        pattern = square_pattern(speaker_frequency(freq), rate)
+        copies = frames * 2 // len(pattern) + 1
+        parts.append((pattern * copies)[:frames * 2])
+    return b"".join(parts)
+
+
+def repeat_blocks(pattern, nbytes, block_bytes):
+    """把 pattern 循环铺满 nbytes 字节，分块产出"""
+    length = len(pattern)
+    position = 0
+    while nbytes > 0:
+        size = min(nbytes, block_bytes)
+        copies = (position + size) // length + 1
+        yield (pattern * copies)[position:position + size]
+        nbytes -= size
+        position = (position + size) % length
+
+
+def iter_pcm(rows, rate=SAMPLE_RATE, block_frames=BLOCK_FRAMES):
+    """把音符行渲染为 16 位单声道 PCM，按块产出
+
+    每个音符按整段生成：方波片段由缓存的单周期组重复拼接而成，
+    不逐个采样计算。采样点位置由累计时间换算，长曲子不会累积误差。
+    和弦按琶音循环的片段重复拼接。
+    """
+    block_bytes = block_frames * 2
+    silence = bytes(block_bytes)
+    at = 0.0
+    position = 0
+    for _, degree, freq, delay, duration, *_ in group_chords(rows):
+        if degree != -1:
+            at += duration
+            end = round(at * rate / 1000)
+            if isinstance(freq, tuple):
+                pattern = chord_pattern(freq, rate)
+            else:
+                pattern = square_pattern(speaker_frequency(freq), rate)
+            yield from repeat_blocks(pattern, (end - position) * 2, block_bytes)
+            position = end
+            at += delay
+        else:
+            at += duration + delay
+        end = round(at * rate / 1000)
+        yield from repeat_blocks(silence, (end - position) * 2, block_bytes)
+        position = end
+
+
+def render(rows, path, rate=SAMPLE_RATE, raw=False):
+    """渲染到 WAV（raw 为 True 时为裸 PCM）文件，返回帧数"""
+    frames = 0
+    if raw:
+        with open(path, "wb") as file:
+            for block in iter_pcm(rows, rate):
+                file.write(block)
+                frames += len(block) // 2
+        return frames
+
+    with wave.open(path, "wb") as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(rate)
+        for block in iter_pcm(rows, rate):
+            file.writeframesraw(block)
+            frames += len(block) // 2
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把曲谱渲染为 WAV 或裸 PCM")
+    parser.add_argument("score", help="曲谱文件")
+    parser.add_argument("output", help="输出文件")
+    parser.add_argument("--bpm", type=int, default=200)
+    parser.add_argument("--key", default="C", choices=list(KEY_OFFSETS))
+    parser.add_argument("--rate", type=int, default=SAMPLE_RATE)
+    parser.add_argument("--raw", action="store_true",
+                        help="输出 16 位小端单声道裸 PCM")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with open(args.score, encoding="utf-8") as file:
+        frames = render(iter_notes(file, KEY_OFFSETS[args.key], args.bpm),
+                        args.output, args.rate, args.raw)
+    elapsed = time.perf_counter() - start
+    seconds = frames / args.rate
+    print(f"已渲染 {seconds:.1f} 秒音频，用时 {elapsed:.2f} 秒"
+          f"（{seconds / elapsed if elapsed else 0:.0f} 倍实时）")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
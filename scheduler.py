@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import math
+import time
+from array import array
+from bisect import bisect_left
+
+
+# 迟到时间直方图的分桶上界 (微秒)
+HISTOGRAM_BUCKETS_US = (50, 100, 250, 500, 1000, 2000, 5000, 10000)
+
+
+def percentile(sorted_values, p):
+    """已排序序列的百分位数（最近秩法）"""
+    if not sorted_values:
+        return 0
+    rank = max(1, math.ceil(len(sorted_values) * p / 100))
+    return sorted_values[rank - 1]
+
+
+class Scheduler:
+    """按 time.monotonic_ns() 绝对截止时间调度事件
+
+    每个事件的截止时间都从同一个起点算出，某次唤醒迟到不会累积到后面的
+    事件上。等待时先睡到截止时间前 spin_ns，再忙等到截止时间，
+    以获得亚毫秒精度。每次唤醒的迟到时间都会记录下来供统计。
+    """
+
+    def __init__(self, spin_ns=1_000_000):
+        self.spin_ns = spin_ns
+        self.start_ns = None
+        # 每个事件的迟到时间 (ns)
+        self.lateness = array("q")
+        # 其中由 spin_until() 等待的事件
+        self.spin_lateness = array("q")
+
+    def start(self, start_ns=None):
+        """以 start_ns（默认为当前时间）为时间零点开始新的调度"""
+        self.start_ns = time.monotonic_ns() if start_ns is None else start_ns
+        self.lateness = array("q")
+        self.spin_lateness = array("q")
+
+    def wait_until(self, offset_ns, stop_event=None):
+        """等待到零点后 offset_ns，stop_event 被设置时提前返回 True"""
+        if stop_event is not None and stop_event.is_set():
+            return True
+        deadline = self.start_ns + offset_ns
+        remaining = deadline - time.monotonic_ns()
+        if remaining > self.spin_ns:
+            timeout = (remaining - self.spin_ns) / 1e9
+            if stop_event is not None:
+                if stop_event.wait(timeout):
+                    return True
+            else:
+                time.sleep(timeout)
+        now = time.monotonic_ns()
+        while now < deadline:
+            now = time.monotonic_ns()
+        self.lateness.append(now - deadline)
+        return False
+
+    def spin_until(self, offset_ns, stop_event=None):
+        """全程忙等到零点后 offset_ns，不让出 CPU，用于间隔很短的连续事件
+
+        stop_event 被设置时提前返回 True。
+        """
+        deadline = self.start_ns + offset_ns
+        now = time.monotonic_ns()
+        while now < deadline:
+            if stop_event is not None and stop_event.is_set():
+                return True
+            now = time.monotonic_ns()
+        self.lateness.append(now - deadline)
+        self.spin_lateness.append(now - deadline)
+        return False
+
+    def stats(self):
+        """迟到时间统计，时间单位为毫秒
+
+        drift_ms 为最后一个事件相对计划时间的偏差，即整首曲子的累计漂移。
+        有 spin_until() 等待的事件（如和弦切换）时，另在 spin 中单独统计。
+        """
+        values = sorted(self.lateness)
+        histogram = {}
+        lower = 0
+        for upper in HISTOGRAM_BUCKETS_US:
+            index = bisect_left(values, upper * 1000)
+            histogram[f"<{upper}us"] = index - lower
+            lower = index
+        histogram[f">={HISTOGRAM_BUCKETS_US[-1]}us"] = len(values) - lower
+        result = {
+            "count": len(values),
+            "p50_ms": percentile(values, 50) / 1e6,
+            "p99_ms": percentile(values, 99) / 1e6,
+            "max_ms": (values[-1] if values else 0) / 1e6,
+            "drift_ms": (self.lateness[-1] if values else 0) / 1e6,
+            "histogram": histogram,
+        }
+        if self.spin_lateness:
+            spin = sorted(self.spin_lateness)
+            result["spin"] = {
+                "count": len(spin),
+                "p50_ms": percentile(spin, 50) / 1e6,
+                "p99_ms": percentile(spin, 99) / 1e6,
+                "max_ms": spin[-1] / 1e6,
+            }
+        return result
@@ -0,0 +1,1186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from itertools import islice
+
+from metrics import REGISTRY
+
+
+# 音符频率映射表 (C调基准)
+NOTE_FREQUENCIES = {
+    -1: [130.81, 146.83, 164.81, 174.61, 196.00, 220.00, 246.94],  # 低音
+    0: [261.63, 293.66, 329.63, 349.23, 392.00, 440.00, 493.88],   # 中音
+    1: [523.25, 587.33, 659.25, 698.46, 783.99, 880.00, 987.77]    # 高音
+}
+
+# 调性偏移映射 (半音数)
+KEY_OFFSETS = {
+    "C": 0, "C♯": 1, "Db": 1, "D": 2, "D♯": 3, "Eb": 3,
+    "E": 4, "F": 5, "F♯": 6, "Gb": 6, "G": 7, "G♯": 8,
+    "Ab": 8, "A": 9, "A♯": 10, "Bb": 10, "B": 11
+}
+# 调性偏移 -> 写出时使用的名称，取 KEY_OFFSETS 中每个偏移的第一个名称
+KEY_NAMES = {offset: name for name, offset in reversed(KEY_OFFSETS.items())}
+
+# 十二平均律频率表：(八度, 调性偏移) -> 7 个音级的频率，导入时一次算好
+FREQUENCY_TABLE = {
+    (octave, key_offset): [base_freq * (2 ** (key_offset / 12))
+                           for base_freq in base_freqs]
+    for octave, base_freqs in NOTE_FREQUENCIES.items()
+    for key_offset in range(12)
+}
+
+# 频率表命中/未命中次数
+FREQUENCY_STATS = {"hits": 0, "misses": 0}
+
+# 解析缓存的最大条目数
+NOTE_CACHE_SIZE = 4096
+
+TOKEN_PATTERN = re.compile(r"\S+")
+
+# 从编辑框等处按行范围取文本时，每次最多取的行数
+FETCH_LINES = 4096
+
+# 和弦以快速琶音模拟，每个音持续的毫秒数 (5-20)
+ARPEGGIO_INTERVAL = 10
+
+# 结构记号：|: 反复开始，:| 或 :|*N 反复结束（共演奏 N 遍），
+# |1. |2. |1,3. 反复结尾，@名称{ ... } 定义宏，@名称 调用宏
+STRUCTURE_PATTERN = re.compile(
+    r"\|:|:\|(?:\*\d+)?|\|\d+(?:,\d+)*\.|@\w+\{?|\{|\}")
+
+
+def parse_note(note_str, default_duration, default_delay, key_offset, bpm):
+    """解析音符字符串"""
+    # 默认值
+    pitch = 0
+    duration = default_duration
+    delay = default_delay
+    offset = key_offset
+
+    # 解析音高部分
+    pitch_match = re.match(r"([+-]?)(\d+)", note_str)
+    if pitch_match:
+        sign = pitch_match.group(1)
+        note_num = int(pitch_match.group(2))
+
+        # 确定八度
+        if sign == "-":
+            pitch = (-1, note_num - 1)
+        elif sign == "+":
+            pitch = (1, note_num - 1)
+        else:
+            pitch = (0, note_num - 1)
+
+    # 解析参数部分
+    params_match = re.search(r"\(([^)]*)\)", note_str)
+    if params_match:
+        params = params_match.group(1).split(",")
+
+        # 1 s/n   s/n      str    num
+        # 1 delay duration offset bpm
+        # 2 delay duration offset
+        # 3 delay duration
+        # 4 duration offset bpm
+        # 5 duration offset
+        # 6 duration
+        # 7
+
+        # 解析第四/三个参数（bpm），对后面 note 均生效 #1,2,4
+        if len(params) > 2 and params[-1].strip():
+            try:
+                # 1,4
+                bpm = int(params[-1])
+            except ValueError:
+                pass
+        default_delay = default_duration = 60000 / bpm
+
+        # 解析第一个参数（假定为延时，可能为持续时间） #1,2,3
+        if params[0].strip():
+            try:
+                # 支持倍数表示法 (如 *1.5)
+                if params[0].strip().startswith("*"):
+                    factor = float(params[0].strip()[1:])
+                    delay = float(default_delay * factor)
+                else:
+                    delay = float(params[0].strip())
+            except ValueError:
+                pass
+        else:
+            delay = 0
+
+        # 解析第二/一个参数（持续时间）
+        i = 1
+        #  1,2,3,4,5
+        if len(params) > 1:
+            if params[1].strip().startswith("*"):  # 123
+                i = 1
+            else:
+                try:
+                    # 123
+                    float(params[1].strip())
+                    i = 1
+                except ValueError:
+                    i = 0
+                    pass
+        else:
+            # 4,5,6
+            i = 0
+        if params[i].strip():
+            try:
+                # 支持倍数表示法 (如 *1.5)
+                if params[i].strip().startswith("*"):
+                    factor = float(params[i].strip()[1:])
+                    duration = float(default_duration * factor)
+                else:
+                    duration = float(params[i].strip())
+            except ValueError:
+                pass
+        if i == 0:
+            delay = 0
+
+        # 解析第三/二个参数（调），对后面 note 均生效
+        if (len(params) > i + 1) and params[i + 1].strip():
+            try:
+                offset = KEY_OFFSETS[params[i + 1]]
+            except KeyError:
+                pass
+    else:
+        delay = 0
+        duration = 60000 / bpm
+
+    return pitch, delay, duration, offset, bpm
+
+
+def calculate_frequency(pitch, key_offset):
+    """计算音符频率（考虑调性偏移）"""
+    if not pitch:
+        return None
+
+    octave, note_index = pitch
+
+    # 检查音符是否有效
+    if octave not in NOTE_FREQUENCIES or note_index < -1 or note_index > 6:
+        return None
+
+    row = FREQUENCY_TABLE.get((octave, key_offset))
+    if row is not None:
+        FREQUENCY_STATS["hits"] += 1
+        return row[note_index]
+    FREQUENCY_STATS["misses"] += 1
+
+    base_freq = NOTE_FREQUENCIES[octave][note_index]
+
+    # 应用调性偏移（十二平均律）
+    return base_freq * (2 ** (key_offset / 12))
+
+
+@lru_cache(maxsize=NOTE_CACHE_SIZE)
+def resolve_note(note_str, default_duration, key_offset, bpm):
+    """解析音符并计算频率，结果按参数缓存
+
+    返回 (是否有效, 八度, 音级, 频率, 延时, 持续时间, 调性偏移, bpm)，
+    后两项为解析后延续给后面音符的状态；无效音符也可能改变状态。
+    """
+    # 只有未命中缓存时才会执行到这里，计时开销不影响命中的音符
+    begin = time.perf_counter_ns()
+    try:
+        pitch, delay, duration, offset, new_bpm = parse_note(
+            note_str, default_duration, default_duration, key_offset, bpm
+        )
+    except ZeroDivisionError:
+        # bpm 为 0，状态不变
+        return False, 0, 0, 0.0, 0.0, 0.0, key_offset, bpm
+    parsed = time.perf_counter_ns()
+    REGISTRY.add("parse_note", parsed - begin, begin)
+
+    freq = calculate_frequency(pitch, offset)
+    REGISTRY.add("frequency", time.perf_counter_ns() - parsed, parsed)
+    if freq is None:
+        return False, 0, 0, 0.0, 0.0, 0.0, offset, new_bpm
+    return True, pitch[0], pitch[1], freq, delay, duration, offset, new_bpm
+
+
+def cache_stats():
+    """解析缓存和频率表的命中统计"""
+    info = resolve_note.cache_info()
+    return {
+        "note_cache": {"hits": info.hits, "misses": info.misses,
+                       "size": info.currsize, "max_size": info.maxsize},
+        "frequency_table": dict(FREQUENCY_STATS),
+    }
+
+
+def is_number(param):
+    """参数是否为数字或倍数表示法"""
+    param = param.strip()
+    if param.startswith("*"):
+        param = param[1:]
+    try:
+        float(param)
+    except ValueError:
+        return False
+    return True
+
+
+def param_fields(params, valid=False):
+    """按 parse_note 的规则返回 (延时, 持续时间, 调性, bpm) 各参数的下标，没有的为 None
+
+    调性和 bpm 只看该位置是否写了内容，两者可能是同一个参数；valid 为真时
+    只返回 parse_note 实际采用的，即有效的调性名称和整数 bpm。
+    """
+    i = 1 if len(params) > 1 and (params[1].strip().startswith("*")
+                                  or is_number(params[1])) else 0
+    key = i + 1 if len(params) > i + 1 and params[i + 1].strip() else None
+    bpm = len(params) - 1 if len(params) > 2 and params[-1].strip() else None
+    if valid:
+        if key is not None and params[key] not in KEY_OFFSETS:
+            key = None
+        if bpm is not None:
+            try:
+                int(params[bpm])
+            except ValueError:
+                bpm = None
+    return (0 if i == 1 else None), i, key, bpm
+
+
+def check_note(note_str):
+    """检查音符字符串，返回 parse_note 会静默忽略的问题，没有问题时返回 None"""
+    if STRUCTURE_PATTERN.fullmatch(note_str):
+        return None
+    # 和弦 [1 3 5](参数) 的各部分按普通音符检查
+    if note_str.startswith("["):
+        note_str = note_str[1:]
+        if not note_str:
+            return None
+    if "]" in note_str:
+        pitch, _, params = note_str.partition("]")
+        note_str = (pitch or "1") + params
+    pitch_match = re.match(r"([+-]?)(\d+)", note_str)
+    if not pitch_match:
+        return "无法识别的音高"
+    if int(pitch_match.group(2)) > 7:
+        return "音符超出范围 (0-7)"
+
+    params_match = re.search(r"\(([^)]*)\)", note_str)
+    if not params_match:
+        if "(" in note_str or ")" in note_str:
+            return "括号不完整"
+        return None
+    params = params_match.group(1).split(",")
+
+    delay, i, key, bpm = param_fields(params)
+    if delay is not None and params[0].strip() and not is_number(params[0]):
+        return f"延时 '{params[0].strip()}' 不是数字"
+    if params[i].strip() and not is_number(params[i]):
+        return f"持续时间 '{params[i].strip()}' 不是数字"
+    if key is not None and params[key] not in KEY_OFFSETS:
+        return f"未知的调性 '{params[key]}'"
+    # 与调性是同一个参数时已按调性报告
+    if bpm is not None and bpm != key:
+        try:
+            if int(params[bpm]) <= 0:
+                return "bpm 必须大于 0"
+        except ValueError:
+            return f"bpm '{params[bpm].strip()}' 不是整数"
+    if len(params) > i + 3:
+        return "参数过多"
+    return None
+
+
+def iter_line_tokens(line, line_num):
+    """逐个产出一行中的音符 (行号, 起始列, 结束列, 文本)，注释行不产出"""
+    stripped_line = line.strip()
+    if not stripped_line or stripped_line.startswith("#"):
+        return
+    for match in TOKEN_PATTERN.finditer(line):
+        # 以 # 开头的是行内注释，解析时本来就会跳过
+        if match.group().startswith("#"):
+            continue
+        yield line_num, match.start(), match.end(), match.group()
+
+
+def iter_tokens(text):
+    """逐个产出曲谱中的音符 (行号, 起始列, 结束列, 文本)，跳过注释行"""
+    for line_num, line in enumerate(text.split("\n"), 1):
+        yield from iter_line_tokens(line, line_num)
+
+
+def iter_range_lines(get_lines, first, last, chunk_lines=FETCH_LINES):
+    """逐行产出第 first 到 last 行 (从 1 开始，含两端) 的 (行号, 文本)
+
+    get_lines(first, last) 返回一段行的文本列表；每次只取 chunk_lines 行，
+    不会一次把整段文本复制出来。
+    """
+    while first <= last:
+        end = min(last, first + chunk_lines - 1)
+        yield from enumerate(get_lines(first, end), first)
+        first = end + 1
+
+
+def iter_range_tokens(get_lines, first, last):
+    """逐个产出第 first 到 last 行中的音符 (行号, 起始列, 结束列, 文本)"""
+    for line_num, line in iter_range_lines(get_lines, first, last):
+        yield from iter_line_tokens(line, line_num)
+
+
+# 语法高亮的标签：注释、结构记号、八度前缀、参数、改变调性或 bpm 的参数、
+# 有问题的音符
+HIGHLIGHT_TAGS = ("comment", "structure", "octave", "params", "change",
+                  "invalid")
+
+
+def highlight_spans(line):
+    """一行的语法高亮，返回 [(标签, 起始列, 结束列)]，与解析器的规则一致"""
+    stripped_line = line.lstrip()
+    if not stripped_line:
+        return []
+    if stripped_line.startswith("#"):
+        return [("comment", len(line) - len(stripped_line), len(line.rstrip()))]
+    # 无法解析的音符和和弦按编译结果标出，和弦错误跨越多个词
+    table, _, _ = compile_tokens(iter_line_tokens(line, 0), KEY_OFFSETS["C"], 200)
+    invalid = [(start, end) for _, start, end, _ in table.invalid]
+    spans = [("invalid", start, end) for start, end in invalid]
+    for match in TOKEN_PATTERN.finditer(line):
+        token = match.group()
+        start, end = match.span()
+        if token.startswith("#"):
+            spans.append(("comment", start, end))
+            continue
+        if STRUCTURE_PATTERN.fullmatch(token):
+            spans.append(("structure", start, end))
+            continue
+        if check_note(token) is not None and not any(
+                first <= start < last for first, last in invalid):
+            spans.append(("invalid", start, end))
+        prefix = 1 if token.startswith("[") else 0
+        if token[prefix:prefix + 1] in ("+", "-"):
+            spans.append(("octave", start + prefix, start + prefix + 1))
+        params_match = re.search(r"\(([^)]*)\)", token)
+        if not params_match:
+            continue
+        spans.append(("params", start + params_match.start(),
+                      start + params_match.end()))
+        # 与 parse_note 相同的规则找出调性和 bpm 参数
+        params = params_match.group(1).split(",")
+        changes = param_fields(params)[2:]
+        column = start + params_match.start(1)
+        for k, param in enumerate(params):
+            if k in changes:
+                spans.append(("change", column, column + len(param)))
+            column += len(param) + 1
+    return spans
+
+
+def note_args(degree, freq, delay, duration):
+    """单个音符的 beep 命令行参数"""
+    if degree != -1:
+        args = ["-f", str(freq), "-l", str(duration)]
+        if delay > 0:
+            args.extend(["-D", str(delay)])
+        return args
+    return ["-f", "1", "-l", str(duration + delay)]
+
+
+@lru_cache(maxsize=256)
+def chord_cycle(freqs, interval=ARPEGGIO_INTERVAL):
+    """和弦琶音一个循环的 beep 参数，每个音 interval 毫秒，各音之间以 -n 分隔"""
+    args = []
+    for freq in freqs:
+        args.extend(["-n", "-f", str(freq), "-l", str(interval)])
+    return tuple(args[1:])
+
+
+def chord_args(freqs, delay, duration, interval=ARPEGGIO_INTERVAL):
+    """和弦的 beep 命令行参数：在 duration 内循环切换各音"""
+    cycle = chord_cycle(freqs, interval)
+    cycles, rest = divmod(duration, interval * len(freqs))
+    cycles = int(cycles)
+    args = []
+    if cycles:
+        args.extend(cycle)
+        for _ in range(cycles - 1):
+            args.append("-n")
+            args.extend(cycle)
+    # 最后不足一个循环的部分
+    for freq in freqs:
+        if rest <= 0:
+            break
+        if args:
+            args.append("-n")
+        args.extend(["-f", str(freq), "-l", str(min(interval, rest))])
+        rest -= interval
+    if not args:
+        # 持续时间为 0：同单个音符，写出一个无声的音，否则 beep 会用默认音调
+        args = ["-f", "1", "-l", "0"]
+    if delay > 0:
+        args.extend(["-D", str(delay)])
+    return args
+
+
+class NoteTable:
+    """编译后的音符表，每列一个 array，按下标对应同一个音符"""
+
+    COLUMNS = (
+        ("octave", "b"),     # 八度 -1/0/1
+        ("degree", "b"),     # 音级 0-6，-1 为休止符
+        ("freq", "d"),       # 频率 (Hz)
+        ("delay", "d"),      # 延时 (ms)
+        ("duration", "d"),   # 持续时间 (ms)
+        ("key", "b"),        # 调性偏移 (半音数)
+        ("bpm", "l"),        # 当前 bpm
+        ("line", "l"),       # 所在行 (从 1 开始)
+        ("start", "l"),      # 起始列
+        ("end", "l"),        # 结束列
+        ("voices", "b"),     # 和弦首音为和弦的音数，其余和弦音为 0，普通音符为 1
+    )
+
+    def __init__(self):
+        for name, typecode in self.COLUMNS:
+            setattr(self, name, array(typecode))
+        # 无法解析的音符 (行号, 起始列, 结束列, 原因)
+        self.invalid = []
+        # 结构记号 (位于其前的音符数, 行号, 起始列, 结束列, 文本)
+        self.marks = []
+        # 由 expand_table() 展开得到时，原音符表和每个音符在其中的下标
+        self.origin = None
+        self.origin_index = None
+        # 展开时超出 Arrangement.MAX_NOTES 而截断
+        self.truncated = False
+        # 每个音符的开始时间 (ms)，由 onsets() 生成
+        self._onsets = None
+        # 展开的表中，原表第 i 个及之后的音符最早演奏时的下标，由 index_at_position() 生成
+        self._first_played = None
+
+    def __len__(self):
+        return len(self.freq)
+
+    def append(self, octave, degree, freq, delay, duration, key, bpm,
+               line, start, end, voices=1):
+        """追加一个音符"""
+        self.octave.append(octave)
+        self.degree.append(degree)
+        self.freq.append(freq)
+        self.delay.append(delay)
+        self.duration.append(duration)
+        self.key.append(key)
+        self.bpm.append(bpm)
+        self.line.append(line)
+        self.start.append(start)
+        self.end.append(end)
+        self.voices.append(voices)
+
+    def extend(self, other, line=None):
+        """追加另一个音符表的全部音符，line 不为 None 时改写所在行"""
+        offset = len(self)
+        self.marks.extend(
+            (index + offset, mark_line if line is None else line,
+             start, end, text)
+            for index, mark_line, start, end, text in other.marks)
+        for name, typecode in self.COLUMNS:
+            if name == "line" and line is not None:
+                self.line.extend(array("l", [line]) * len(other))
+            else:
+                getattr(self, name).extend(getattr(other, name))
+        if line is None:
+            self.invalid.extend(other.invalid)
+        else:
+            self.invalid.extend((line, start, end, reason)
+                                for _, start, end, reason in other.invalid)
+
+    def onsets(self):
+        """每个音符相对曲首的开始时间 (ms)，即延时加持续时间的前缀和
+
+        第一次调用时生成并缓存，之后修改音符表不会更新。
+        """
+        if self._onsets is None:
+            onsets = array("d", bytes(8 * len(self)))
+            at = 0.0
+            delay, duration = self.delay, self.duration
+            for i in range(len(onsets)):
+                onsets[i] = at
+                at += delay[i] + duration[i]
+            self._onsets = onsets
+        return self._onsets
+
+    def end_ms(self, i):
+        """第 i 个音符结束（含延时）的时间 (ms)"""
+        return self.onsets()[i] + self.delay[i] + self.duration[i]
+
+    def index_at_time(self, ms):
+        """ms 时正在播放的音符下标，位于和弦中时为和弦首音"""
+        i = max(0, bisect_right(self.onsets(), ms) - 1)
+        while i > 0 and not self.voices[i]:
+            i -= 1
+        return i
+
+    def chord(self, i):
+        """第 i 个音符为和弦首音时返回和弦各音频率的元组，否则返回 None"""
+        voices = self.voices[i]
+        if voices < 2:
+            return None
+        return tuple(self.freq[i:i + voices])
+
+    def index_at_position(self, line, col):
+        """第一个不完全位于 (line, col) 之前的音符下标，没有时为 len(self)
+
+        展开过重复的音符表取该位置的音符第一次演奏时的下标。
+        """
+        if self.origin is not None:
+            return self.first_played()[self.origin.index_at_position(line, col)]
+        lo = bisect_left(self.line, line)
+        hi = bisect_right(self.line, line, lo)
+        return bisect_right(self.end, col, lo, hi)
+
+    def first_played(self):
+        """展开的表中，原表第 i 个及之后的音符最早演奏时的下标（第 len(origin) 项为 len(self)）
+
+        第一次调用时生成并缓存。
+        """
+        if self._first_played is None:
+            count = len(self)
+            first = array("l", [count]) * (len(self.origin) + 1)
+            for played in range(count - 1, -1, -1):
+                first[self.origin_index[played]] = played
+            # 取后缀最小值：没有演奏过的音符对应其后最早演奏的音符
+            for i in range(len(first) - 2, -1, -1):
+                if first[i + 1] < first[i]:
+                    first[i] = first[i + 1]
+            self._first_played = first
+        return self._first_played
+
+    def is_rest(self, i):
+        """是否为休止符"""
+        return self.degree[i] == -1
+
+    def total_ms(self):
+        """总时长 (ms)"""
+        return sum(self.delay) + sum(self.duration)
+
+    def rows(self, start=0, stop=None):
+        """逐个产出第 start 到 stop 个音符的音符行，字段顺序同 COLUMNS"""
+        columns = [getattr(self, name) for name, _ in self.COLUMNS]
+        for i in range(start, len(self) if stop is None else stop):
+            yield tuple(column[i] for column in columns)
+
+    def beep_args(self, program="beep"):
+        """生成 beep 命令行参数"""
+        args = [program]
+        freq, delay, duration, degree = (
+            self.freq, self.delay, self.duration, self.degree)
+        for i in range(len(freq)):
+            if not self.voices[i]:
+                continue
+            if len(args) > 1:
+                args.append("-n")
+            chord = self.chord(i)
+            if chord and degree[i] != -1:
+                args.extend(chord_args(chord, delay[i], duration[i]))
+            else:
+                args.extend(note_args(degree[i], freq[i], delay[i],
+                                      duration[i]))
+        return args
+
+
+# 决定发声内容的列，比较两个音符表时只看这些列
+SOUND_COLUMNS = ("octave", "degree", "freq", "delay", "duration", "voices")
+
+
+def _common_prefix(a, b):
+    """两个 array 的公共前缀长度，二分查找并用切片比较，比较在 C 中完成"""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix(a, b, limit):
+    """两个 array 的公共后缀长度，不超过 limit"""
+    lo, hi = 0, limit
+    len_a, len_b = len(a), len(b)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len_a - mid:len_a - lo] == b[len_b - mid:len_b - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def diff_tables(old, new):
+    """比较两个音符表的发声内容，返回 (公共前缀长度, 公共后缀长度)
+
+    两者之间的部分即为改动过的音符，前缀和后缀不会重叠。
+    """
+    prefix = min(len(old), len(new))
+    for name in SOUND_COLUMNS:
+        prefix = min(prefix, _common_prefix(
+            getattr(old, name)[:prefix], getattr(new, name)[:prefix]))
+    suffix = min(len(old), len(new)) - prefix
+    for name in SOUND_COLUMNS:
+        suffix = _common_suffix(getattr(old, name), getattr(new, name), suffix)
+    return prefix, suffix
+
+
+def index_mapper(old_len, new_len, prefix, suffix):
+    """返回把旧音符表下标换算为新音符表下标的函数"""
+    old_changed_end = old_len - suffix
+    new_changed_end = new_len - suffix
+
+    def map_index(i):
+        if i < prefix:
+            return i
+        if i >= old_changed_end:
+            return i - old_len + new_len
+        # 位于改动区域内：按相对位置对应，不超出新的改动区域
+        return min(i, new_changed_end)
+
+    return map_index
+
+
+def compile_tokens(tokens, key_offset, bpm, default_duration=None,
+                   table=None):
+    """把 iter_tokens 产出的音符编译进音符表，返回 (音符表, 调性偏移, bpm)
+
+    调性和 bpm 会从一个音符延续到后面的音符，因此同时返回结束时的状态。
+    default_duration 为参数无法解析时的回退值，默认按初始 bpm 计算。
+    """
+    if table is None:
+        table = NoteTable()
+    if default_duration is None:
+        default_duration = 60000 / bpm
+    # 正在收集的和弦 [行号, 起始列, [音高], 结束列, 错误原因]
+    chord = None
+    for line_num, start, end, note in tokens:
+        if chord is not None and line_num != chord[0]:
+            # 和弦不能跨行
+            table.invalid.append((chord[0], chord[1], chord[3], "和弦缺少 ]"))
+            chord = None
+        if chord is None and note.startswith("["):
+            chord = [line_num, start, [], end, None]
+            note = note[1:]
+            if not note:
+                continue
+        if chord is not None:
+            chord[3] = end
+            if note.startswith("["):
+                chord[4] = chord[4] or "和弦不能嵌套"
+                note = note[1:]
+            pitch, closed, params = note.partition("]")
+            if pitch:
+                chord[2].append(pitch)
+            if not closed:
+                continue
+            key_offset, bpm = _compile_chord(
+                table, chord, params, default_duration, key_offset, bpm)
+            chord = None
+            continue
+        valid, octave, degree, freq, delay, duration, key_offset, bpm = \
+            resolve_note(note, default_duration, key_offset, bpm)
+        if not valid:
+            if STRUCTURE_PATTERN.fullmatch(note):
+                table.marks.append((len(table), line_num, start, end, note))
+            else:
+                table.invalid.append((line_num, start, end,
+                                      check_note(note) or "无法解析的音符"))
+            continue
+        table.append(octave, degree, freq, delay, duration, key_offset,
+                     bpm, line_num, start, end)
+    if chord is not None:
+        table.invalid.append((chord[0], chord[1], chord[3], "和弦缺少 ]"))
+    return table, key_offset, bpm
+
+
+def _compile_chord(table, chord, params, default_duration, key_offset, bpm):
+    """把收集好的和弦编译为连续的几行，返回之后的 (调性偏移, bpm)
+
+    参数写在 ] 之后，对整个和弦生效；首音带延时和持续时间，其余音为 0，
+    因此和弦在时间线上只占一个位置。
+    """
+    line_num, start, pitches, end, error = chord
+    if not pitches:
+        error = error or "空的和弦"
+    if error:
+        table.invalid.append((line_num, start, end, error))
+        return key_offset, bpm
+    head = pitches[0] + params
+    valid, octave, degree, freq, delay, duration, key_offset, bpm = \
+        resolve_note(head, default_duration, key_offset, bpm)
+    if not valid:
+        error = check_note(head)
+    tones = [(octave, degree, freq)]
+    for pitch in pitches[1:]:
+        tone_valid, octave, degree, freq, *_ = resolve_note(
+            pitch, default_duration, key_offset, bpm)
+        if not tone_valid and valid:
+            error = check_note(pitch)
+            valid = False
+        tones.append((octave, degree, freq))
+    if not valid:
+        table.invalid.append((line_num, start, end,
+                              error or "无法解析的和弦"))
+        return key_offset, bpm
+    for k, (octave, degree, freq) in enumerate(tones):
+        table.append(octave, degree, freq, delay if k == 0 else 0.0,
+                     duration if k == 0 else 0.0, key_offset, bpm,
+                     line_num, start, end, len(tones) if k == 0 else 0)
+    return key_offset, bpm
+
+
+def group_chords(rows):
+    """把音符行中和弦的各行合并为一行，频率一栏换成和弦各音频率的元组"""
+    head = None
+    freqs = None
+    remaining = 0
+    for row in rows:
+        voices = row[-1]
+        if remaining:
+            if voices == 0:
+                freqs.append(row[2])
+                remaining -= 1
+                if not remaining:
+                    yield head[:2] + (tuple(freqs),) + head[3:]
+                continue
+            # 和弦被截断，按已有的音播放
+            yield head[:2] + (tuple(freqs),) + head[3:]
+            remaining = 0
+        if voices > 1:
+            head, freqs, remaining = row, [row[2]], voices - 1
+        elif voices:
+            yield row
+    if remaining:
+        yield head[:2] + (tuple(freqs),) + head[3:]
+
+
+def compile_score(text, key_offset, bpm):
+    """把曲谱文本编译为音符表"""
+    return compile_tokens(iter_tokens(text), key_offset, bpm)[0]
+
+
+def compile_lines(lines, key_offset, bpm):
+    """逐行编译行的可迭代对象（如打开的文件），得到未展开的音符表"""
+    default_duration = 60000 / bpm
+    table = NoteTable()
+    for line_num, line in enumerate(lines, 1):
+        table, key_offset, bpm = compile_tokens(
+            iter_line_tokens(line, line_num), key_offset, bpm,
+            default_duration, table
+        )
+    return table
+
+
+def iter_notes(lines, key_offset, bpm):
+    """从行的可迭代对象（如打开的文件）惰性地产出演奏顺序的音符行
+
+    重复和宏在产出时才展开，内存占用与曲谱源文本大小成正比，与展开后的
+    长度无关。字段顺序同 NoteTable.COLUMNS。
+    """
+    yield from Arrangement(compile_lines(lines, key_offset, bpm)).rows()
+
+
+class _Frame:
+    """Arrangement 构建时的一层：整个曲谱、一段反复或一个宏定义"""
+    __slots__ = ("kind", "mark", "body", "target", "endings", "floor", "name")
+
+    def __init__(self, kind, mark=None, name=None):
+        self.kind = kind
+        self.mark = mark
+        self.name = name
+        self.body = []
+        # 当前音符加入的列表：反复的主体或最后一个结尾
+        self.target = self.body
+        # 反复结尾 [(演奏第几遍时使用, 列表)]
+        self.endings = []
+        # 没有 |: 的 :| 从这里开始反复
+        self.floor = 0
+
+
+def _mark_kind(text):
+    """结构记号的 (种类, 参数)"""
+    if text == "|:":
+        return "begin", None
+    if text.startswith(":|"):
+        return "end", int(text[3:]) if len(text) > 2 else None
+    if text.startswith("|"):
+        return "ending", frozenset(int(n) for n in text[1:-1].split(","))
+    if text == "{":
+        return "open", None
+    if text == "}":
+        return "close", None
+    if text.endswith("{"):
+        return "define", text[1:-1]
+    return "call", text[1:]
+
+
+class Arrangement:
+    """音符表的演奏顺序
+
+    结构记号在构建时整理为由音符下标区间、反复和宏调用组成的树，大小与
+    记号数量成正比；迭代时才按树产出演奏顺序的下标，不会整体展开。
+
+    反复按写出的样子重放已编译的音符：段内改变的 bpm 和调性只影响其后
+    书写的音符。不完整或无法识别的结构记号被忽略，记录在 errors 中。
+
+    展开后的音符数最多比原音符数多 MAX_NOTES 个，超出的部分不演奏，
+    并在使其超出的结构记号处记录错误。
+    """
+
+    MAX_NOTES = 200000
+
+    def __init__(self, table):
+        self._setup(table, table.marks, len(table))
+
+    @classmethod
+    def from_marks(cls, marks, count):
+        """只由结构记号和音符总数构建，用于逐行编译时检查结构
+
+        不保留音符，得到的对象只能用于检查 errors 和迭代下标，不能产出音符行。
+        """
+        arrangement = cls.__new__(cls)
+        arrangement._setup(None, marks, count)
+        return arrangement
+
+    def _setup(self, table, marks, count):
+        self.table = table
+        self.macros = {}
+        # (行号, 起始列, 结束列, 记号, 原因)
+        self.errors = []
+        self.items = self._build(marks, count)
+        self._check_calls()
+        self.limit = count + self.MAX_NOTES
+        self.truncated = self._check_length()
+
+    def __iter__(self):
+        """按演奏顺序产出音符下标"""
+        return islice(self._iter_items(self.items, set()), self.limit)
+
+    def rows(self):
+        """按演奏顺序产出音符行"""
+        table = self.table
+        columns = [getattr(table, name) for name, _ in table.COLUMNS]
+        for i in self:
+            yield tuple(column[i] for column in columns)
+
+    def _error(self, mark, reason):
+        _, line, start, end, text = mark
+        self.errors.append((line, start, end, text, reason))
+
+    def _build(self, marks, count):
+        stack = [_Frame("top")]
+        position = 0
+        skip = False
+        for k, mark in enumerate(marks):
+            if skip:
+                skip = False
+                continue
+            index = mark[0]
+            frame = stack[-1]
+            if index > position:
+                frame.target.append(("notes", position, index))
+                position = index
+            kind, arg = _mark_kind(mark[4])
+            if (kind == "call" and k + 1 < len(marks)
+                    and marks[k + 1][0] == index and marks[k + 1][4] == "{"):
+                # "@名称 {" 分开书写
+                kind = "define"
+                skip = True
+
+            if kind == "begin":
+                stack.append(_Frame("repeat", mark))
+            elif kind == "ending":
+                if frame.kind != "repeat":
+                    self._error(mark, "反复结尾不在 |: 和 :| 之间")
+                elif 0 in arg:
+                    self._error(mark, "反复结尾的编号必须大于 0")
+                else:
+                    frame.target = []
+                    frame.endings.append((arg, frame.target))
+            elif kind == "end":
+                if arg is not None and arg < 1:
+                    self._error(mark, "反复次数必须大于 0")
+                    arg = None
+                if frame.kind == "repeat":
+                    stack.pop()
+                    passes = arg or max(
+                        [2] + [max(numbers) for numbers, _ in frame.endings])
+                    parent = stack[-1]
+                    parent.target.append(
+                        ("repeat", passes, frame.body, frame.endings, mark))
+                else:
+                    # 没有 |: 时从开头或上一个反复之后开始
+                    parent = frame
+                    body = parent.target[parent.floor:]
+                    del parent.target[parent.floor:]
+                    parent.target.append(("repeat", arg or 2, body, [], mark))
+                parent.floor = len(parent.target)
+            elif kind == "define":
+                stack.append(_Frame("macro", mark, arg))
+            elif kind == "close":
+                while stack[-1].kind == "repeat":
+                    self._unwind(stack)
+                if stack[-1].kind == "macro":
+                    self._define(stack.pop())
+                else:
+                    self._error(mark, "多余的 }")
+            elif kind == "open":
+                self._error(mark, "{ 前缺少宏名称")
+            else:
+                frame.target.append(("call", arg, mark))
+
+        if count > position:
+            stack[-1].target.append(("notes", position, count))
+        while len(stack) > 1:
+            if stack[-1].kind == "repeat":
+                self._unwind(stack)
+            else:
+                frame = stack.pop()
+                self._error(frame.mark, "宏定义缺少 }")
+                self._define(frame)
+        return stack[0].body
+
+    def _unwind(self, stack):
+        """没有 :| 的反复只演奏一遍"""
+        frame = stack.pop()
+        self._error(frame.mark, "缺少对应的 :|")
+        target = stack[-1].target
+        target.extend(frame.body)
+        for _, items in frame.endings:
+            target.extend(items)
+
+    def _define(self, frame):
+        if frame.name in self.macros:
+            self._error(frame.mark, f"宏 '{frame.name}' 重复定义")
+        self.macros[frame.name] = frame.body
+
+    def _iter_calls(self, items):
+        for item in items:
+            if item[0] == "call":
+                yield item
+            elif item[0] == "repeat":
+                yield from self._iter_calls(item[2])
+                for _, ending in item[3]:
+                    yield from self._iter_calls(ending)
+
+    def _check_calls(self):
+        """检查未定义和递归调用的宏"""
+        for items in [self.items] + list(self.macros.values()):
+            for _, name, mark in self._iter_calls(items):
+                if name not in self.macros:
+                    self._error(mark, f"未定义的宏 '{name}'")
+        # 从每个宏出发深度优先，调用到栈上的宏即为递归
+        done = set()
+        for root in self.macros:
+            if root in done:
+                continue
+            path = [root]
+            pending = [self._iter_calls(self.macros[root])]
+            while pending:
+                call = next(pending[-1], None)
+                if call is None:
+                    done.add(path.pop())
+                    pending.pop()
+                    continue
+                _, name, mark = call
+                if name in path:
+                    self._error(mark, f"宏 '{name}' 递归调用")
+                elif name in self.macros and name not in done:
+                    path.append(name)
+                    pending.append(self._iter_calls(self.macros[name]))
+
+    def _count(self, items, active, counted):
+        """items 展开后的音符数，counted 缓存各个宏的结果"""
+        total = 0
+        for item in items:
+            kind = item[0]
+            if kind == "notes":
+                total += item[2] - item[1]
+            elif kind == "repeat":
+                passes = item[1]
+                total += passes * self._count(item[2], active, counted)
+                for numbers, ending in item[3]:
+                    played = sum(1 for n in numbers if n <= passes)
+                    if played:
+                        total += played * self._count(ending, active, counted)
+            else:
+                name = item[1]
+                if name in self.macros and name not in active:
+                    if name not in counted:
+                        active.add(name)
+                        counted[name] = self._count(
+                            self.macros[name], active, counted)
+                        active.discard(name)
+                    total += counted[name]
+        return total
+
+    def _check_length(self):
+        """展开后超过 limit 时在使其超出的记号处记录错误，返回是否超出"""
+        total = 0
+        counted = {}
+        mark = None
+        for item in self.items:
+            if item[0] != "notes":
+                mark = item[-1]
+            total += self._count([item], set(), counted)
+            if total > self.limit:
+                self._error(mark, f"展开后超过 {self.limit} 个音符，之后的部分不演奏")
+                return True
+        return False
+
+    def _iter_items(self, items, active):
+        for item in items:
+            kind = item[0]
+            if kind == "notes":
+                yield from range(item[1], item[2])
+            elif kind == "repeat":
+                _, passes, body, endings, _ = item
+                for played in range(1, passes + 1):
+                    yield from self._iter_items(body, active)
+                    for numbers, ending in endings:
+                        if played in numbers:
+                            yield from self._iter_items(ending, active)
+            else:
+                name = item[1]
+                # 未定义和递归的调用跳过
+                if name in self.macros and name not in active:
+                    active.add(name)
+                    yield from self._iter_items(self.macros[name], active)
+                    active.discard(name)
+
+
+def expand_table(table):
+    """按演奏顺序展开音符表，没有结构记号时原样返回
+
+    展开后的音符保留原来的行列位置，origin_index 记录其在原表中的下标。
+    展开后过长时截断，truncated 为真。
+    """
+    if not table.marks:
+        return table
+    arrangement = Arrangement(table)
+    indices = array("l", arrangement)
+    expanded = NoteTable()
+    for name, typecode in table.COLUMNS:
+        column = getattr(table, name)
+        setattr(expanded, name, array(typecode, [column[i] for i in indices]))
+    expanded.invalid = table.invalid
+    expanded.origin = table
+    expanded.origin_index = indices
+    expanded.truncated = arrangement.truncated
+    return expanded
+
+
+class _Line:
+    """LineCache 中的一行"""
+    __slots__ = ("text", "state", "out_state", "segment")
+
+    def __init__(self, text):
+        self.text = text
+        # 进入该行时的 (调性偏移, bpm, 默认持续时间)
+        self.state = None
+        # 离开该行时的 (调性偏移, bpm)
+        self.out_state = None
+        # 该行编译出的音符表
+        self.segment = None
+
+
+class LineCache:
+    """按行缓存的增量编译结果
+
+    每行保存文本和以进入该行时的状态编译出的片段。编辑只把受影响的行
+    标记为脏；重新编译时只解析脏行，以及因前面 bpm/调性变化而进入状态
+    改变的行，其余行直接拼接缓存的片段。
+    """
+
+    def __init__(self, line_count=1):
+        # None 表示该行是脏的，需要重新获取文本
+        self.lines = [None] * line_count
+        self.table = None
+        self._state = None
+        # 上次编译时重新解析的行数
+        self.reparsed = 0
+
+    def reset(self, line_count):
+        """把所有行标记为脏"""
+        self.lines = [None] * line_count
+        self.table = None
+
+    def adopt(self, table, key_offset, bpm):
+        """直接使用外部编译好的整个音符表（如二进制缓存），直到下一次编辑
+
+        各行的片段没有缓存，下一次编辑后会整体重新解析。
+        """
+        self.table = table
+        self._state = (key_offset, bpm)
+
+    def splice(self, first, removed, added):
+        """把从 first 行 (从 0 开始) 起的 removed 行替换为 added 个脏行"""
+        self.lines[first:first + removed] = [None] * added
+        self.table = None
+
+    def compile(self, get_lines, key_offset, bpm):
+        """编译为完整音符表
+
+        get_lines(first, last) 返回第 first 到 last 行 (从 1 开始，含两端)
+        的文本列表，只对脏行调用。
+        """
+        if self.table is not None and self._state == (key_offset, bpm):
+            self.reparsed = 0
+            return self.table
+
+        lines = self.lines
+        count = len(lines)
+
+        # 批量获取连续脏行的文本
+        with REGISTRY.span("extract"):
+            i = 0
+            while i < count:
+                if lines[i] is not None:
+                    i += 1
+                    continue
+                j = i
+                while j < count and lines[j] is None:
+                    j += 1
+                for line_num, text in iter_range_lines(get_lines, i + 1, j):
+                    lines[line_num - 1] = _Line(text)
+                i = j
+
+        self._state = (key_offset, bpm)
+        default_duration = 60000 / bpm
+        reparsed = 0
+        # 去注释和分词、解析的耗时分别累计，最后各记一次
+        tokenize_ns = parse_ns = 0
+        clock = time.perf_counter_ns
+        table = NoteTable()
+        for line_num, entry in enumerate(lines, 1):
+            state = (key_offset, bpm, default_duration)
+            if entry.segment is None or entry.state != state:
+                begin = clock()
+                tokens = list(iter_tokens(entry.text))
+                tokenized = clock()
+                entry.segment, key_offset, bpm = compile_tokens(
+                    tokens, key_offset, bpm, default_duration
+                )
+                tokenize_ns += tokenized - begin
+                parse_ns += clock() - tokenized
+                entry.state = state
+                entry.out_state = (key_offset, bpm)
+                reparsed += 1
+            else:
+                key_offset, bpm = entry.out_state
+            table.extend(entry.segment, line_num)
+
+        if reparsed:
+            REGISTRY.add("tokenize", tokenize_ns)
+            REGISTRY.add("parse", parse_ns)
+            REGISTRY.count("reparsed_lines", reparsed)
+        self.reparsed = reparsed
+        self.table = table
+        return table
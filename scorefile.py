@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""编译后曲谱的二进制缓存
+
+缓存文件与曲谱文本文件放在一起（文件名加 CACHE_SUFFIX），格式为：
+
+    文件头 HEADER：魔数、版本、字节序、编译参数、音符数、错误数、
+                  结构记号数、文本字节数、原文本的 SHA-256
+    各列数据：按 COLUMNS 的顺序，每列为定宽数值紧密排列，8 字节对齐
+    错误位置：每个为 (行号, 起始列, 结束列) 三个 int32
+    结构记号：每个为 (音符下标, 行号, 起始列, 结束列) 四个 int32
+    文本：先是各错误的原因，再是各结构记号的文本，以换行分隔 (UTF-8)
+
+缓存的是未展开的音符表，重复和宏在播放时才展开。
+
+读取时用 mmap 映射整个文件，各列直接以 memoryview 作为音符表的列，
+不为每个音符分配对象。文本内容、编译参数或格式版本不符时视为过期。
+"""
+
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import time
+
+from score import KEY_OFFSETS, NoteTable, compile_score
+
+
+MAGIC = b"PCSB"
+FORMAT_VERSION = 4
+CACHE_SUFFIX = ".pcsb"
+
+# 魔数, 版本, 字节序, 调性偏移, bpm, 音符数, 错误数, 记号数, 文本字节数,
+# SHA-256
+HEADER = struct.Struct("<4sHBxiiQQQQ32s")
+BYTE_ORDERS = {"little": 1, "big": 2}
+
+# 文件中各列的定宽格式，onsets 为预先算好的开始时间
+COLUMNS = (
+    ("octave", "b"),
+    ("degree", "b"),
+    ("freq", "d"),
+    ("delay", "d"),
+    ("duration", "d"),
+    ("key", "b"),
+    ("bpm", "i"),
+    ("line", "i"),
+    ("start", "i"),
+    ("end", "i"),
+    ("voices", "b"),
+    ("onsets", "d"),
+)
+
+
+def cache_path(path):
+    """曲谱文件对应的缓存文件路径"""
+    return path + CACHE_SUFFIX
+
+
+def text_digest(text):
+    """曲谱文本的 SHA-256"""
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+def _padding(size):
+    return -size % 8
+
+
+def write_table(path, table, digest, key_offset, bpm):
+    """把音符表写入缓存文件
+
+    先写临时文件再替换，已映射旧文件的读者不受影响。
+    """
+    count = len(table)
+    text = "\n".join([entry[3] for entry in table.invalid]
+                     + [mark[4] for mark in table.marks]).encode("utf-8")
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, BYTE_ORDERS[sys.byteorder],
+                         key_offset, bpm, count, len(table.invalid),
+                         len(table.marks), len(text), digest)
+    temp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp, "wb") as file:
+            file.write(header)
+            file.write(bytes(_padding(HEADER.size)))
+            for name, fmt in COLUMNS:
+                column = (table.onsets() if name == "onsets"
+                          else getattr(table, name))
+                view = memoryview(column)
+                if view.format != fmt:
+                    view = memoryview(struct.pack(f"{count}{fmt}", *column))
+                file.write(view)
+                file.write(bytes(_padding(view.nbytes)))
+            for entry in table.invalid:
+                file.write(struct.pack("3i", *entry[:3]))
+            for mark in table.marks:
+                file.write(struct.pack("4i", *mark[:4]))
+            file.write(text)
+        os.replace(temp, path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def read_table(path, digest=None, key_offset=None, bpm=None):
+    """映射缓存文件并返回音符表，文件不存在、损坏或过期时返回 None
+
+    给出 digest、key_offset、bpm 时检查它们与缓存是否一致。
+    """
+    try:
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size < HEADER.size:
+                return None
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    (magic, version, byte_order, cached_key, cached_bpm, count,
+     invalid_count, mark_count, text_size,
+     cached_digest) = HEADER.unpack_from(data)
+    if (magic != MAGIC or version != FORMAT_VERSION
+            or byte_order != BYTE_ORDERS[sys.byteorder]
+            or (digest is not None and cached_digest != digest)
+            or (key_offset is not None and cached_key != key_offset)
+            or (bpm is not None and cached_bpm != bpm)):
+        data.close()
+        return None
+
+    # 先核对文件长度，再创建任何 memoryview
+    offset = HEADER.size + _padding(HEADER.size)
+    spans = []
+    for _, fmt in COLUMNS:
+        size = count * struct.calcsize(fmt)
+        spans.append((offset, size))
+        offset += size + _padding(size)
+    invalid_size = invalid_count * struct.calcsize("3i")
+    mark_size = mark_count * struct.calcsize("4i")
+    if offset + invalid_size + mark_size + text_size != len(data):
+        data.close()
+        return None
+
+    view = memoryview(data)
+    table = NoteTable()
+    for (name, fmt), (start, size) in zip(COLUMNS, spans):
+        column = view[start:start + size].cast(fmt)
+        if name == "onsets":
+            table._onsets = column
+        else:
+            setattr(table, name, column)
+    texts = bytes(view[offset + invalid_size + mark_size:]).decode(
+        "utf-8").split("\n")
+    table.invalid = [entry + (text,) for entry, text in zip(
+        struct.iter_unpack("3i", view[offset:offset + invalid_size]), texts)]
+    offset += invalid_size
+    table.marks = [entry + (text,) for entry, text in zip(
+        struct.iter_unpack("4i", view[offset:offset + mark_size]),
+        texts[invalid_count:])]
+    # 映射随音符表存在，列不再被引用时一并释放
+    table.mapping = data
+    return table
+
+
+def load_score(path, key_offset, bpm):
+    """读取曲谱文件并返回 (文本, 音符表, 是否命中缓存)
+
+    缓存有效时直接映射，否则重新编译并重写缓存；缓存写不进去时只是不缓存。
+    """
+    with open(path, encoding="utf-8") as file:
+        text = file.read()
+    digest = text_digest(text)
+    cache = cache_path(path)
+    table = read_table(cache, digest, key_offset, bpm)
+    if table is not None:
+        return text, table, True
+
+    table = compile_score(text, key_offset, bpm)
+    try:
+        write_table(cache, table, digest, key_offset, bpm)
+    except OSError as e:
+        print(f"无法写入缓存 {cache}: {e}", file=sys.stderr)
+    return text, table, False
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="为曲谱文件生成或更新二进制缓存")
+    parser.add_argument("paths", nargs="+", help="曲谱文件")
+    parser.add_argument("--bpm", type=int, default=200)
+    parser.add_argument("--key", default="C", choices=list(KEY_OFFSETS))
+    args = parser.parse_args()
+
+    for path in args.paths:
+        start = time.perf_counter()
+        try:
+            _, table, cached = load_score(path, KEY_OFFSETS[args.key], args.bpm)
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"{path}: {e}", file=sys.stderr)
+            continue
+        elapsed = time.perf_counter() - start
+        print(f"{path}: {len(table)} 个音符，"
+              f"{'缓存有效' if cached else '已重新生成缓存'}，用时 {elapsed * 1000:.1f} 毫秒")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
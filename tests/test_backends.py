@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""backends 的测试：evdev 后端写出的事件流"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from backends import (EV_SND, INPUT_EVENT, SND_TONE, BeepBackend,
+                      EvdevBackend, PlayCursor)
+from score import KEY_OFFSETS, compile_score
+
+
+def read_events(path):
+    """读出文件中的 input_event，返回 [(类型, 代码, 数值)]"""
+    with open(path, "rb") as file:
+        data = file.read()
+    size = INPUT_EVENT.size
+    return [INPUT_EVENT.unpack(data[k:k + size])[2:]
+            for k in range(0, len(data), size)]
+
+
+class EvdevBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.device = tempfile.mkstemp(prefix="pcspkr-")
+        os.close(fd)
+        self.addCleanup(os.remove, self.device)
+
+    def play(self, text):
+        table = compile_score(text, KEY_OFFSETS["C"], 200)
+        EvdevBackend(self.device).play(table)
+        return table, read_events(self.device)
+
+    def test_event_stream(self):
+        # 单音、休止符、三个循环的和弦、带延时的音
+        table, events = self.play("1(0,20) 0(0,10) [1 3](0,30) 2(10,20)")
+        c, e, d = (round(table.freq[i]) for i in (0, 3, 4))
+        self.assertEqual(events, [
+            (EV_SND, SND_TONE, c), (EV_SND, SND_TONE, 0),
+            (EV_SND, SND_TONE, c), (EV_SND, SND_TONE, e),
+            (EV_SND, SND_TONE, c), (EV_SND, SND_TONE, 0),
+            (EV_SND, SND_TONE, d), (EV_SND, SND_TONE, 0),
+        ])
+
+    def test_stop_before_play_writes_nothing(self):
+        backend = EvdevBackend(self.device)
+        backend.stop()
+        backend.play(compile_score("1 2 3", KEY_OFFSETS["C"], 200))
+        self.assertEqual(read_events(self.device), [])
+
+
+# 把参数逐行追加到 $BEEP_LOG 的假 beep
+FAKE_BEEP = '#!/bin/sh\necho "$@" >> "$BEEP_LOG"\n'
+CHUNK_SCORE = " ".join(["1 [1 3 5](*2) 0 +2(10,*1)"] * 20)
+
+
+class BeepChunkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = compile_score(CHUNK_SCORE, KEY_OFFSETS["C"], 200)
+        # 每块最多 7 行（和弦的每个音各占一行）
+        self.chunks = -(-len(self.table) // 7)
+
+    def test_chunks_join_to_full_args(self):
+        backend = BeepBackend(program="beep", chunk_size=7)
+        cursor = PlayCursor(self.table)
+        chunks = []
+        total = 0.0
+        while True:
+            chunk = backend._next_chunk(cursor)
+            if chunk is None:
+                break
+            self.assertEqual(chunk[0][0], "beep")
+            chunks.append(chunk[0][1:])
+            total += chunk[1]
+        self.assertEqual(len(chunks), self.chunks)
+        self.assertEqual(join_chunks(chunks), self.table.beep_args()[1:])
+        self.assertAlmostEqual(total, self.table.total_ms())
+
+    def test_play_spawns_every_chunk_in_order(self):
+        workdir = tempfile.mkdtemp(prefix="beep-")
+        program = os.path.join(workdir, "beep")
+        log = os.path.join(workdir, "log")
+        with open(program, "w") as file:
+            file.write(FAKE_BEEP)
+        os.chmod(program, 0o755)
+        os.environ["BEEP_LOG"] = log
+        try:
+            BeepBackend(program=program, chunk_size=7).play(self.table)
+            with open(log) as file:
+                chunks = [line.split() for line in file]
+        finally:
+            del os.environ["BEEP_LOG"]
+            for name in os.listdir(workdir):
+                os.remove(os.path.join(workdir, name))
+            os.rmdir(workdir)
+        self.assertEqual(len(chunks), self.chunks)
+        self.assertEqual(join_chunks(chunks), self.table.beep_args()[1:])
+
+
+# 按参数中的时长睡眠、并记下启动时刻和参数的假 beep
+TIMED_BEEP = f"""#!{sys.executable}
+import os, sys, time
+args = sys.argv[1:]
+ms = sum(float(args[k + 1]) for k, arg in enumerate(args) if arg in ("-l", "-D"))
+with open(os.environ["BEEP_LOG"], "a") as file:
+    file.write(f"{{time.monotonic()}} {{' '.join(args)}}\\n")
+time.sleep(ms / 1000)
+"""
+
+
+class BeepHotSwapTest(unittest.TestCase):
+
+    def test_swap_at_next_note(self):
+        workdir = tempfile.mkdtemp(prefix="beep-")
+        program = os.path.join(workdir, "beep")
+        log = os.path.join(workdir, "log")
+        with open(program, "w") as file:
+            file.write(TIMED_BEEP)
+        os.chmod(program, 0o755)
+        # 60 个 50 ms 的音符，都在同一块里；换表改变第 40 个之后的音
+        old = compile_score(" ".join(["1 2 3 4"] * 15), KEY_OFFSETS["C"], 1200)
+        new = compile_score(" ".join(["1 2 3 4"] * 10 + ["5 5 5 5"] * 5),
+                            KEY_OFFSETS["C"], 1200)
+        backend = BeepBackend(program=program)
+        swaps = []
+        os.environ["BEEP_LOG"] = log
+        try:
+            thread = threading.Thread(target=backend.play, args=(old,), kwargs={
+                "on_swap": lambda *args: swaps.append(args)})
+            begin = time.monotonic()
+            thread.start()
+            time.sleep(0.52)
+            backend.swap(new)
+            thread.join()
+            elapsed = time.monotonic() - begin
+            with open(log) as file:
+                runs = [line.split(" ", 1) for line in file]
+        finally:
+            del os.environ["BEEP_LOG"]
+            for name in os.listdir(workdir):
+                os.remove(os.path.join(workdir, name))
+            os.rmdir(workdir)
+
+        # 换表在正在播放的音符结束时生效，不等到块结束，也不从头播放
+        self.assertEqual(len(swaps), 1)
+        table, index, stop, at_ms = swaps[0]
+        self.assertIs(table, new)
+        self.assertIn(index, (11, 12))
+        self.assertEqual(at_ms, index * 50)
+        self.assertEqual(len(runs), 2)
+        self.assertAlmostEqual(float(runs[1][0]) - float(runs[0][0]),
+                               at_ms / 1000, delta=0.03)
+        self.assertEqual(runs[1][1].split(),
+                         new.beep_args()[1 + 5 * index:])
+        self.assertAlmostEqual(elapsed, 3, delta=0.3)
+
+
+def join_chunks(chunks):
+    """把各块的参数用 -n 连接为一个进程的参数"""
+    joined = []
+    for args in chunks:
+        if joined:
+            joined.append("-n")
+        joined.extend(args)
+    return joined
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""check 和 batch 报告错误的测试"""
+
+import os
+import tempfile
+import unittest
+
+from batch import process_file
+from check import validate_line
+from score import KEY_OFFSETS
+
+
+LINES = (
+    "1 1 1 1 [1 3",
+    "[1 [3 5] 1",
+    "[] 1 1 1 1",
+    "1 1 1 4(0,X)",
+)
+REASONS = [
+    (1, 9, "[1 3", "和弦缺少 ]"),
+    (2, 1, "[1 [3 5]", "和弦不能嵌套"),
+    (3, 1, "[]", "空的和弦"),
+]
+
+
+class ReportTest(unittest.TestCase):
+
+    def test_check_reports_chord_errors(self):
+        errors = []
+        for line_num, line in enumerate(LINES, 1):
+            errors += validate_line(line, line_num, KEY_OFFSETS["C"], 200,
+                                    300, None)[0]
+        self.assertEqual(errors, [
+            f"Line {line}, column {column}: Format error - '{token}': {reason}"
+            for line, column, token, reason in REASONS
+        ] + ["Line 4, column 7: Format error - '4(0,X)': 未知的调性 'X'"])
+
+    def test_batch_reports_reasons(self):
+        with tempfile.NamedTemporaryFile(
+                "w", suffix=".txt", encoding="utf-8", delete=False) as file:
+            file.write("\n".join(LINES) + "\n")
+        try:
+            result = process_file(file.name, KEY_OFFSETS["C"], 200)
+        finally:
+            os.remove(file.name)
+        self.assertFalse(result["valid"])
+        self.assertEqual(result["invalid"], 3)
+        self.assertEqual(
+            [(error["line"], error["column"], error["token"], error["reason"])
+             for error in result["errors"]], REASONS)
+
+
+if __name__ == "__main__":
+    unittest.main()
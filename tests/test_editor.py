@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""编辑器增量编译路径的测试，不需要图形显示
+
+用一个按 Tk Text 的索引规则工作的假编辑框驱动 MusicEditor 的命令代理
+(on_text_command) 和 LineCache，检查编辑后的增量编译结果与整体编译一致，
+并且每次编辑取出和重新解析的行数与文档长度无关。
+"""
+
+import types
+import unittest
+
+from score import KEY_OFFSETS, LineCache, compile_score
+
+try:
+    from main import MusicEditor
+except (ImportError, SyntaxError):  # main.py 需要 Python 3.12 和 tkinter
+    MusicEditor = None
+
+
+LINE = "1 2 3(*0,*1) +5(*0,*2) [1 3 5](*2) -6 #注释"
+SIZES = (10, 1000, 20000)
+
+
+def table_rows(table):
+    return list(table.rows()), table.marks, table.invalid
+
+
+class FakeText:
+    """只实现代理和 LineCache 用到的命令的编辑框，文本保存为一个字符串
+
+    insert/get 等方法同 tkinter.Text，修改经过 proxy（即改名后的 Tk 命令代理）。
+    """
+
+    _w = ".text"
+
+    def __init__(self, text):
+        self.text = text
+        self.tk = self
+        self.proxy = None
+        self.cursor = "1.0"
+        # get() 每次取出的字符数
+        self.got = []
+
+    # Tk 索引 <-> 字符串下标
+    def _offset(self, index):
+        if index.startswith("insert"):
+            index = self.cursor + index[len("insert"):]
+        shift = 0
+        if index.endswith("1c"):
+            index, shift = index[:-3], int(index[-3] + "1")
+        if index == "end":
+            # Tk 文本最后总有一个换行，end-1c 即为文本末尾
+            offset = len(self.text) + 1
+        else:
+            line, col = index.split(".")
+            offset = 0
+            for _ in range(int(line) - 1):
+                offset = self.text.index("\n", offset) + 1
+            end = self.text.find("\n", offset)
+            end = len(self.text) if end < 0 else end
+            offset = end if col == "end" else min(offset + int(col), end)
+        return max(0, min(offset + shift, len(self.text)))
+
+    def _index(self, offset):
+        line = self.text.count("\n", 0, offset) + 1
+        return f"{line}.{offset - self.text.rfind(chr(10), 0, offset) - 1}"
+
+    def call(self, *args):
+        """改名后的原始命令"""
+        if len(args) == 1:
+            args = args[0]
+        op, rest = args[1], args[2:]
+        if op == "index":
+            return self._index(self._offset(rest[0]))
+        if op == "insert":
+            at = self._offset(rest[0])
+            self.text = self.text[:at] + rest[1] + self.text[at:]
+        elif op == "delete":
+            first = self._offset(rest[0])
+            last = self._offset(rest[1]) if len(rest) > 1 else first + 1
+            self.text = self.text[:first] + self.text[last:]
+        return ""
+
+    # tkinter.Text 的方法
+    def insert(self, index, text):
+        self.proxy("insert", self._index(self._offset(index)), text)
+
+    def delete(self, first, last):
+        self.proxy("delete", first, last)
+
+    def get(self, first, last):
+        first, last = self._offset(first), self._offset(last)
+        self.got.append(last - first)
+        return self.text[first:last]
+
+    def mark_set(self, name, index):
+        self.cursor = self._index(self._offset(index))
+
+    def focus_set(self):
+        pass
+
+
+class LineCacheSpliceTest(unittest.TestCase):
+
+    def test_edit_reparses_only_touched_lines(self):
+        for size in SIZES:
+            lines = [LINE] * size
+            fetched = []
+
+            def get_lines(first, last):
+                fetched.append(last - first + 1)
+                return lines[first - 1:last]
+
+            cache = LineCache(size)
+            cache.compile(get_lines, KEY_OFFSETS["C"], 200)
+            middle = size // 2
+            lines[middle] += " 5"
+            cache.splice(middle, 1, 1)
+            fetched.clear()
+            table = cache.compile(get_lines, KEY_OFFSETS["C"], 200)
+            self.assertEqual(fetched, [1])
+            self.assertEqual(cache.reparsed, 1)
+            self.assertEqual(table_rows(table), table_rows(
+                compile_score("\n".join(lines), KEY_OFFSETS["C"], 200)))
+
+
+@unittest.skipIf(MusicEditor is None, "main.py 需要 Python 3.12 和 tkinter")
+class TextProxyTest(unittest.TestCase):
+
+    def editor(self, text):
+        widget = FakeText(text)
+        editor = types.SimpleNamespace(
+            score_text=widget,
+            _text_command="text_orig",
+            line_cache=LineCache(text.count("\n") + 1),
+            highlighter=types.SimpleNamespace(
+                splice=lambda *args: None, reset=lambda *args: None),
+            worker=types.SimpleNamespace(state="stopped"),
+        )
+        widget.proxy = lambda *args: MusicEditor.on_text_command(editor, *args)
+        return editor
+
+    def compile(self, editor):
+        fetched = []
+
+        def get_lines(first, last):
+            fetched.append(last - first + 1)
+            return MusicEditor.get_lines(editor, first, last)
+
+        table = editor.line_cache.compile(get_lines, KEY_OFFSETS["C"], 200)
+        self.assertEqual(table_rows(table), table_rows(
+            compile_score(editor.score_text.text, KEY_OFFSETS["C"], 200)))
+        return sum(fetched), editor.line_cache.reparsed
+
+    def test_edits_are_independent_of_size(self):
+        for size in SIZES:
+            editor = self.editor("\n".join([LINE] * size))
+            widget = editor.score_text
+            self.compile(editor)
+            middle = max(1, size // 2)
+
+            # 快速插入音符：只取光标前一个字符
+            widget.got.clear()
+            widget.mark_set("insert", f"{middle}.end")
+            MusicEditor.insert_note(editor, "5")
+            self.assertEqual(widget.got, [1])
+            self.assertEqual(self.compile(editor), (1, 1))
+
+            # 插入换行：一行变两行
+            widget.insert(f"{middle}.2", "4 4\n")
+            self.assertEqual(self.compile(editor), (2, 2))
+
+            # 跨行删除：两行合并为一行
+            widget.delete(f"{middle}.5", f"{middle + 1}.3")
+            self.assertEqual(self.compile(editor), (1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""midi_import 的测试"""
+
+import io
+import struct
+import unittest
+
+from midi_import import convert
+from score import KEY_OFFSETS
+
+
+def smf(events, division=480):
+    """由 [(时间差, 事件字节)] 组成单音轨的标准 MIDI 文件"""
+    track = bytearray()
+    for delta, data in events + [(0, b"\xff\x2f\x00")]:
+        track.append(delta)  # 测试中时间差都小于 128
+        track += data
+    return (b"MThd" + struct.pack(">IHHh", 6, 0, 1, division)
+            + b"MTrk" + struct.pack(">I", len(track)) + bytes(track))
+
+
+# D 大调调号，D E F# C# 四个四分音符
+D_MAJOR = smf([
+    (0, b"\xff\x59\x02\x02\x00"),
+    (0, b"\x90\x3e\x40"), (120, b"\x80\x3e\x00"),
+    (0, b"\x90\x40\x40"), (120, b"\x80\x40\x00"),
+    (0, b"\x90\x42\x40"), (120, b"\x80\x42\x00"),
+    (0, b"\x90\x49\x40"), (120, b"\x80\x49\x00"),
+])
+
+
+class ConvertKeyTest(unittest.TestCase):
+
+    def test_key_signature_used_by_default(self):
+        out = io.StringIO()
+        convert(D_MAJOR, out)
+        self.assertIn(",D", out.getvalue())
+
+    def test_explicit_key_overrides_signature(self):
+        out = io.StringIO()
+        convert(D_MAJOR, out, key=KEY_OFFSETS["C"])
+        text = out.getvalue()
+        self.assertNotIn(",D", text)
+        # D E F# 在 C 调下为 2 3，F# 需要临时换调
+        self.assertTrue(text.startswith("2("), text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""parts 的测试：两个声部写到 FIFO 和文件时的事件、时刻和声部间偏差"""
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from backends import INPUT_EVENT, tone_event
+from parts import PartPlayer, iter_events, split_parts
+from score import KEY_OFFSETS
+
+
+# 每拍 50 ms；声部 b 的和弦琶音每 10 ms 一个事件，与声部 a 的音符在
+# 0、50、100、150、200 ms 处同时有事件
+SCORE = """>> a
+1 2 3 4
+>> b
+[1 3](0,*2) 5 6
+"""
+
+
+class FifoReader(threading.Thread):
+    """从 FIFO 读出事件，记下每个事件到达的时刻"""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.events = []
+
+    def run(self):
+        size = INPUT_EVENT.size
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            pending = b""
+            while True:
+                data = os.read(fd, 4096)
+                if not data:
+                    break
+                now = time.monotonic_ns()
+                pending += data
+                while len(pending) >= size:
+                    self.events.append((now, pending[:size]))
+                    pending = pending[size:]
+        finally:
+            os.close(fd)
+
+
+class PartPlayerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="parts-")
+        self.parts = split_parts(SCORE.splitlines(True))
+        for part in self.parts:
+            part.compile(KEY_OFFSETS["C"], 1200)
+
+    def tearDown(self):
+        for name in os.listdir(self.workdir):
+            os.remove(os.path.join(self.workdir, name))
+        os.rmdir(self.workdir)
+
+    def path(self, name):
+        return os.path.join(self.workdir, name)
+
+    def expected(self, k):
+        """声部 k 应写出的 [(时刻 ns, 事件)]，最后是停止时的静音"""
+        return [(at, event) for at, _, _, event
+                in iter_events(self.parts[k].table, k)] + [(None, tone_event(0))]
+
+    def test_two_parts_stay_aligned(self):
+        readers = []
+        devices = {}
+        for part in self.parts:
+            path = self.path(part.name)
+            os.mkfifo(path)
+            devices[part.name] = path
+            readers.append(FifoReader(path))
+        for reader in readers:
+            reader.start()
+        player = PartPlayer()
+        stats = player.play(self.parts, devices)
+        for reader in readers:
+            reader.join(5)
+
+        arrivals = []
+        for k, reader in enumerate(readers):
+            expected = self.expected(k)
+            self.assertEqual([event for _, event in reader.events],
+                             [event for _, event in expected])
+            # 每个事件相对第一个事件的到达时刻与曲谱中的时刻一致
+            first = reader.events[0][0]
+            times = {}
+            for (now, _), (at, _) in zip(reader.events, expected):
+                if at is None:
+                    continue
+                self.assertAlmostEqual((now - first) / 1e6, at / 1e6, delta=15)
+                times.setdefault(at, now)
+            arrivals.append(times)
+
+        # 同一时刻的事件在两个声部几乎同时到达
+        shared = sorted(set(arrivals[0]) & set(arrivals[1]))
+        self.assertEqual([at // 1_000_000 for at in shared], [0, 50, 100, 150, 200])
+        for at in shared:
+            self.assertLess(abs(arrivals[0][at] - arrivals[1][at]) / 1e6, 10)
+        self.assertEqual(stats["skew"]["count"], len(shared))
+        self.assertLess(stats["skew"]["max_ms"], 10)
+        self.assertEqual(set(stats["parts"]), {"a", "b"})
+
+    def test_file_sink_is_created(self):
+        path = self.path("out")
+        with open(path, "wb") as file:
+            file.write(b"old")
+        PartPlayer().play(self.parts[:1], {"a": "file:" + path})
+        with open(path, "rb") as file:
+            data = file.read()
+        self.assertEqual(data, b"".join(event for _, event in self.expected(0)))
+
+    def test_missing_device_is_not_created(self):
+        path = self.path("missing")
+        with self.assertRaises(FileNotFoundError):
+            PartPlayer().play(self.parts, {"a": path, "b": path})
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""scheduler 的测试：绝对截止时间和迟到统计"""
+
+import threading
+import time
+import unittest
+
+from scheduler import HISTOGRAM_BUCKETS_US, Scheduler, percentile
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_deadlines_are_absolute(self):
+        scheduler = Scheduler()
+        scheduler.start()
+        start = scheduler.start_ns
+        for k in range(1, 6):
+            self.assertFalse(scheduler.wait_until(k * 2_000_000))
+            # 不早于截止时间，迟到不累积到后面的事件
+            self.assertGreaterEqual(time.monotonic_ns(), start + k * 2_000_000)
+        self.assertEqual(len(scheduler.lateness), 5)
+        self.assertTrue(all(late >= 0 for late in scheduler.lateness))
+
+    def test_late_start_is_recorded(self):
+        scheduler = Scheduler()
+        # 零点在 50 ms 之前，第一个 10 ms 的截止时间已经迟到约 40 ms
+        scheduler.start(time.monotonic_ns() - 50_000_000)
+        scheduler.wait_until(10_000_000)
+        stats = scheduler.stats()
+        self.assertGreaterEqual(stats["max_ms"], 40)
+        self.assertEqual(stats["drift_ms"], stats["max_ms"])
+        self.assertEqual(stats["histogram"][f">={HISTOGRAM_BUCKETS_US[-1]}us"], 1)
+
+    def test_spin_is_counted_separately(self):
+        scheduler = Scheduler()
+        scheduler.start()
+        scheduler.wait_until(1_000_000)
+        scheduler.spin_until(2_000_000)
+        stats = scheduler.stats()
+        self.assertEqual(stats["count"], 2)
+        self.assertEqual(stats["spin"]["count"], 1)
+        self.assertEqual(sum(stats["histogram"].values()), 2)
+
+    def test_stop_event(self):
+        scheduler = Scheduler()
+        scheduler.start()
+        stop = threading.Event()
+        threading.Timer(0.02, stop.set).start()
+        begin = time.monotonic()
+        self.assertTrue(scheduler.wait_until(10_000_000_000, stop))
+        self.assertLess(time.monotonic() - begin, 1)
+        self.assertTrue(scheduler.spin_until(10_000_000_000, stop))
+        # 被停止的等待不计入统计
+        self.assertEqual(len(scheduler.lateness), 0)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([], 50), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""score 的测试"""
+
+import unittest
+
+from score import (KEY_OFFSETS, Arrangement, chord_args, compile_score,
+                   diff_tables, expand_table, highlight_spans, index_mapper)
+
+
+def segments(args):
+    """把 beep 参数按 -n 分成各段"""
+    result = [[]]
+    for arg in args:
+        if arg == "-n":
+            result.append([])
+        else:
+            result[-1].append(arg)
+    return result
+
+
+class ChordArgsTest(unittest.TestCase):
+
+    def test_full_cycles_and_rest(self):
+        args = chord_args((261.63, 329.63), 0, 50)
+        lengths = [float(segment[3]) for segment in segments(args)]
+        self.assertEqual(sum(lengths), 50)
+        self.assertEqual(len(lengths), 5)
+
+    def test_zero_duration_is_silent(self):
+        self.assertEqual(chord_args((261.63, 329.63), 0, 0),
+                         ["-f", "1", "-l", "0"])
+        self.assertEqual(chord_args((261.63, 329.63), 100, 0),
+                         ["-f", "1", "-l", "0", "-D", "100"])
+
+    def test_no_empty_segments_in_score(self):
+        table = compile_score("[1 3 5](0,0) [2 4](100,0) 1", KEY_OFFSETS["C"], 200)
+        for segment in segments(table.beep_args()[1:]):
+            self.assertEqual(segment[0], "-f", segment)
+
+
+class InvalidChordTest(unittest.TestCase):
+
+    CASES = (
+        ("1 1 1 1 [1 3", (8, 12, "和弦缺少 ]"), 4),
+        ("[1 [3 5] 1", (0, 8, "和弦不能嵌套"), 1),
+        ("[] 1", (0, 2, "空的和弦"), 1),
+        ("[1 9](*2) 1", (0, 9, "音符超出范围 (0-7)"), 1),
+        ("[1 3 +9] 1", (0, 8, "音符超出范围 (0-7)"), 1),
+        ("x 1", (0, 1, "无法识别的音高"), 1),
+    )
+
+    def test_reasons(self):
+        for text, (start, end, reason), count in self.CASES:
+            table = compile_score(text, KEY_OFFSETS["C"], 200)
+            self.assertEqual(table.invalid, [(1, start, end, reason)], text)
+            self.assertEqual(len(table), count, text)
+
+    def test_chord_cannot_span_lines(self):
+        table = compile_score("[1 3\n5]", KEY_OFFSETS["C"], 200)
+        self.assertEqual(table.invalid, [(1, 0, 4, "和弦缺少 ]")])
+
+    def test_highlighted(self):
+        for text, (start, end, _), _ in self.CASES:
+            invalid = [span for span in highlight_spans(text)
+                       if span[0] == "invalid"]
+            self.assertEqual(invalid, [("invalid", start, end)], text)
+
+
+OLD_NOTES = "1 2 3 4 5 6 7".split()
+PLAYING = 3
+
+
+def edited(notes):
+    """编译改动后的乐谱，返回 (新表, 正在播放的音符在新表中的下标)"""
+    old = compile_score(" ".join(OLD_NOTES), KEY_OFFSETS["C"], 200)
+    new = compile_score(" ".join(notes), KEY_OFFSETS["C"], 200)
+    prefix, suffix = diff_tables(old, new)
+    return new, index_mapper(len(old), len(new), prefix, suffix)(PLAYING)
+
+
+class IndexMapperTest(unittest.TestCase):
+
+    def test_insert(self):
+        # 在正在播放的音符之前、之处、之后插入一个音
+        for at, expected in ((1, PLAYING + 1), (PLAYING, PLAYING + 1),
+                             (PLAYING + 2, PLAYING)):
+            notes = OLD_NOTES[:at] + ["+1"] + OLD_NOTES[at:]
+            new, index = edited(notes)
+            self.assertEqual(index, expected, at)
+            # 继续播放的仍是原来那个音
+            self.assertEqual(notes[index], OLD_NOTES[PLAYING], at)
+
+    def test_delete(self):
+        for at, expected in ((1, PLAYING - 1), (PLAYING, PLAYING),
+                             (PLAYING + 2, PLAYING)):
+            notes = OLD_NOTES[:at] + OLD_NOTES[at + 1:]
+            new, index = edited(notes)
+            self.assertEqual(index, expected, at)
+            # 删掉正在播放的音时从下一个音继续
+            following = OLD_NOTES[PLAYING + (at == PLAYING)]
+            self.assertEqual(notes[index], following, at)
+
+    def test_replace(self):
+        for at in (1, PLAYING, PLAYING + 2):
+            notes = list(OLD_NOTES)
+            notes[at] = "+1"
+            new, index = edited(notes)
+            # 替换正在播放的音时播放新的音
+            self.assertEqual(index, PLAYING, at)
+
+    def test_unchanged(self):
+        new, index = edited(OLD_NOTES)
+        self.assertEqual(index, PLAYING)
+        old = compile_score(" ".join(OLD_NOTES), KEY_OFFSETS["C"], 200)
+        self.assertEqual(diff_tables(old, new), (len(old), 0))
+
+
+def arrange(text):
+    return Arrangement(compile_score(text, KEY_OFFSETS["C"], 200))
+
+
+class ArrangementTest(unittest.TestCase):
+
+    def assertPlays(self, text, indices):
+        arrangement = arrange(text)
+        self.assertEqual(arrangement.errors, [], text)
+        self.assertEqual(list(arrangement), indices, text)
+
+    def assertError(self, text, token, reason, indices):
+        arrangement = arrange(text)
+        self.assertEqual([error[3:] for error in arrangement.errors],
+                         [(token, reason)], text)
+        self.assertEqual(list(arrangement), indices, text)
+
+    def test_repeats(self):
+        self.assertPlays("|: 1 2 :| 3", [0, 1, 0, 1, 2])
+        self.assertPlays("|: 1 2 :|*3 3", [0, 1, 0, 1, 0, 1, 2])
+        # 没有 |: 时从开头或上一个反复之后开始
+        self.assertPlays("1 :| 2 :|*3", [0, 0, 1, 1, 1])
+        self.assertPlays("|: 1 |: 2 :| :|", [0, 1, 1, 0, 1, 1])
+
+    def test_voltas(self):
+        self.assertPlays("|: 1 |1. 2 |2. 3 :| 4", [0, 1, 0, 2, 3])
+        self.assertPlays("|: 1 |1,3. 2 |2. 3 :| 4", [0, 1, 0, 2, 0, 1, 3])
+        self.assertPlays("|: 1 |1. 2 |2,3. 3 :|*2 4", [0, 1, 0, 2, 3])
+
+    def test_macros(self):
+        self.assertPlays("@a{ 1 2 } 3 @a @a", [2, 0, 1, 0, 1])
+        self.assertPlays("@a { 1 2 } @a", [0, 1])
+        self.assertPlays("@a{ 1 } @b{ @a 2 } |: @b :|", [0, 1, 0, 1])
+        # 使用在定义之前
+        self.assertPlays("@a 1 @a{ 2 }", [1, 0])
+
+    def test_errors(self):
+        self.assertError("1 |: 2 3", "|:", "缺少对应的 :|", [0, 1, 2])
+        self.assertError("1 } 2", "}", "多余的 }", [0, 1])
+        self.assertError("@x 1", "@x", "未定义的宏 'x'", [0])
+        self.assertError("@a{ @a 1 } @a", "@a", "宏 'a' 递归调用", [0])
+        self.assertError("@a{ 1 } @a{ 2 } @a", "@a{", "宏 'a' 重复定义", [1])
+        self.assertError("1 |1. 2", "|1.", "反复结尾不在 |: 和 :| 之间", [0, 1])
+        self.assertError("|: 1 :|*0", ":|*0", "反复次数必须大于 0", [0, 0])
+        self.assertError("@a{ 1 2", "@a{", "宏定义缺少 }", [])
+        self.assertError("|: 1 |0. 2 :|", "|0.", "反复结尾的编号必须大于 0",
+                         [0, 1, 0, 1])
+
+    def test_error_positions(self):
+        arrangement = arrange("1 2\n3 :|*0 }")
+        self.assertEqual([error[:3] for error in arrangement.errors],
+                         [(2, 2, 6), (2, 7, 8)])
+
+    def test_expansion_is_capped(self):
+        table = compile_score("1 |: 2 @a :|*1000000 3 @a{ 4 5 }",
+                              KEY_OFFSETS["C"], 200)
+        arrangement = Arrangement(table)
+        self.assertEqual([error[3] for error in arrangement.errors], [":|*1000000"])
+        self.assertTrue(arrangement.truncated)
+        limit = len(table) + Arrangement.MAX_NOTES
+        self.assertEqual(sum(1 for _ in arrangement), limit)
+
+        expanded = expand_table(table)
+        self.assertTrue(expanded.truncated)
+        self.assertEqual(len(expanded), limit)
+        self.assertEqual(list(expanded.origin_index[:7]), [0, 1, 3, 4, 1, 3, 4])
+
+    def test_long_score_without_repeats_is_not_capped(self):
+        table = compile_score("1 " * (Arrangement.MAX_NOTES + 10) + "|: 2 :|",
+                              KEY_OFFSETS["C"], 200)
+        arrangement = Arrangement(table)
+        self.assertFalse(arrangement.truncated)
+        self.assertEqual(arrangement.errors, [])
+        self.assertEqual(sum(1 for _ in arrangement), len(table) + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""scorefile 的测试"""
+
+import mmap
+import os
+import struct
+import tempfile
+import unittest
+
+import scorefile
+from score import KEY_OFFSETS, NoteTable, compile_score
+from scorefile import cache_path, load_score, read_table, text_digest
+
+
+SCORE = "|: 1 2 :| [1 3](0,20)\n1 %x +5(*2) |1. 3 |2. 4 :|\n"
+KEY = KEY_OFFSETS["D"]
+BPM = 180
+
+
+class ScoreFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="scorefile-")
+        self.path = os.path.join(self.workdir, "score.txt")
+        self.write(SCORE)
+
+    def tearDown(self):
+        for name in os.listdir(self.workdir):
+            os.remove(os.path.join(self.workdir, name))
+        os.rmdir(self.workdir)
+
+    def write(self, text):
+        with open(self.path, "w", encoding="utf-8") as file:
+            file.write(text)
+
+    def assertSameTable(self, table, expected):
+        for name, _ in NoteTable.COLUMNS:
+            self.assertEqual(list(getattr(table, name)),
+                             list(getattr(expected, name)), name)
+        self.assertEqual(list(table.onsets()), list(expected.onsets()))
+        self.assertEqual(table.marks, expected.marks)
+        self.assertEqual(table.invalid, expected.invalid)
+
+    def test_save_and_map(self):
+        text, table, cached = load_score(self.path, KEY, BPM)
+        self.assertFalse(cached)
+        self.assertEqual(text, SCORE)
+        self.assertTrue(os.path.exists(cache_path(self.path)))
+
+        text, mapped, cached = load_score(self.path, KEY, BPM)
+        self.assertTrue(cached)
+        # 各列直接映射自缓存文件
+        self.assertIsInstance(mapped.mapping, mmap.mmap)
+        self.assertIsInstance(mapped.freq, memoryview)
+        self.assertSameTable(mapped, compile_score(SCORE, KEY, BPM))
+        self.assertSameTable(mapped, table)
+
+    def test_changed_text_is_stale(self):
+        load_score(self.path, KEY, BPM)
+        stat = os.stat(self.path)
+        # 长度和修改时间都不变，只有内容不同
+        changed = SCORE.replace("+5", "+6")
+        self.write(changed)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertEqual(os.stat(self.path).st_size, stat.st_size)
+
+        _, table, cached = load_score(self.path, KEY, BPM)
+        self.assertFalse(cached)
+        self.assertSameTable(table, compile_score(changed, KEY, BPM))
+        # 重新生成的缓存对应新内容
+        self.assertTrue(load_score(self.path, KEY, BPM)[2])
+
+    def test_touched_file_stays_cached(self):
+        load_score(self.path, KEY, BPM)
+        os.utime(self.path, (0, 0))
+        self.assertTrue(load_score(self.path, KEY, BPM)[2])
+
+    def test_other_parameters_are_stale(self):
+        load_score(self.path, KEY, BPM)
+        cache = cache_path(self.path)
+        digest = text_digest(SCORE)
+        self.assertIsNotNone(read_table(cache, digest, KEY, BPM))
+        self.assertIsNone(read_table(cache, digest, KEY_OFFSETS["C"], BPM))
+        self.assertIsNone(read_table(cache, digest, KEY, BPM + 1))
+        self.assertIsNone(read_table(cache, text_digest(SCORE + " "), KEY, BPM))
+
+    def test_other_format_version_is_rejected(self):
+        load_score(self.path, KEY, BPM)
+        cache = cache_path(self.path)
+        with open(cache, "r+b") as file:
+            # 版本号紧跟在 4 字节魔数之后
+            file.seek(4)
+            file.write(struct.pack("<H", scorefile.FORMAT_VERSION + 1))
+        self.assertIsNone(read_table(cache))
+        _, table, cached = load_score(self.path, KEY, BPM)
+        self.assertFalse(cached)
+        self.assertTrue(load_score(self.path, KEY, BPM)[2])
+
+    def test_truncated_file_is_rejected(self):
+        load_score(self.path, KEY, BPM)
+        cache = cache_path(self.path)
+        size = os.path.getsize(cache)
+        with open(cache, "r+b") as file:
+            file.truncate(size - 4)
+        self.assertIsNone(read_table(cache))
+        self.assertFalse(load_score(self.path, KEY, BPM)[2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""transform 的测试"""
+
+import unittest
+
+from score import KEY_OFFSETS, compile_score
+from transform import scale_tempo, to_factors, to_milliseconds, transpose
+
+BPM = 200
+KEY = KEY_OFFSETS["C"]
+
+
+def apply(text, transform, *args):
+    """对曲谱文本做一次变换，返回新的文本"""
+    lines = text.split("\n")
+    table = compile_score(text, KEY, BPM)
+    for line_num, new in transform(table, lambda a, b: lines[a - 1:b], *args):
+        lines[line_num - 1] = new
+    return "\n".join(lines)
+
+
+def timings(text):
+    table = compile_score(text, KEY, BPM)
+    return list(table.delay), list(table.duration)
+
+
+class TransposeTest(unittest.TestCase):
+
+    # 中途换调、休止符、和弦，换到 B 调后再往上移就跨过八度
+    TEXT = "1 2(,B) -3 0 [1 3 -5](*2)\n4(,Eb) 5"
+
+    def check(self, semitones, expected):
+        transposed = apply(self.TEXT, transpose, semitones, KEY)
+        self.assertEqual(transposed, expected)
+        old = compile_score(self.TEXT, KEY, BPM)
+        new = compile_score(transposed, KEY, BPM)
+        self.assertEqual(list(new.degree), list(old.degree))
+        self.assertEqual(list(new.voices), list(old.voices))
+        self.assertEqual(timings(transposed), timings(self.TEXT))
+        for i in range(len(old)):
+            if old.degree[i] != -1:
+                # 频率表中的基准频率保留两位小数
+                self.assertAlmostEqual(new.freq[i] / old.freq[i],
+                                       2 ** (semitones / 12), delta=1e-4)
+
+    def test_up_across_octave(self):
+        self.check(2, "1(*1,D) +2(,C♯) 3 0 [+1 +3 5](*2)\n4(,F) 5")
+
+    def test_down_across_octave(self):
+        self.check(-3, "-1(*1,A) 2(,G♯) -3 0 [1 3 -5](*2)\n4(,C) 5")
+
+    def test_whole_octaves(self):
+        self.check(12, "+1 +2(,B) 3 0 [+1 +3 5](*2)\n+4(,D♯) +5")
+
+    def test_out_of_range(self):
+        with self.assertRaises(ValueError):
+            apply("-1 2(,C) [1 +3]", transpose, 12, KEY)
+        with self.assertRaises(ValueError):
+            apply("-1", transpose, -1, KEY)
+
+
+class ScaleTempoTest(unittest.TestCase):
+
+    def check(self, text, factor):
+        scaled = apply(text, scale_tempo, factor, BPM)
+        for old, new in zip(timings(text), timings(scaled)):
+            self.assertEqual(len(old), len(new))
+            for a, b in zip(old, new):
+                self.assertAlmostEqual(a / factor, b, places=2, msg=scaled)
+
+    def test_plain_notes(self):
+        # 第一个音符没有参数，写入的 bpm 不能让它单独变慢
+        self.check("1 2 3", 1.5)
+
+    def test_mixed_parameters(self):
+        self.check("1 2 3\n4(,D) 5(100) 6(*2) 7(50,*0.5) [1 3](,,240) 1", 1.5)
+        self.check("1(,D) 2(,,300) 3 [1 3 5](*2)", 0.8)
+
+
+class ConvertTest(unittest.TestCase):
+
+    TEXT = "1(100,200) 2(*0.5) 3(50,*0.3333) 4(,,240) 5(12.5) 6(1/3)\n7(70,*1.25,D)"
+
+    def test_factors_play_the_same(self):
+        factors = apply(self.TEXT, to_factors)
+        self.assertEqual(timings(factors), timings(self.TEXT))
+
+    def test_round_trip(self):
+        factors = apply(self.TEXT, to_factors)
+        back = apply(factors, to_milliseconds)
+        self.assertEqual(timings(back), timings(self.TEXT))
+        self.assertEqual(apply(back, to_factors), factors)
+        self.assertEqual(apply(apply(back, to_factors), to_milliseconds), back)
+
+
+if __name__ == "__main__":
+    unittest.main()
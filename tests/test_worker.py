@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""worker 的测试：通过命令队列播放、暂停、继续、跳转和停止
+
+使用 evdev 后端写入临时文件，不需要扬声器。
+"""
+
+import os
+import queue
+import tempfile
+import time
+import unittest
+
+from core import BeepPlayer
+from score import KEY_OFFSETS, NoteTable, compile_score
+from worker import PlaybackWorker
+
+# 每个音符 50 ms
+SCORE = " ".join(["1 2 3 4"] * 10)
+BPM = 1200
+
+
+class WorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, device = tempfile.mkstemp(prefix="pcspkr-")
+        os.close(fd)
+        self.addCleanup(os.remove, device)
+        self.events = queue.Queue()
+        self.worker = PlaybackWorker(
+            BeepPlayer(device, "evdev"),
+            lambda event, info: self.events.put((event, info)))
+        self.addCleanup(self.worker.close)
+        self.table = compile_score(SCORE, KEY_OFFSETS["C"], BPM)
+
+    def wait_for(self, name, timeout=5):
+        """等待事件 name，返回其信息；期间的其他事件忽略"""
+        while True:
+            event, info = self.events.get(timeout=timeout)
+            if event == name:
+                return info
+
+    def test_play_to_end(self):
+        self.worker.play(self.table)
+        info = self.wait_for("playing")
+        self.assertEqual((info["start"], info["stop"]), (0, None))
+        self.wait_for("finished")
+        self.assertEqual(self.worker.state, "idle")
+        self.assertEqual(self.worker.metrics()["plays"], 1)
+
+    def test_start_past_the_end(self):
+        # 从最后一个音符之后或在空表上播放：直接结束，播放线程继续工作
+        self.worker.play(self.table, len(self.table))
+        self.wait_for("finished")
+        self.worker.play(NoteTable())
+        self.wait_for("finished")
+        self.worker.play(self.table, len(self.table) - 1)
+        self.wait_for("playing")
+        self.wait_for("finished")
+        self.assertEqual(self.worker.metrics()["playback_threads"], 1)
+
+    def test_failing_command_keeps_thread(self):
+        self.worker.play(self.table, backend="no-such-backend")
+        self.assertIsInstance(self.wait_for("error")["error"], ValueError)
+        self.worker.play(self.table, len(self.table) - 1)
+        self.wait_for("finished")
+        metrics = self.worker.metrics()
+        self.assertEqual(metrics["errors"], 1)
+        self.assertEqual(metrics["playback_threads"], 1)
+
+    def test_stop(self):
+        self.worker.play(self.table)
+        self.wait_for("playing")
+        self.worker.stop()
+        self.wait_for("stopped")
+        metrics = self.worker.metrics()
+        self.assertEqual(metrics["state"], "idle")
+        self.assertEqual(metrics["interrupts"], 1)
+        self.assertLess(metrics["stop_latency_ms"], 100)
+
+    def test_pause_resume(self):
+        self.worker.play(self.table)
+        self.wait_for("playing")
+        time.sleep(0.3)  # 让播放进行一段时间
+        self.worker.pause()
+        index = self.wait_for("paused")["index"]
+        self.assertGreater(index, 0)
+        self.assertEqual(self.worker.state, "paused")
+        self.worker.resume()
+        self.assertEqual(self.wait_for("playing")["start"], index)
+        self.wait_for("finished")
+
+    def test_seek(self):
+        self.worker.play(self.table)
+        self.wait_for("playing")
+        self.worker.pause()
+        self.wait_for("paused")
+        # 暂停中跳转只移动位置
+        self.worker.seek(1000)
+        self.assertEqual(self.wait_for("paused")["index"], 20)
+        self.worker.resume()
+        self.assertEqual(self.wait_for("playing")["start"], 20)
+        # 播放中跳转从新位置继续
+        self.worker.seek(1500)
+        self.assertEqual(self.wait_for("playing")["start"], 30)
+        self.wait_for("finished")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""整首曲谱的批量变换：移调、改变速度、时值在毫秒和倍数之间转换
+
+变换在编译好的（未展开的）音符表上一遍完成：按每个音符记录的位置取出
+它的文本，结合音符表中该音符生效的调性和 bpm 改写，只返回有改动的行，
+调用方可以把它们作为一次编辑写回。音符文本按 (文本, 状态) 缓存改写结果，
+重复的音符只改写一次。
+
+全曲的调性和 bpm 不在文本中；需要改变时，写进第一个音符的参数里，
+这样变换完全体现在文本上，撤销也能完整恢复。无法解析的音符保持原样。
+"""
+
+import argparse
+import re
+import sys
+from functools import lru_cache
+
+from score import (KEY_NAMES, KEY_OFFSETS, compile_score, is_number,
+                   iter_range_lines, param_fields)
+
+
+OCTAVE_PREFIXES = {-1: "-", 0: "", 1: "+"}
+
+# 一个音符（或和弦）的文本：音高部分、参数 (...) 、其余部分
+NOTE_PATTERN = re.compile(r"^(\[[^\]]*\]|[^(]*)(?:\(([^)]*)\))?(.*)$", re.S)
+PITCH_PATTERN = re.compile(r"^([+-]?)(\d+)(.*)$", re.S)
+
+
+def _format(value, digits=3):
+    """数字的简短文本，最多保留 digits 位小数"""
+    text = f"{value:.{digits}f}".rstrip("0").rstrip(".")
+    return "0" if text in ("", "-0") else text
+
+
+def _exact(value, scale=1.0):
+    """最短的文本 t，使 float(t) * scale 恰好等于 value，找不到时返回 None
+
+    解析器把倍数乘以 60000/bpm 得到毫秒，按同样的方式验证，转换后演奏的
+    时值不变，毫秒和倍数之间来回转换也回到同样的数值。
+    """
+    for digits in range(18):
+        text = _format(value / scale, digits)
+        if float(text) * scale == value:
+            return text
+    return None
+
+
+def _split(text):
+    """把音符文本分成 (音高部分, 参数列表或 None, 其余部分)"""
+    pitch, params, rest = NOTE_PATTERN.match(text).groups()
+    return pitch, None if params is None else params.split(","), rest
+
+
+def _join(pitch, params, rest):
+    if params is None:
+        return pitch + rest
+    return f"{pitch}({','.join(params)}){rest}"
+
+
+def _add_state(params, key=None, bpm=None):
+    """在参数中写入调性和/或 bpm，参数列表可以为 None
+
+    没有参数的音符持续一拍；写上参数后空的持续时间改按全曲初始的 bpm
+    计算，因此写成 *1，随写入的 bpm 变化。
+    """
+    if params is None:
+        params = ["*1"]
+    delay, i, key_index, bpm_index = param_fields(params, valid=True)
+    fields = params[:i + 1]
+    fields.append(key if key is not None else
+                  params[key_index] if key_index is not None else "")
+    if bpm is not None or bpm_index is not None:
+        fields.append(str(bpm) if bpm is not None else params[bpm_index])
+    while len(fields) > i + 1 and not fields[-1]:
+        fields.pop()
+    return fields
+
+
+def _map_pitches(pitch, func):
+    """对音高部分（单个音或和弦中的每个音）调用 func(符号, 数字)"""
+    def one(text):
+        match = PITCH_PATTERN.match(text)
+        if not match:
+            return text
+        sign, number, rest = match.groups()
+        return func(sign, number) + rest
+    if pitch.startswith("["):
+        return "[" + re.sub(r"\S+", lambda m: one(m.group()), pitch[1:-1]) + "]"
+    return one(pitch)
+
+
+@lru_cache(maxsize=4096)
+def transpose_note(text, key_offset, semitones):
+    """把调性为 key_offset 的音符移调 semitones 个半音，超出音域时抛出 ValueError"""
+    target = key_offset + semitones
+    shift, new_key = divmod(target, 12)
+    pitch, params, rest = _split(text)
+
+    def move(sign, number):
+        if shift == 0 or int(number) == 0:
+            return sign + number
+        octave = {"-": -1, "": 0, "+": 1}[sign] + shift
+        if octave not in OCTAVE_PREFIXES:
+            raise ValueError(f"音符 '{text}' 移调后超出音域")
+        return OCTAVE_PREFIXES[octave] + number
+
+    pitch = _map_pitches(pitch, move)
+    if params is not None:
+        key_index = param_fields(params, valid=True)[2]
+        if key_index is not None:
+            params = params[:]
+            params[key_index] = KEY_NAMES[new_key]
+    return _join(pitch, params, rest)
+
+
+@lru_cache(maxsize=4096)
+def scale_tempo_note(text, factor, fallback):
+    """速度乘以 factor：毫秒表示的时值除以 factor，bpm 乘以 factor
+
+    fallback 为参数中持续时间为空时使用的时值（全曲初始 bpm 的一拍），
+    改写为除以 factor 后的毫秒数。
+    """
+    pitch, params, rest = _split(text)
+    if params is None:
+        return text
+    params = params[:]
+    delay, duration, _, bpm = param_fields(params, valid=True)
+    for k in (delay, duration):
+        value = params[k].strip() if k is not None else ""
+        if value and not value.startswith("*") and is_number(value):
+            params[k] = _format(float(value) / factor)
+    if not params[duration].strip():
+        params[duration] = _format(fallback / factor)
+    if bpm is not None:
+        params[bpm] = str(max(1, round(int(params[bpm]) * factor)))
+    return _join(pitch, params, rest)
+
+
+@lru_cache(maxsize=4096)
+def convert_note(text, bpm, to_factor):
+    """时值在毫秒和倍数 (*n，以 60000/bpm 为单位) 之间转换
+
+    转换后的数值与原来演奏的时值完全相同；无法用有限位小数精确表示的
+    时值保持原样。
+    """
+    pitch, params, rest = _split(text)
+    if params is None:
+        return text
+    params = params[:]
+    beat = 60000 / bpm
+    delay, duration, _, _ = param_fields(params)
+    for k in (delay, duration):
+        value = params[k].strip() if k is not None else ""
+        if not value or not is_number(value):
+            continue
+        if to_factor and not value.startswith("*"):
+            factor = _exact(float(value), beat)
+            if factor is not None:
+                params[k] = "*" + factor
+        elif not to_factor and value.startswith("*"):
+            ms = _exact(beat * float(value[1:]))
+            if ms is not None:
+                params[k] = ms
+    return _join(pitch, params, rest)
+
+
+def rewrite_notes(table, get_lines, rewrite):
+    """一遍扫描音符表，对每个音符（和弦整体算一个）调用 rewrite(下标, 文本)
+
+    get_lines(first, last) 返回第 first 到 last 行的文本列表（同
+    LineCache.compile）。返回按行号排序的 [(行号, 新的行文本)]，只含有改动的行。
+    """
+    changes = []
+    count = len(table)
+    if not count:
+        return changes
+    line_col, start_col, end_col = table.line, table.start, table.end
+    lines = iter_range_lines(get_lines, line_col[0], line_col[count - 1])
+    line_num, text = next(lines)
+    pieces = []
+    position = 0
+    last = None
+    for i in range(count):
+        if not table.voices[i]:
+            continue
+        line = line_col[i]
+        if line != line_num:
+            if pieces:
+                pieces.append(text[position:])
+                changes.append((line_num, "".join(pieces)))
+                pieces = []
+            position = 0
+            while line_num != line:
+                line_num, text = next(lines)
+        start, end = start_col[i], end_col[i]
+        if (line, start) == last:
+            continue
+        last = (line, start)
+        old = text[start:end]
+        try:
+            new = rewrite(i, old)
+        except ValueError as e:
+            raise ValueError(f"第 {line} 行第 {start + 1} 列: {e}") from None
+        if new != old:
+            pieces.append(text[position:start])
+            pieces.append(new)
+            position = end
+    if pieces:
+        pieces.append(text[position:])
+        changes.append((line_num, "".join(pieces)))
+    return changes
+
+
+def _first_note(table):
+    """第一个音符（和弦首音）的下标，没有时返回 None"""
+    for i in range(len(table)):
+        if table.voices[i]:
+            return i
+    return None
+
+
+def _with_first(table, rewrite, state):
+    """让第一个音符的改写结果带上全曲新的调性或 bpm（若它本来没有写）"""
+    first = _first_note(table)
+
+    def wrapped(i, text):
+        text = rewrite(i, text)
+        if i == first:
+            pitch, params, rest = _split(text)
+            fields = (param_fields(params, valid=True) if params is not None
+                      else (None,) * 4)
+            key, bpm = state
+            key = key if fields[2] is None else None
+            bpm = bpm if fields[3] is None else None
+            if key is not None or bpm is not None:
+                text = _join(pitch, _add_state(params, key, bpm), rest)
+        return text
+    return wrapped
+
+
+def transpose(table, get_lines, semitones, key_offset):
+    """全曲移调 semitones 个半音，key_offset 为全曲的调性偏移
+
+    改变调性参数，必要时改写八度前缀；全曲调性改变时写进第一个音符。
+    有音符超出音域时抛出 ValueError，不做任何改动。
+    """
+    keys = table.key
+    rewrite = _with_first(
+        table, lambda i, text: transpose_note(text, keys[i], semitones),
+        (KEY_NAMES[(key_offset + semitones) % 12] if semitones % 12 else None,
+         None))
+    return rewrite_notes(table, get_lines, rewrite)
+
+
+def scale_tempo(table, get_lines, factor, bpm):
+    """速度乘以 factor（大于 1 为加快），bpm 为全曲的 bpm，会写进第一个音符"""
+    if factor <= 0:
+        raise ValueError("速度倍数必须大于 0")
+    new_bpm = max(1, round(bpm * factor))
+    fallback = 60000 / bpm
+    rewrite = _with_first(
+        table, lambda i, text: scale_tempo_note(text, factor, fallback),
+        (None, new_bpm if new_bpm != bpm else None))
+    return rewrite_notes(table, get_lines, rewrite)
+
+
+def to_factors(table, get_lines):
+    """把毫秒表示的时值改为倍数表示"""
+    bpms = table.bpm
+    return rewrite_notes(
+        table, get_lines, lambda i, text: convert_note(text, bpms[i], True))
+
+
+def to_milliseconds(table, get_lines):
+    """把倍数表示的时值改为毫秒表示"""
+    bpms = table.bpm
+    return rewrite_notes(
+        table, get_lines, lambda i, text: convert_note(text, bpms[i], False))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="整首曲谱的批量变换，结果输出到标准输出或 -o 指定的文件")
+    parser.add_argument("score", help="曲谱文件")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--transpose", type=int, metavar="半音",
+                       help="移调若干半音，可为负")
+    group.add_argument("--tempo", type=float, metavar="倍数",
+                       help="速度乘以该倍数")
+    group.add_argument("--to-factor", action="store_true",
+                       help="时值改为倍数表示")
+    group.add_argument("--to-ms", action="store_true",
+                       help="时值改为毫秒表示")
+    parser.add_argument("-o", "--output", help="输出文件")
+    parser.add_argument("--bpm", type=int, default=200)
+    parser.add_argument("--key", default="C", choices=list(KEY_OFFSETS))
+    args = parser.parse_args()
+
+    with open(args.score, encoding="utf-8") as file:
+        lines = file.read().split("\n")
+    key_offset = KEY_OFFSETS[args.key]
+    table = compile_score("\n".join(lines), key_offset, args.bpm)
+
+    def get_lines(first, last):
+        return lines[first - 1:last]
+
+    try:
+        if args.transpose is not None:
+            changes = transpose(table, get_lines, args.transpose, key_offset)
+        elif args.tempo is not None:
+            changes = scale_tempo(table, get_lines, args.tempo, args.bpm)
+        else:
+            changes = (to_factors if args.to_factor else to_milliseconds)(
+                table, get_lines)
+    except ValueError as e:
+        print(f"变换失败: {e}", file=sys.stderr)
+        return 1
+    for line_num, text in changes:
+        lines[line_num - 1] = text
+    print(f"改动了 {len(changes)} 行", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write("\n".join(lines))
+    else:
+        sys.stdout.write("\n".join(lines))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+import time
+
+from metrics import REGISTRY
+
+
+class PlaybackWorker:
+    """常驻的播放线程
+
+    所有播放都在同一个线程里按命令队列依次执行，不会有两个播放同时进行。
+    play/stop/pause/seek 会先立即打断正在进行的播放，再把命令放入队列；
+    后端在播放开始前收到的停止请求也会生效，因此打断总能在有限时间内完成。
+
+    状态变化以 on_event(事件, 信息) 通知，回调在播放线程中执行：
+    playing {table, start, stop, start_ns}、
+    swapped {table, index, stop, at_ms}、paused {index}、stopped、
+    finished、error {error}。
+    """
+
+    def __init__(self, player, on_event=None):
+        self.player = player
+        self.on_event = on_event
+        self.state = "idle"
+        # 播放线程是否正在播放
+        self._busy = False
+        self._commands = queue.Queue()
+        self._lock = threading.Lock()
+        # 每次打断加一，播放线程据此跳过已过时的命令
+        self._generation = 0
+        self._interrupt_ns = None
+        # 最近一次播放 [音符表, 起始下标, 结束下标, 开始时间, 时间偏移]，
+        # 时间偏移为开始时刻对应的曲谱时间 (毫秒)，换表后随之更新
+        self._current = None
+        # 暂停或停止时的位置 (音符表, 下标, 结束下标)
+        self._position = None
+        self._metrics = {
+            "plays": 0,
+            "interrupts": 0,
+            "stop_latency_ms": None,
+            "max_stop_latency_ms": 0.0,
+            "leaked_processes": 0,
+            "errors": 0,
+            "swaps": 0,
+        }
+        self._thread = threading.Thread(
+            target=self._run, name="playback", daemon=True)
+        self._thread.start()
+
+    # 以下方法可在任意线程调用
+
+    def play(self, table, start=0, stop=None, backend=None):
+        """播放音符表的第 start 到 stop 个音符，backend 不为 None 时先切换后端"""
+        self._send("play", table, start, stop, backend, time.monotonic_ns())
+
+    def stop(self):
+        """停止播放"""
+        self._send("stop")
+
+    def pause(self):
+        """暂停，记住当前位置"""
+        self._send("pause")
+
+    def resume(self):
+        """从暂停的位置继续播放"""
+        self._commands.put(("resume",))
+
+    def seek(self, ms):
+        """跳转到 ms 处；播放中则从该处继续播放，暂停中则只移动位置"""
+        self._send("seek", ms)
+
+    def update(self, table):
+        """播放中换用改动后的音符表，从下一个音符起生效，返回是否已提交"""
+        with self._lock:
+            if not self._busy:
+                return False
+            self.player.backend.swap(table)
+            return True
+
+    def close(self):
+        """停止播放并结束播放线程"""
+        self._send("quit")
+        self._thread.join()
+
+    def metrics(self):
+        """指标快照"""
+        snapshot = dict(self._metrics)
+        snapshot["state"] = self.state
+        snapshot["queued_commands"] = self._commands.qsize()
+        snapshot["playback_threads"] = sum(
+            1 for thread in threading.enumerate()
+            if thread.name == "playback" and thread.is_alive())
+        snapshot["live_processes"] = len(self.player.backend.live_processes())
+        return snapshot
+
+    def _send(self, *command):
+        with self._lock:
+            self._generation += 1
+            if self._busy and self._interrupt_ns is None:
+                self._interrupt_ns = time.monotonic_ns()
+            self.player.stop()
+            self._commands.put(command)
+
+    # 以下方法只在播放线程中执行
+
+    def _emit(self, event, **info):
+        self.state = {"playing": "playing", "swapped": "playing",
+                      "paused": "paused"}.get(event, "idle")
+        if self.on_event:
+            self.on_event(event, info)
+
+    def _run(self):
+        while True:
+            command = self._commands.get()
+            if command[0] == "quit":
+                break
+            try:
+                self._execute(command)
+            except Exception as e:
+                # 一条命令失败不能结束播放线程
+                self._metrics["errors"] += 1
+                self._emit("error", error=e)
+
+    def _execute(self, command):
+        """执行一条命令（quit 以外）"""
+        name = command[0]
+        if name == "play":
+            _, table, start, stop, backend, requested_ns = command
+            if backend is not None:
+                self.player.set_backend(backend)
+            self._play(table, start, stop, requested_ns)
+        elif name == "stop":
+            self._position = None
+            if self.state != "idle":
+                self._emit("stopped")
+        elif name == "pause":
+            if self._position is not None:
+                self._emit("paused", index=self._position[1])
+        elif name == "resume":
+            if self.state == "paused" and self._position is not None:
+                self._play(*self._position)
+        elif name == "seek":
+            self._seek(command[1])
+
+    def _seek(self, ms):
+        if self._position is not None:
+            table, _, stop = self._position
+        elif self._current is not None:
+            table, _, stop = self._current[:3]
+        else:
+            return
+        self._position = (table, table.index_at_time(ms), stop)
+        if self.state == "paused":
+            self._emit("paused", index=self._position[1])
+        else:
+            self._play(*self._position)
+
+    def _play(self, table, start, stop, requested_ns=None):
+        if requested_ns is None:
+            requested_ns = time.monotonic_ns()
+        with self._lock:
+            # 队列里还有命令时，这次播放已经过时
+            if not self._commands.empty():
+                self._position = (table, start, stop)
+                return
+        if start >= len(table):
+            # 空表或从最后一个音符之后开始：没有可播放的音符
+            self._position = None
+            self._emit("finished")
+            return
+        with self._lock:
+            generation = self._generation
+            self._interrupt_ns = None
+            self._busy = True
+            self.player.backend.reset()
+
+        self._current = [table, start, stop, None, table.onsets()[start]]
+        self._metrics["plays"] += 1
+
+        def started(start_ns):
+            self._current[3] = start_ns
+            # 从发出播放命令到交给后端
+            REGISTRY.add("dispatch", start_ns - requested_ns)
+            self._emit("playing", table=table, start=start, stop=stop,
+                       start_ns=start_ns)
+
+        def swapped(new_table, index, new_stop, at_ms):
+            current = self._current
+            current[0], current[2] = new_table, new_stop
+            current[4] = new_table.onsets()[index] - at_ms
+            self._metrics["swaps"] += 1
+            self._emit("swapped", table=new_table, index=index, stop=new_stop,
+                       at_ms=at_ms)
+
+        def failed(error):
+            self._metrics["errors"] += 1
+            self._emit("error", error=error)
+
+        try:
+            with REGISTRY.profiled():
+                self.player.play_table(
+                    table, started, start, stop, failed, swapped)
+        finally:
+            with self._lock:
+                self._busy = False
+
+        # 没有发声时后端留着的是上一次播放的时间
+        first_tone_ns = getattr(self.player.backend, "first_tone_ns", None)
+        if first_tone_ns is not None and first_tone_ns >= requested_ns:
+            REGISTRY.add("time_to_first_tone", first_tone_ns - requested_ns)
+
+        # 清理没有正常退出的进程
+        for process in self.player.backend.live_processes():
+            process.kill()
+            process.wait()
+            self._metrics["leaked_processes"] += 1
+
+        interrupt_ns = self._interrupt_ns
+        if generation == self._generation or interrupt_ns is None:
+            self._position = None
+            if self.state == "playing":
+                self._emit("finished")
+            return
+
+        # 被打断：记录延迟和当前位置
+        latency = (time.monotonic_ns() - interrupt_ns) / 1e6
+        self._metrics["interrupts"] += 1
+        self._metrics["stop_latency_ms"] = latency
+        REGISTRY.add("stop_latency", round(latency * 1e6))
+        self._metrics["max_stop_latency_ms"] = max(
+            self._metrics["max_stop_latency_ms"], latency)
+        table, _, stop, start_ns, offset_ms = self._current
+        index = start
+        if start_ns is not None:
+            elapsed = (interrupt_ns - start_ns) / 1e6
+            index = table.index_at_time(offset_ms + elapsed)
+        self._position = (table, index, stop)